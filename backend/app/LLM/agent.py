@@ -6,7 +6,6 @@ from sqlalchemy.orm import Session
 import google.generativeai as genai
 from PIL import Image
 from app.database import models
-import asyncio
 import time
 import random
 
@@ -156,18 +155,14 @@ def classify_and_assign_tier_hybrid(db: Session, page_id: int):
     # ✅ ส่ง SSE หลัง commit
     if pending_updates:
         try:
-            from app.routes.facebook.sse import customer_type_update_queue
-
-            async def send_all():
-                for update in pending_updates:
-                    await customer_type_update_queue.put(update)
-                    print(f"📡 Queueing SSE update: {update['psid']} -> {update['customer_type_knowledge_name']}")
-
-            try:
-                loop = asyncio.get_running_loop()
-                loop.create_task(send_all())
-            except RuntimeError:
-                asyncio.run(send_all())
+            from app.service.sse_broker import publish
+
+            # SSE ใช้ Facebook page_id (page_id ในฟังก์ชันนี้คือ ID ของตาราง facebook_pages)
+            fb_page_id = db.query(models.FacebookPage.page_id).filter(models.FacebookPage.ID == page_id).scalar()
+            for update in pending_updates:
+                update['page_id'] = fb_page_id
+                publish(fb_page_id, update)
+                print(f"📡 Published SSE update: {update['psid']} -> {update['customer_type_knowledge_name']}")
 
         except Exception as e:
             print(f"❌ Error sending SSE updates: {e}")
@@ -13,14 +13,22 @@ from app.routes import pages, webhook, custom_messages, fb_customer, sync, group
 from app.routes import facebook
 from app.routes import retarget_tiers
 from app.routes import mining_status
+from app.routes import media
 
 # Import database
 from app.database import crud, database, models, schemas
-from app.database.database import SessionLocal, engine, Base
+from app.database.database import (SessionLocal, engine, async_engine, replica_engine, async_replica_engine,
+                                   replica_health, Base, PROCESS_ROLE, DB_PGBOUNCER)
+from app.database.pool_metrics import pool_metrics
+from app.database.migrations import run_startup_migrations, backfill_media_blobs
 
 # Import services
 from app.service.message_scheduler import message_scheduler
 from app.service.auto_sync_service import auto_sync_service
+from app.service.webhook_ingest import webhook_ingest_consumer
+from app.service.sse_broker import sse_broker
+from app.service.sse_poller import customer_change_poller
+from app.service.change_feed import change_feed_listener
 
 # Import task scheduler
 from app.task.scheduler import start_scheduler
@@ -41,6 +49,8 @@ app = FastAPI()
 
 # สร้างตารางในฐานข้อมูล
 Base.metadata.create_all(bind=engine)
+# เพิ่ม column/ดัชนีที่ create_all ไม่ทำให้กับตารางเดิม
+run_startup_migrations(engine)
 
 # เพิ่ม CORS middleware
 app.add_middleware(
@@ -61,12 +71,30 @@ app.include_router(fb_customer.router)
 app.include_router(sync.router)
 app.include_router(group_messages.router)
 app.include_router(retarget_tiers.router)
+app.include_router(media.router)
 
 # Root endpoint
 @app.get("/")
 async def root():
     return {"message": "Facebook Bot API with FastAPI is running."}
 
+# สถานะ connection pool ของโปรเซสนี้ (รอ connection นานแค่ไหน / pool เต็มแค่ไหน / ถือ connection นานแค่ไหน)
+@app.get("/metrics/db-pool")
+async def db_pool_metrics():
+    return {
+        "process_role": PROCESS_ROLE,
+        "pgbouncer": DB_PGBOUNCER,
+        "pid": os.getpid(),
+        "sync": pool_metrics(engine),
+        "async": pool_metrics(async_engine.sync_engine),
+        "replica": {
+            "lag_seconds": replica_health.lag,
+            "in_use": replica_health.usable(),
+            "sync": pool_metrics(replica_engine),
+            "async": pool_metrics(async_replica_engine.sync_engine),
+        } if replica_engine is not None else None,
+    }
+
 # ฟังก์ชันสำหรับ run scheduler
 def run_scheduler():
     """รัน scheduler ใน thread แยก"""
@@ -114,12 +142,28 @@ async def startup_event():
     # Start task scheduler
     start_scheduler()
 
+    # Start webhook ingest consumer (ปิดได้ถ้ารันแยก process)
+    if os.getenv("WEBHOOK_INGEST_IN_API", "true").lower() == "true":
+        webhook_ingest_consumer.start_in_thread()
+        logging.info("Webhook ingest consumer thread started")
+
+    # Postgres LISTEN/NOTIFY -> SSE (leader ตัวเดียวทั้งระบบ)
+    change_feed_listener.start()
+
+    # ย้ายสื่อเดิม (image_data) ไป blob store แบบ background
+    if os.getenv("MEDIA_BACKFILL_ON_STARTUP", "true").lower() == "true":
+        threading.Thread(target=backfill_media_blobs, daemon=True).start()
+
 @app.on_event("shutdown")
 async def shutdown_event():
     """ปิดเมื่อ app หยุดทำงาน"""
     logging.info("Shutting down...")
     message_scheduler.stop()
     auto_sync_service.stop()
+    webhook_ingest_consumer.stop()
+    customer_change_poller.stop()
+    await change_feed_listener.stop()
+    await sse_broker.close()
 
 # สำหรับรันแอป
 if __name__ == "__main__":
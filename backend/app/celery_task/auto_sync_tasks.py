@@ -8,6 +8,7 @@ from app.service.facebook_api import fb_get
 from app.service.auto_sync_service import auto_sync_service
 from app.celery_task.customer_tasks import handle_new_customer_task, handle_existing_customer_task
 from app.utils.redis_helper import get_page_token
+from app.utils import lookup_cache
 import logging
 
 logger = logging.getLogger(__name__)
@@ -106,7 +107,7 @@ def process_participant_task(self, participant_data, page_id, convo_id, access_t
 
         logger.info(f"👤 [Participant] Processing {name} ({participant_id})")
 
-        page = crud.get_page_by_page_id(db, page_id)
+        page = lookup_cache.get_page(db, page_id)
         if not page:
             return {"error": f"page_id {page_id} not found"}
         
@@ -120,7 +121,7 @@ def process_participant_task(self, participant_data, page_id, convo_id, access_t
         print(f"✅ Step 1 Success: Token found for page_id={page_id}")
 
 
-        existing = crud.get_customer_by_psid(db, page.ID, participant_id)
+        existing = lookup_cache.get_customer_id(db, page.ID, participant_id)
         if existing:
             # ✅ ลูกค้าเก่า → ให้ Celery จัดการอัปเดต
             msg_time = datetime.now().isoformat()
@@ -0,0 +1,252 @@
+"""
+Broadcast Tasks
+แตก campaign ขนาดใหญ่เป็น chunk แล้วส่งผ่าน Celery
+- แต่ละเพจถูก route ไป queue เดิมเสมอ (page affinity) ด้วย crc32(page_id)
+- จำกัดจำนวน chunk ที่ส่งพร้อมกันต่อเพจด้วย lease ใน Redis
+- รวมผลของทุก chunk ไว้ที่ตาราง broadcast_campaigns
+"""
+
+from app.celery_worker import celery_app
+from app.database.database import SessionLocal
+from app.database import models
+from app.utils.redis_helper import r, get_page_token
+from celery.exceptions import SoftTimeLimitExceeded
+from datetime import datetime
+from sqlalchemy import case
+from typing import Any, Dict, List
+import asyncio
+import logging
+import os
+import time
+import uuid
+import zlib
+
+logger = logging.getLogger(__name__)
+
+BROADCAST_CHUNK_SIZE = int(os.getenv("BROADCAST_CHUNK_SIZE", 100))
+BROADCAST_QUEUE_SHARDS = int(os.getenv("BROADCAST_QUEUE_SHARDS", 4))
+# จำนวน chunk ที่ส่งพร้อมกันได้ต่อเพจ (ทุก worker รวมกัน)
+BROADCAST_PAGE_CONCURRENCY = int(os.getenv("BROADCAST_PAGE_CONCURRENCY", 2))
+BROADCAST_SLOT_TTL = int(os.getenv("BROADCAST_SLOT_TTL", 960))
+# retry ของ chunk (รอ slot ว่าง + error ระหว่างส่ง) - ครบแล้วบันทึกทั้ง chunk เป็น failed เพื่อให้ campaign ปิดได้
+BROADCAST_CHUNK_MAX_RETRIES = int(os.getenv("BROADCAST_CHUNK_MAX_RETRIES", 120))
+
+# ยึด slot แบบ atomic: ล้าง lease ที่หมดอายุ แล้วเพิ่ม lease ใหม่ถ้ายังไม่เต็ม
+ACQUIRE_SLOT_LUA = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+if redis.call('ZCARD', KEYS[1]) < tonumber(ARGV[3]) then
+    redis.call('ZADD', KEYS[1], ARGV[2], ARGV[4])
+    redis.call('EXPIRE', KEYS[1], ARGV[5])
+    return 1
+end
+return 0
+"""
+_acquire_slot_script = r.register_script(ACQUIRE_SLOT_LUA)
+
+
+def page_queue(page_id: str) -> str:
+    """queue ของเพจ - เพจเดียวกันไป queue เดิมเสมอ"""
+    shard = zlib.crc32(str(page_id).encode()) % BROADCAST_QUEUE_SHARDS
+    return f"broadcast.p{shard}"
+
+
+def all_broadcast_queues() -> List[str]:
+    return [f"broadcast.p{i}" for i in range(BROADCAST_QUEUE_SHARDS)]
+
+
+def _slot_key(page_id: str) -> str:
+    return f"broadcast:page_slots:{page_id}"
+
+
+def acquire_page_slot(page_id: str, lease_id: str) -> bool:
+    now = time.time()
+    return bool(_acquire_slot_script(
+        keys=[_slot_key(page_id)],
+        args=[now, now + BROADCAST_SLOT_TTL, BROADCAST_PAGE_CONCURRENCY, lease_id, BROADCAST_SLOT_TTL],
+    ))
+
+
+def release_page_slot(page_id: str, lease_id: str):
+    r.zrem(_slot_key(page_id), lease_id)
+
+
+def dispatch_campaign(page_id: str, psids: List[str], messages: List[Dict], schedule: Dict[str, Any] = None,
+                      group_type: str = "") -> str:
+    """สร้าง campaign record แล้วส่ง chunk เข้า queue ของเพจ - คืนค่า campaign_id"""
+    from app.service.send_ledger import schedule_campaign_key  # lazy import
+
+    chunks = [psids[i:i + BROADCAST_CHUNK_SIZE] for i in range(0, len(psids), BROADCAST_CHUNK_SIZE)]
+    campaign_id = uuid.uuid4().hex
+    # ทุก chunk ใช้ ledger key เดียวกัน - retry ของ chunk จะไม่ส่งซ้ำ
+    campaign_key = schedule_campaign_key(str(schedule['id'])) if schedule else f"campaign:{campaign_id}"
+
+    db = SessionLocal()
+    try:
+        db.add(models.BroadcastCampaign(
+            id=campaign_id,
+            page_id=page_id,
+            schedule_id=str(schedule['id']) if schedule else None,
+            group_type=group_type,
+            status="queued",
+            total_recipients=len(psids),
+            total_chunks=len(chunks),
+        ))
+        db.commit()
+    finally:
+        db.close()
+
+    queue = page_queue(page_id)
+    for chunk in chunks:
+        send_broadcast_chunk_task.apply_async(
+            args=[campaign_id, page_id, chunk, messages, schedule, group_type, campaign_key],
+            queue=queue,
+        )
+
+    logger.info(f"[{group_type}] 📦 Campaign {campaign_id}: {len(psids)} users in {len(chunks)} chunks -> {queue}")
+    return campaign_id
+
+
+def cancel_campaign(campaign_id: str) -> bool:
+    """ยกเลิก campaign - chunk ที่ยังไม่เริ่มจะถูกข้าม"""
+    db = SessionLocal()
+    try:
+        updated = db.query(models.BroadcastCampaign).filter(
+            models.BroadcastCampaign.id == campaign_id,
+            models.BroadcastCampaign.status.in_(["queued", "running"])
+        ).update({"status": "cancelled", "finished_at": datetime.now()}, synchronize_session=False)
+        db.commit()
+        return updated > 0
+    finally:
+        db.close()
+
+
+def cancel_schedule_campaigns(schedule_id: str) -> int:
+    db = SessionLocal()
+    try:
+        updated = db.query(models.BroadcastCampaign).filter(
+            models.BroadcastCampaign.schedule_id == str(schedule_id),
+            models.BroadcastCampaign.status.in_(["queued", "running"])
+        ).update({"status": "cancelled", "finished_at": datetime.now()}, synchronize_session=False)
+        db.commit()
+        return updated
+    finally:
+        db.close()
+
+
+def _record_chunk_result(campaign_id: str, sent: int, failed: int, error: str = None):
+    """รวมผลของ chunk เข้า campaign แบบ atomic (sent = sent + n)"""
+    db = SessionLocal()
+    try:
+        Campaign = models.BroadcastCampaign
+        values = {
+            Campaign.sent: Campaign.sent + sent,
+            Campaign.failed: Campaign.failed + failed,
+            Campaign.completed_chunks: Campaign.completed_chunks + 1,
+        }
+        if error:
+            values[Campaign.error] = error
+        db.query(Campaign).filter(Campaign.id == campaign_id).update(values, synchronize_session=False)
+
+        # chunk สุดท้ายปิด campaign (แถวถูก lock จาก UPDATE ข้างบนจนกว่าจะ commit) - ไม่มีใครได้รับเลย = failed
+        db.query(Campaign).filter(
+            Campaign.id == campaign_id,
+            Campaign.completed_chunks >= Campaign.total_chunks,
+            Campaign.status.in_(["queued", "running"])
+        ).update({
+            "status": case(((Campaign.sent == 0) & (Campaign.failed > 0), "failed"), else_="completed"),
+            "finished_at": datetime.now()
+        }, synchronize_session=False)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+def _get_campaign_status(campaign_id: str):
+    db = SessionLocal()
+    try:
+        campaign = db.query(models.BroadcastCampaign.status).filter(
+            models.BroadcastCampaign.id == campaign_id
+        ).first()
+        return campaign.status if campaign else None
+    finally:
+        db.close()
+
+
+def _mark_running(campaign_id: str):
+    db = SessionLocal()
+    try:
+        db.query(models.BroadcastCampaign).filter(
+            models.BroadcastCampaign.id == campaign_id,
+            models.BroadcastCampaign.status == "queued"
+        ).update({"status": "running"}, synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+
+
+@celery_app.task(bind=True, max_retries=BROADCAST_CHUNK_MAX_RETRIES, soft_time_limit=900, time_limit=960, acks_late=True)
+def send_broadcast_chunk_task(self, campaign_id: str, page_id: str, psids: List[str], messages: List[Dict],
+                              schedule: Dict[str, Any] = None, group_type: str = "", campaign_key: str = None):
+    """Celery task: ส่ง 1 chunk ของ campaign ภายใต้ rate budget ของเพจ"""
+    from app.service.broadcast_engine import broadcast_engine, BroadcastJob, BROADCAST_RATE_PER_PAGE  # lazy import
+
+    status = _get_campaign_status(campaign_id)
+    if status is None or status == "cancelled":
+        logger.info(f"⏭️ Campaign {campaign_id} {status or 'missing'}, skip chunk of {len(psids)} users")
+        if status == "cancelled":
+            _record_chunk_result(campaign_id, 0, 0)
+        return {"status": "skipped", "campaign_id": campaign_id}
+
+    # จำกัดจำนวน chunk ที่ส่งพร้อมกันต่อเพจ - เต็มแล้วให้รอแล้วลองใหม่
+    lease_id = self.request.id or uuid.uuid4().hex
+    if not acquire_page_slot(page_id, lease_id):
+        if self.request.retries >= BROADCAST_CHUNK_MAX_RETRIES:
+            logger.error(f"❌ Campaign {campaign_id}: no send slot for page {page_id}, giving up chunk")
+            _record_chunk_result(campaign_id, 0, len(psids), "no send slot available for page")
+            return {"status": "error", "campaign_id": campaign_id}
+        raise self.retry(countdown=5)
+
+    job = None
+    try:
+        access_token = get_page_token(page_id)
+        if not access_token:
+            _record_chunk_result(campaign_id, 0, len(psids), f"No access_token found for page_id={page_id}")
+            return {"status": "error", "campaign_id": campaign_id}
+
+        _mark_running(campaign_id)
+
+        # แบ่ง rate budget ของเพจให้ chunk ที่ส่งพร้อมกัน
+        rate = BROADCAST_RATE_PER_PAGE / max(1, BROADCAST_PAGE_CONCURRENCY)
+        # สร้าง job เองเพื่อให้ยังอ่านผลที่ส่งไปแล้วได้เมื่อ timeout
+        job = BroadcastJob(page_id, psids, str(schedule['id']) if schedule else None, group_type)
+        asyncio.run(broadcast_engine.run(
+            page_id, psids, messages, access_token, schedule, group_type,
+            rate_per_sec=rate, campaign_key=campaign_key or f"campaign:{campaign_id}", job=job
+        ))
+
+        _record_chunk_result(campaign_id, job.sent, job.failed, job.error)
+        logger.info(f"✅ Campaign {campaign_id} chunk done: {job.sent} success, {job.failed} failed")
+        return {"status": job.status, "campaign_id": campaign_id, "sent": job.sent, "failed": job.failed}
+
+    except SoftTimeLimitExceeded:
+        # บันทึกผลที่ส่งไปแล้วก่อน timeout - ผู้รับที่ยังไม่ถึงคิวนับเป็น failed
+        sent, failed = (job.sent, job.failed) if job else (0, 0)
+        not_processed = len(psids) - (job.done if job else 0)
+        logger.warning(f"⏰ Timeout while sending chunk of campaign {campaign_id}: "
+                       f"{sent} sent, {failed} failed, {not_processed} not processed")
+        _record_chunk_result(campaign_id, sent, failed + not_processed,
+                             f"chunk timeout: {not_processed} recipients not processed")
+        return {"status": "timeout", "campaign_id": campaign_id, "sent": sent, "failed": failed + not_processed}
+    except Exception as e:
+        # ส่งซ้ำได้ปลอดภัย (send ledger ข้ามผู้รับที่ส่งแล้ว) - ครั้งสุดท้ายบันทึกเป็น failed ให้ campaign ปิดได้
+        if self.request.retries < BROADCAST_CHUNK_MAX_RETRIES:
+            logger.warning(f"⚠️ Campaign {campaign_id} chunk error, retrying: {e}")
+            raise self.retry(exc=e, countdown=min(60, 5 * (self.request.retries + 1)))
+        logger.exception(f"❌ Campaign {campaign_id} chunk failed")
+        _record_chunk_result(campaign_id, 0, len(psids), f"chunk error: {e}")
+        return {"status": "error", "campaign_id": campaign_id}
+    finally:
+        release_page_slot(page_id, lease_id)
@@ -7,6 +7,7 @@ from app.database import crud
 from app.service.auto_sync_service import auto_sync_service
 from celery.exceptions import SoftTimeLimitExceeded
 from app.utils.redis_helper import get_page_token
+from app.utils import lookup_cache
 import logging
 
 logger = logging.getLogger(__name__)
@@ -19,7 +20,7 @@ def handle_new_customer_task(self, page_id: str, participant_id: str, participan
     try:
         logger.info(f"🆕 [Celery] Creating new customer: {participant_name} ({participant_id}) | page={page_id}")
 
-        page = crud.get_page_by_page_id(db, page_id)
+        page = lookup_cache.get_page(db, page_id)
         if not page:
             return {"error": f"Page {page_id} not found"}
         
@@ -59,7 +60,7 @@ def handle_existing_customer_task(self, page_id: str, customer_psid: str, msg_ti
     try:
         logger.info(f"📝 [Celery] Updating existing customer {customer_psid} | page={page_id}")
 
-        page = crud.get_page_by_page_id(db, page_id)
+        page = lookup_cache.get_page(db, page_id)
         if not page:
             return {"error": f"Page {page_id} not found"}
         
@@ -2,6 +2,7 @@ from app.celery_worker import celery_app
 from app.database.database import SessionLocal
 from app.service.fb_messenger import send_facebook_message
 from app.utils.redis_helper import get_page_token
+from app.service import send_ledger
 from datetime import datetime, timezone
 import logging
 import io
@@ -16,15 +17,27 @@ def send_message_task(
     psid: str,
     message: str = None,
     msg_type: str = "text",
-    image_binary: bytes = None,
+    media_digest: str = None,
     is_system_message: bool = False,
     message_tag: str = None
 ):
     """
     Celery Task: ส่งข้อความหรือรูปภาพผ่าน Facebook Messenger API
-    - msg_type: "text" หรือ "image"
-    - image_binary: ถ้าเป็นรูป ให้ใส่ binary data
+    - msg_type: "text", "image" หรือ "video"
+    - media_digest: digest ของสื่อใน blob store (ไม่ส่ง bytes ผ่าน broker)
     """
+    # 🧾 ใช้ task id เป็น ledger key - retry ของ task เดิมจะไม่ส่งซ้ำ
+    campaign_key = f"task:{self.request.id}"
+    msg_key = "0"
+    if not send_ledger.claim(campaign_key, msg_key, psid, page_id):
+        entry = send_ledger.get_entry(campaign_key, msg_key, psid)
+        logger.info(f"⏭️ Message to PSID={psid} already {entry.status if entry else 'claimed'}, skip resend")
+        return {
+            "status": entry.status if entry else "skipped",
+            "psid": psid,
+            "message_id": entry.graph_message_id if entry else None
+        }
+
     db = SessionLocal()
     try:
         # 🔑 ดึง access_token จาก Redis
@@ -40,7 +53,7 @@ def send_message_task(
             psid=psid,
             message=message,
             msg_type=msg_type,
-            image_binary=image_binary,
+            media_digest=media_digest,
             access_token=access_token,
             is_system_message=is_system_message,
             message_tag=tag_allowed
@@ -50,10 +63,18 @@ def send_message_task(
         if "error" in result:
             raise Exception(result["error"])
 
+        send_ledger.mark_sent(campaign_key, msg_key, psid, result.get("message_id"))
         logger.info(f"✅ Message sent to PSID={psid} successfully")
         return {"status": "success", "psid": psid, "result": result}
 
     except Exception as e:
+        if send_ledger.is_delivery_unknown(e):
+            # request อาจถึง Facebook แล้ว - ไม่ retry เพื่อกันส่งซ้ำ
+            send_ledger.mark_unknown(campaign_key, msg_key, psid, str(e))
+            logger.warning(f"⚠️ Delivery to {psid} unknown, not retrying: {e}")
+            return {"status": send_ledger.STATUS_UNKNOWN, "psid": psid}
+
+        send_ledger.mark_failed(campaign_key, msg_key, psid, str(e))
         logger.error(f"❌ Celery error sending message to {psid}: {e}")
         raise
     finally:
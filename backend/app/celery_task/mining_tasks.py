@@ -3,6 +3,7 @@ from app.database.database import SessionLocal
 from celery.exceptions import SoftTimeLimitExceeded
 from sqlalchemy import text
 from app.database import crud, models
+from app.utils import lookup_cache
 from datetime import datetime
 import logging
 
@@ -19,7 +20,7 @@ def update_mining_status_task(self, page_id: str, psids: list, status: str, note
     errors = []
 
     try:
-        page = crud.get_page_by_page_id(db, page_id)
+        page = lookup_cache.get_page(db, page_id)
         if not page:
             raise ValueError(f"Page not found: {page_id}")
 
@@ -65,7 +66,7 @@ def reset_mining_status_task(self, page_id: str, psids: list):
     db = SessionLocal()
     reset_count = 0
     try:
-        page = crud.get_page_by_page_id(db, page_id)
+        page = lookup_cache.get_page(db, page_id)
         if not page:
             raise ValueError(f"Page not found: {page_id}")
 
@@ -92,7 +93,7 @@ def clean_mining_history_task(self, page_id: str):
     """ล้าง record เก่าของสถานะ (เก็บเฉพาะล่าสุด)"""
     db = SessionLocal()
     try:
-        page = crud.get_page_by_page_id(db, page_id)
+        page = lookup_cache.get_page(db, page_id)
         if not page:
             raise ValueError(f"Page not found: {page_id}")
 
@@ -23,6 +23,10 @@ def sync_new_user_data_task(self, page_id: str, sender_id: str, page_db_id: int)
             sync_new_user_data(page_id, sender_id, page_db_id, db)
         )
 
+        # ข้อความที่ webhook บันทึกไว้ก่อนลูกค้าถูกสร้าง
+        from app.database import crud
+        crud.link_customer_messages(db, page_db_id, sender_id)
+
         logger.info(f"✅ [Celery] Done syncing user {sender_id} for page_id={page_id}")
         return {"status": "success", "sender_id": sender_id, "result": result}
 
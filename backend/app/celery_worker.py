@@ -36,5 +36,6 @@ celery_app.conf.include = [
     "app.celery_task.mining_tasks",
     "app.celery_task.webhook_task",
     "app.celery_task.page_tasks",
-    "app.celery_task.pages_admin"
+    "app.celery_task.pages_admin",
+    "app.celery_task.broadcast_tasks"
 ]
\ No newline at end of file
@@ -0,0 +1,168 @@
+"""
+Async CRUD
+query ที่ route แบบ async def เรียกบ่อย (ใช้ AsyncSession จาก get_async_db)
+- ฟังก์ชันชื่อเดียวกับใน crud.py ให้ผลเหมือนกัน แต่ไม่ block event loop
+- AsyncSession lazy load relationship ไม่ได้ -> โหลดล่วงหน้าด้วย selectinload หรือ join ใน query
+"""
+
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import func, or_, select, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+
+import app.database.models as models
+from app.database import crud
+
+# ชื่อ User Group ล่าสุดของลูกค้า (จาก fb_customer_custom_classifications)
+_latest_custom_type_name = (
+    select(models.CustomerTypeCustom.type_name)
+    .join(
+        models.FBCustomerCustomClassification,
+        models.FBCustomerCustomClassification.new_category_id == models.CustomerTypeCustom.id
+    )
+    .where(models.FBCustomerCustomClassification.customer_id == models.FbCustomer.id)
+    .order_by(models.FBCustomerCustomClassification.classified_at.desc())
+    .limit(1)
+    .correlate(models.FbCustomer)
+    .scalar_subquery()
+    .label("customer_type_custom")
+)
+
+
+async def get_page_by_page_id(db: AsyncSession, page_id: str) -> Optional[models.FacebookPage]:
+    result = await db.execute(select(models.FacebookPage).where(models.FacebookPage.page_id == page_id))
+    return result.scalars().first()
+
+
+async def get_customers_by_page(db: AsyncSession, page_id: int, skip: int = 0, limit: int = 100):
+    """ลูกค้าของเพจ (ล่าสุดก่อน) -> [(FbCustomer, ชื่อ User Group)]"""
+    result = await db.execute(
+        select(models.FbCustomer, _latest_custom_type_name)
+        .where(models.FbCustomer.page_id == page_id)
+        .order_by(models.FbCustomer.last_interaction_at.desc())
+        .offset(skip).limit(limit)
+    )
+    return result.all()
+
+
+async def search_customers(db: AsyncSession, page_id: int, search_term: str):
+    """ค้นหาลูกค้าจากชื่อหรือ PSID -> [(FbCustomer, ชื่อ User Group)]"""
+    result = await db.execute(
+        select(models.FbCustomer, _latest_custom_type_name).where(
+            models.FbCustomer.page_id == page_id,
+            or_(
+                models.FbCustomer.name.ilike(f"%{search_term}%"),
+                models.FbCustomer.customer_psid.ilike(f"%{search_term}%")
+            )
+        )
+    )
+    return result.all()
+
+
+async def get_customer_by_psid(db: AsyncSession, page_id: int, customer_psid: str):
+    """ลูกค้าจาก PSID พร้อม current_category (knowledge) -> (FbCustomer, ชื่อ User Group) หรือ None"""
+    result = await db.execute(
+        select(models.FbCustomer, _latest_custom_type_name)
+        .options(selectinload(models.FbCustomer.current_category))
+        .where(
+            models.FbCustomer.page_id == page_id,
+            models.FbCustomer.customer_psid == customer_psid
+        )
+    )
+    return result.first()
+
+
+async def get_customer_statistics(db: AsyncSession, page_id: int) -> Dict[str, int]:
+    """สถิติลูกค้าของเพจ (page DB ID) จาก rollup รายวัน"""
+    result = await db.execute(text(crud.CUSTOMER_STATISTICS_SQL), {"page_id": page_id})
+    return crud.customer_statistics_dict(result.one())
+
+
+async def get_customer_daily_stats(db: AsyncSession, page_id: int, days: int = 30) -> List[Dict]:
+    """จำนวนลูกค้าใหม่ / ลูกค้าที่คุยต่อวัน ย้อนหลัง days วัน (page DB ID)"""
+    result = await db.execute(text(crud.CUSTOMER_DAILY_STATS_SQL), {"page_id": page_id, "days": days})
+    return crud.customer_daily_stats_list(result.all())
+
+
+async def get_page_mining_statuses(db: AsyncSession, page_id: int) -> Dict[str, Dict[str, Any]]:
+    """สถานะการขุดของลูกค้าทุกคนในเพจ (page DB ID)"""
+    result = await db.execute(text("""
+        SELECT
+            c.customer_psid,
+            ms.status,
+            ms.note,
+            ms.created_at
+        FROM fb_customers c
+        LEFT JOIN fb_customer_mining_status ms ON c.id = ms.customer_id
+        WHERE c.page_id = :page_id
+        ORDER BY c.customer_psid
+    """), {"page_id": page_id})
+
+    statuses = {}
+    for row in result:
+        statuses[row[0]] = {
+            "status": row[1] or "ยังไม่ขุด",
+            "note": row[2],
+            "created_at": row[3]
+        }
+    return statuses
+
+
+async def get_customer_groups(db: AsyncSession, page_id: int, include_inactive: bool = False) -> List[Dict]:
+    """User Groups ของเพจพร้อมจำนวนลูกค้า (นับทุกกลุ่มใน query เดียว)"""
+    customer_count = (
+        select(func.count(models.FbCustomer.id))
+        .where(
+            models.FbCustomer.page_id == page_id,
+            models.FbCustomer.current_category_id == models.CustomerTypeCustom.id
+        )
+        .correlate(models.CustomerTypeCustom)
+        .scalar_subquery()
+    )
+    query = select(models.CustomerTypeCustom, customer_count).where(models.CustomerTypeCustom.page_id == page_id)
+    if not include_inactive:
+        query = query.where(models.CustomerTypeCustom.is_active == True)
+    result = await db.execute(query.order_by(models.CustomerTypeCustom.created_at.desc()))
+
+    return [
+        {
+            "id": group.id,
+            "page_id": group.page_id,
+            "type_name": group.type_name,
+            "keywords": group.keywords or [],
+            "examples": group.examples or [],
+            "rule_description": group.rule_description,
+            "is_active": group.is_active,
+            "created_at": group.created_at,
+            "updated_at": group.updated_at,
+            "customer_count": count or 0
+        }
+        for group, count in result.all()
+    ]
+
+
+async def get_all_customer_type_knowledge(db: AsyncSession) -> List[models.CustomerTypeKnowledge]:
+    result = await db.execute(select(models.CustomerTypeKnowledge))
+    return list(result.scalars().all())
+
+
+async def get_page_knowledge_records(db: AsyncSession, page_db_id: int) -> List[models.PageCustomerTypeKnowledge]:
+    """page_customer_type_knowledge ของเพจพร้อม knowledge (สร้าง default ให้ถ้ายังไม่มี)"""
+    query = (
+        select(models.PageCustomerTypeKnowledge)
+        .options(selectinload(models.PageCustomerTypeKnowledge.knowledge))
+        .where(models.PageCustomerTypeKnowledge.page_id == page_db_id)
+    )
+    records = list((await db.execute(query)).scalars().all())
+    if records:
+        return records
+
+    for kt in await get_all_customer_type_knowledge(db):
+        db.add(models.PageCustomerTypeKnowledge(
+            page_id=page_db_id,
+            customer_type_knowledge_id=kt.id,
+            is_enabled=True
+        ))
+    await db.commit()
+    return list((await db.execute(query)).scalars().all())
@@ -4,12 +4,13 @@ from app.database.schemas import FacebookPageCreate, FacebookPageUpdate
 from sqlalchemy.exc import IntegrityError
 import app.database.models as models
 import app.database.schemas as schemas
-from sqlalchemy import or_, func
-from datetime import datetime, timedelta
+from sqlalchemy import or_, func, text
+from datetime import datetime
 from typing import List, Dict, Optional, Any
 import logging
 import json
-from sqlalchemy.orm import Session, joinedload
+from sqlalchemy.orm import Session, joinedload, undefer
+from app.utils import lookup_cache
 
 
 
@@ -34,6 +35,7 @@ def create_page(db: Session, page: schemas.FacebookPageCreate):
     db.add(db_page)
     db.commit()
     db.refresh(db_page)
+    lookup_cache.invalidate_page(db_page.page_id)
     return db_page
 
 def update_page(db: Session, id: int, page_update: FacebookPageUpdate):
@@ -44,6 +46,7 @@ def update_page(db: Session, id: int, page_update: FacebookPageUpdate):
         db_page.page_name = page_update.page_name
     db.commit()
     db.refresh(db_page)
+    lookup_cache.invalidate_page(db_page.page_id)
     return db_page
 
 def delete_page(db: Session, id: int):
@@ -51,6 +54,8 @@ def delete_page(db: Session, id: int):
     if db_page:
         db.delete(db_page)
         db.commit()
+        # ลูกค้าของเพจถูกลบตาม (cascade) -> ล้าง cache ทั้งหมด
+        lookup_cache.invalidate_all()
     return db_page
 
 def get_all_connected_pages(db: Session):
@@ -134,6 +139,8 @@ def create_or_update_customer(db: Session, page_id: int, customer_psid: str, cus
         db.add(db_customer)
         db.commit()
         db.refresh(db_customer)
+        # ล้าง negative cache ของ psid นี้ทุกโปรเซส
+        lookup_cache.invalidate_customer(page_id, customer_psid)
         return db_customer
 
 # แก้ไขฟังก์ชัน get_customer_by_psid ให้ใช้ ID ที่ถูกต้อง
@@ -171,6 +178,77 @@ def update_customer_interaction(db: Session, page_id: int, customer_psid: str):
     
     return None
 
+def bulk_touch_customer_interactions(db: Session, interactions: List[tuple]) -> set:
+    """อัพเดท last_interaction_at ของลูกค้าหลายคนใน UPDATE เดียว
+    interactions: [(page_db_id, psid, interaction_time), ...] - 1 รายการต่อลูกค้า
+    คืนค่า set ของ (page_db_id, psid) ที่มีอยู่ในฐานข้อมูล (ที่เหลือคือลูกค้าใหม่)
+    """
+    if not interactions:
+        return set()
+
+    page_ids, psids, times = zip(*interactions)
+    rows = db.execute(text("""
+        UPDATE fb_customers AS c
+        SET last_interaction_at = GREATEST(c.last_interaction_at, v.ts),
+            first_interaction_at = COALESCE(c.first_interaction_at, v.ts),
+            updated_at = NOW()
+        FROM unnest(CAST(:page_ids AS integer[]), CAST(:psids AS text[]), CAST(:times AS timestamptz[]))
+             AS v(page_id, psid, ts)
+        WHERE c.page_id = v.page_id AND c.customer_psid = v.psid
+        RETURNING c.page_id, c.customer_psid
+    """), {"page_ids": list(page_ids), "psids": list(psids), "times": list(times)}).fetchall()
+    db.commit()
+    return {(row.page_id, row.customer_psid) for row in rows}
+
+def insert_webhook_messages(db: Session, messages: List[dict]) -> int:
+    """บันทึกข้อความจาก webhook ลง customer_messages (ซ้ำตาม mid จะถูกข้าม)
+    messages: dict ที่มี page_db_id, psid (ลูกค้า), sender_id, is_echo, mid, message_text, message_type, created_at
+    - customer_id / ชื่อผู้ส่ง / conversation_id เดิมของลูกค้า หาใน SQL ครั้งเดียว
+    คืนค่าจำนวนข้อความที่เพิ่มใหม่
+    """
+    if not messages:
+        return 0
+
+    columns = ("page_db_id", "psid", "sender_id", "is_echo", "mid", "message_text", "message_type", "created_at")
+    params = {column: [message[column] for message in messages] for column in columns}
+    result = db.execute(text("""
+        INSERT INTO customer_messages
+            (customer_id, conversation_id, sender_id, sender_name, message_text, message_type, created_at, mid)
+        SELECT c.id,
+               COALESCE(
+                   (SELECT cm.conversation_id FROM customer_messages cm
+                    WHERE cm.customer_id = c.id ORDER BY cm.created_at DESC LIMIT 1),
+                   'conv_' || v.psid
+               ),
+               v.sender_id,
+               CASE WHEN v.is_echo THEN p.page_name
+                    ELSE COALESCE(c.name, 'User...' || RIGHT(v.psid, 8)) END,
+               v.message_text, v.message_type, v.created_at, v.mid
+        FROM unnest(CAST(:page_db_id AS integer[]), CAST(:psid AS text[]), CAST(:sender_id AS text[]),
+                    CAST(:is_echo AS boolean[]), CAST(:mid AS text[]), CAST(:message_text AS text[]),
+                    CAST(:message_type AS text[]), CAST(:created_at AS timestamptz[]))
+             AS v(page_db_id, psid, sender_id, is_echo, mid, message_text, message_type, created_at)
+        JOIN facebook_pages p ON p."ID" = v.page_db_id
+        LEFT JOIN fb_customers c ON c.page_id = v.page_db_id AND c.customer_psid = v.psid
+        ON CONFLICT (mid) DO NOTHING
+    """), params)
+    db.commit()
+    return result.rowcount
+
+def link_customer_messages(db: Session, page_db_id: int, psid: str) -> int:
+    """ผูก customer_id ให้ข้อความจาก webhook ที่เข้ามาก่อนลูกค้าถูกสร้างในฐานข้อมูล"""
+    result = db.execute(text("""
+        UPDATE customer_messages AS cm
+        SET customer_id = c.id
+        FROM fb_customers c
+        WHERE c.page_id = :page_db_id AND c.customer_psid = :psid
+          AND cm.customer_id IS NULL
+          AND cm.mid IS NOT NULL
+          AND (cm.sender_id = :psid OR cm.conversation_id = 'conv_' || :psid)
+    """), {"page_db_id": page_db_id, "psid": psid})
+    db.commit()
+    return result.rowcount
+
 def search_customers(db: Session, page_id: int, search_term: str):
     """ค้นหาลูกค้าจากชื่อหรือ PSID"""
     return db.query(models.FbCustomer).filter(
@@ -284,6 +362,46 @@ def bulk_create_or_update_customers(db: Session, page_id: int, customers_data: L
     
     return results
 
+# สถิติจาก customer_daily_stats (trigger บน fb_customers ดูแล) - อ่าน row รายวันของเพจเดียวใน query เดียว
+# ไม่ขึ้นกับจำนวนลูกค้าในเพจ / ช่วงเวลานับเป็นวันตามเวลาไทย (7 วัน = วันนี้ + 6 วันก่อนหน้า)
+CUSTOMER_STATISTICS_SQL = """
+    SELECT COALESCE(SUM(new_customers), 0) AS total_customers,
+           COALESCE(SUM(last_active_customers) FILTER (WHERE day > stats_day(now()) - 7), 0) AS active_7days,
+           COALESCE(SUM(last_active_customers) FILTER (WHERE day > stats_day(now()) - 30), 0) AS active_30days,
+           COALESCE(SUM(new_customers) FILTER (WHERE day > stats_day(now()) - 7), 0) AS new_7days
+    FROM customer_daily_stats
+    WHERE page_id = :page_id
+"""
+
+# กราฟรายวันย้อนหลัง :days วัน (วันที่ไม่มี row = 0)
+CUSTOMER_DAILY_STATS_SQL = """
+    SELECT d::date AS day,
+           COALESCE(s.new_customers, 0) AS new_customers,
+           COALESCE(s.active_customers, 0) AS active_customers
+    FROM generate_series(stats_day(now()) - (CAST(:days AS integer) - 1), stats_day(now()), interval '1 day') d
+    LEFT JOIN customer_daily_stats s ON s.page_id = :page_id AND s.day = d::date
+    ORDER BY d
+"""
+
+def customer_statistics_dict(row) -> Dict[str, int]:
+    return {
+        "total_customers": int(row.total_customers),
+        "active_7days": int(row.active_7days),
+        "active_30days": int(row.active_30days),
+        "new_7days": int(row.new_7days),
+        "inactive_customers": int(row.total_customers - row.active_30days)
+    }
+
+def customer_daily_stats_list(rows) -> List[Dict]:
+    return [
+        {
+            "date": row.day.isoformat(),
+            "new_customers": row.new_customers,
+            "active_customers": row.active_customers
+        }
+        for row in rows
+    ]
+
 def get_customer_statistics(db: Session, page_id):
     """ดึงสถิติของลูกค้าในเพจ"""
     # แปลง page_id ให้เป็น database ID ที่ถูกต้อง
@@ -297,36 +415,14 @@ def get_customer_statistics(db: Session, page_id):
             "new_7days": 0,
             "inactive_customers": 0
         }
-    
-    total_customers = db.query(func.count(models.FbCustomer.id)).filter(
-        models.FbCustomer.page_id == db_page_id
-    ).scalar()
-    
-    # ลูกค้าที่ active ใน 7 วันที่ผ่านมา
-    active_7days = db.query(func.count(models.FbCustomer.id)).filter(
-        models.FbCustomer.page_id == db_page_id,
-        models.FbCustomer.last_interaction_at >= datetime.now() - timedelta(days=7)
-    ).scalar()
-    
-    # ลูกค้าที่ active ใน 30 วันที่ผ่านมา
-    active_30days = db.query(func.count(models.FbCustomer.id)).filter(
-        models.FbCustomer.page_id == db_page_id,
-        models.FbCustomer.last_interaction_at >= datetime.now() - timedelta(days=30)
-    ).scalar()
-    
-    # ลูกค้าใหม่ใน 7 วันที่ผ่านมา
-    new_7days = db.query(func.count(models.FbCustomer.id)).filter(
-        models.FbCustomer.page_id == db_page_id,
-        models.FbCustomer.created_at >= datetime.now() - timedelta(days=7)
-    ).scalar()
-    
-    return {
-        "total_customers": total_customers or 0,
-        "active_7days": active_7days or 0,
-        "active_30days": active_30days or 0,
-        "new_7days": new_7days or 0,
-        "inactive_customers": (total_customers or 0) - (active_30days or 0)
-    }
+
+    row = db.execute(text(CUSTOMER_STATISTICS_SQL), {"page_id": db_page_id}).one()
+    return customer_statistics_dict(row)
+
+def get_customer_daily_stats(db: Session, page_id: int, days: int = 30) -> List[Dict]:
+    """จำนวนลูกค้าใหม่ / ลูกค้าที่คุยต่อวัน ย้อนหลัง days วัน (page DB ID)"""
+    rows = db.execute(text(CUSTOMER_DAILY_STATS_SQL), {"page_id": page_id, "days": days}).fetchall()
+    return customer_daily_stats_list(rows)
     
 # ========== CustomerTypeCustom CRUD Operations ==========
 
@@ -505,6 +601,146 @@ def get_customers_updated_after(db: Session, page_id: int, after_time: datetime)
         db.rollback()
         return []
     
+CUSTOMER_UPDATE_SQL = """
+    SELECT c.id, c.customer_psid, c.name, c.first_interaction_at, c.last_interaction_at,
+           c.source_type, c.current_category_id, v.current_category_name,
+           v.mining_status, c.updated_at, p.page_id AS fb_page_id
+    FROM fb_customers c
+    JOIN facebook_pages p ON p."ID" = c.page_id
+    LEFT JOIN customer_view v ON v.customer_id = c.id
+    WHERE {where}
+    ORDER BY c.updated_at
+    LIMIT :limit
+"""
+
+def _customer_update_dict(row) -> Dict:
+    return {
+        'id': row.id,
+        'psid': row.customer_psid,
+        'name': row.name or f"User...{row.customer_psid[-8:]}",
+        'first_interaction': row.first_interaction_at.isoformat() if row.first_interaction_at else None,
+        'last_interaction': row.last_interaction_at.isoformat() if row.last_interaction_at else None,
+        'source_type': row.source_type,
+        'current_category_id': row.current_category_id,
+        'current_category_name': row.current_category_name,
+        'mining_status': row.mining_status or 'ยังไม่ขุด',
+        'action': 'update',
+        'updated_at': row.updated_at,
+        'fb_page_id': row.fb_page_id,
+    }
+
+def get_customer_updates_after(db: Session, page_id: int, after_time: datetime, limit: int = 500) -> List[Dict]:
+    """ลูกค้าที่ถูกแก้ไขหลัง after_time ในรูปแบบที่ SSE ส่ง - query เดียว (ชื่อหมวด + mining status ล่าสุด)"""
+    rows = db.execute(
+        text(CUSTOMER_UPDATE_SQL.format(where="c.page_id = :page_id AND c.updated_at > :after_time")),
+        {"page_id": page_id, "after_time": after_time, "limit": limit}
+    ).fetchall()
+    return [_customer_update_dict(row) for row in rows]
+
+def get_customer_updates_by_ids(db: Session, customer_ids: List[int]) -> List[Dict]:
+    """ข้อมูลลูกค้าสำหรับ SSE ตาม id (ใช้กับ change feed) - มี fb_page_id สำหรับแยกส่งตามเพจ"""
+    if not customer_ids:
+        return []
+    rows = db.execute(
+        text(CUSTOMER_UPDATE_SQL.format(where="c.id = ANY(CAST(:customer_ids AS integer[]))")),
+        {"customer_ids": list(customer_ids), "limit": len(customer_ids)}
+    ).fetchall()
+    return [_customer_update_dict(row) for row in rows]
+
+# ========== Customer listing (keyset pagination) ==========
+
+# ค่าล่าสุด/จำนวนต่อลูกค้าอ่านจาก customer_view (trigger ดูแลตอนเขียน) แทนการคำนวณทุกครั้งที่อ่าน
+# เรียงตาม (last_interaction_at, id) ล่าสุดก่อน - ใช้ index fb_customers_page_last_interaction_idx
+CUSTOMER_LIST_SQL = """
+    SELECT c.id, c.page_id, c.customer_psid, c.name, c.first_interaction_at, c.last_interaction_at,
+           c.created_at, c.updated_at, c.source_type, c.current_category_id,
+           v.current_category_name, v.custom_category_id, v.custom_category_name,
+           COALESCE(v.mining_status, 'ยังไม่ขุด') AS mining_status, v.mining_status_updated_at,
+           COALESCE(v.classifications_count, 0) AS classifications_count,
+           COALESCE(v.custom_classifications_count, 0) AS custom_classifications_count
+    FROM fb_customers c
+    LEFT JOIN customer_view v ON v.customer_id = c.id
+    WHERE {where}
+    ORDER BY c.last_interaction_at DESC, c.id DESC
+    LIMIT :limit
+"""
+
+def list_customers_page(
+    db: Session,
+    page: Any,
+    limit: Optional[int] = 100,
+    after: Optional[tuple] = None,
+    category_id: Optional[int] = None,
+    custom_category_id: Optional[int] = None,
+    mining_status: Optional[str] = None,
+    source_type: Optional[str] = None,
+    inactive_min_days: Optional[int] = None,
+    inactive_max_days: Optional[int] = None,
+    name_prefix: Optional[str] = None,
+) -> List[Dict]:
+    """ลูกค้าของเพจทีละหน้า (keyset) พร้อม filter ฝั่ง server
+
+    page: row ของ facebook_pages (ต้องมี ID, created_at) / limit=None = ทั้งหมด / after: (last_interaction_at, id) ของรายการสุดท้ายหน้าก่อน
+    เงื่อนไขการแสดงผลเหมือน /fb-customers/by-page (imported แสดงเฉพาะที่คุยหลังติดตั้ง)
+    """
+    where = [
+        "c.page_id = :page_id",
+        "c.first_interaction_at IS NOT NULL",
+        "c.last_interaction_at IS NOT NULL",
+        "(c.source_type = 'new' OR (c.source_type = 'imported' AND c.last_interaction_at > :installed_at))",
+    ]
+    params: Dict[str, Any] = {"page_id": page.ID, "installed_at": page.created_at, "limit": limit}
+
+    if after:
+        where.append("(c.last_interaction_at, c.id) < (:after_time, :after_id)")
+        params.update(after_time=after[0], after_id=after[1])
+    if category_id is not None:
+        where.append("c.current_category_id = :category_id")
+        params["category_id"] = category_id
+    if custom_category_id is not None:
+        where.append("v.custom_category_id = :custom_category_id")
+        params["custom_category_id"] = custom_category_id
+    if mining_status:
+        where.append("COALESCE(v.mining_status, 'ยังไม่ขุด') = :mining_status")
+        params["mining_status"] = mining_status
+    if source_type:
+        where.append("c.source_type = :source_type")
+        params["source_type"] = source_type
+    if inactive_min_days is not None:
+        where.append("c.last_interaction_at <= now() - make_interval(days => :inactive_min_days)")
+        params["inactive_min_days"] = inactive_min_days
+    if inactive_max_days is not None:
+        where.append("c.last_interaction_at >= now() - make_interval(days => :inactive_max_days)")
+        params["inactive_max_days"] = inactive_max_days
+    if name_prefix:
+        # ตรงกับ index fb_customers_page_name_prefix_idx (lower(name) text_pattern_ops)
+        where.append("lower(c.name) LIKE :name_prefix")
+        params["name_prefix"] = name_prefix.lower().replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+    rows = db.execute(text(CUSTOMER_LIST_SQL.format(where=" AND ".join(where))), params).fetchall()
+    return [
+        {
+            "id": row.id,
+            "page_id": row.page_id,
+            "customer_psid": row.customer_psid,
+            "name": row.name,
+            "first_interaction_at": row.first_interaction_at.isoformat() if row.first_interaction_at else None,
+            "last_interaction_at": row.last_interaction_at.isoformat() if row.last_interaction_at else None,
+            "created_at": row.created_at.isoformat() if row.created_at else None,
+            "updated_at": row.updated_at.isoformat() if row.updated_at else None,
+            "source_type": row.source_type,
+            "current_category_id": row.current_category_id,
+            "current_category_name": row.current_category_name,
+            "custom_category_id": row.custom_category_id,
+            "custom_category_name": row.custom_category_name,
+            "classifications_count": row.classifications_count,
+            "custom_classifications_count": row.custom_classifications_count,
+            "mining_status": row.mining_status,
+            "mining_status_updated_at": row.mining_status_updated_at.isoformat() if row.mining_status_updated_at else None,
+        }
+        for row in rows
+    ]
+
 # ========== RetargetTierConfig CRUD Operations ==========
 
 def get_retarget_tiers_by_page(db: Session, page_id: int):
@@ -746,4 +982,11 @@ def get_page_db_id(db: Session, page_identifier):
             models.FacebookPage.page_id == page_identifier
         ).first()
         return page.ID if page else None
-    return None
\ No newline at end of file
+    return None
+
+# ==================== Message media loaders ====================
+# image_data เป็น deferred column - ใช้เฉพาะ path ที่ต้องใช้ bytes จริง (endpoint รูปเดิมของ custom message)
+def get_custom_message_with_media(db: Session, message_id: int) -> Optional[models.FBCustomMessage]:
+    return db.query(models.FBCustomMessage).options(
+        undefer(models.FBCustomMessage.image_data)
+    ).filter(models.FBCustomMessage.id == message_id).first()
@@ -1,26 +1,207 @@
 # backend/app/database/database.py
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, scoped_session
-from sqlalchemy.pool import StaticPool
+from sqlalchemy.orm import Session, sessionmaker, scoped_session
+from sqlalchemy.pool import NullPool, StaticPool
+import logging
 import os
+import threading
+import time
+import uuid
 from dotenv import load_dotenv
 
+from app.database.pool_metrics import MeteredAsyncQueuePool, MeteredQueuePool, track_hold_time
+
 
 load_dotenv()
 
 DATABASE_URL = os.getenv("DATABASE_URL")
+# connection ตรงไป Postgres (ไม่ผ่าน PgBouncer) สำหรับ LISTEN/NOTIFY ที่ต้องใช้ session เดิมตลอด
+DATABASE_DIRECT_URL = os.getenv("DATABASE_DIRECT_URL") or DATABASE_URL
+# read replica (ไม่ตั้ง = อ่านจาก primary ทั้งหมด)
+DATABASE_REPLICA_URL = os.getenv("DATABASE_REPLICA_URL")
+# replica ช้ากว่า primary เกินนี้ (วินาที) -> กลับไปอ่านจาก primary
+REPLICA_MAX_LAG_SECONDS = float(os.getenv("REPLICA_MAX_LAG_SECONDS", 5))
+REPLICA_CHECK_INTERVAL = float(os.getenv("REPLICA_CHECK_INTERVAL", 5))
+
+logger = logging.getLogger(__name__)
+
+# บทบาทของโปรเซส (api / worker / broadcast / ...) - ใช้เลือกขนาด pool
+# Celery prefork มี pool แยกต่อ child process จึงควรเล็กกว่า API มาก
+PROCESS_ROLE = os.getenv("PROCESS_ROLE", "api").lower()
+# broadcast engine เรียก send ledger (1 session ต่อครั้ง) พร้อมกันได้ถึงค่านี้ต่อเพจ - pool ของ role broadcast ต้องไม่เล็กกว่า
+BROADCAST_MAX_CONCURRENCY = int(os.getenv("BROADCAST_MAX_CONCURRENCY", 8))
+
+ROLE_POOL_DEFAULTS = {
+    "api": {"POOL_SIZE": 10, "MAX_OVERFLOW": 10, "POOL_TIMEOUT": 10},
+    "worker": {"POOL_SIZE": 2, "MAX_OVERFLOW": 3, "POOL_TIMEOUT": 30},
+    "broadcast": {"POOL_SIZE": BROADCAST_MAX_CONCURRENCY, "MAX_OVERFLOW": 2, "POOL_TIMEOUT": 30},
+}
+
+# โหมด PgBouncer (transaction pooling): ไม่ถือ pool ในโปรเซส และไม่ใช้ prepared statement ฝั่ง server
+DB_PGBOUNCER = os.getenv("DB_PGBOUNCER", "false").lower() == "true"
+DB_ECHO_POOL = os.getenv("DB_ECHO_POOL", "false").lower() == "true"
+
+
+def pool_setting(name: str) -> int:
+    """DB_{name}_{ROLE} > DB_{name} > ค่า default ของ role"""
+    defaults = ROLE_POOL_DEFAULTS.get(PROCESS_ROLE, ROLE_POOL_DEFAULTS["worker"])
+    value = os.getenv(f"DB_{name}_{PROCESS_ROLE.upper()}") or os.getenv(f"DB_{name}")
+    return int(value) if value else defaults[name]
+
+
+def _pool_options(poolclass) -> dict:
+    if DB_PGBOUNCER:
+        return {"poolclass": NullPool}
+    return {
+        "poolclass": poolclass,
+        "pool_size": pool_setting("POOL_SIZE"),
+        "max_overflow": pool_setting("MAX_OVERFLOW"),
+        "pool_timeout": pool_setting("POOL_TIMEOUT"),
+        "pool_pre_ping": True,   # ตรวจสอบ connection ก่อนใช้
+        "pool_recycle": 3600,    # recycle connection ทุก 1 ชั่วโมง
+    }
+
 
-# เพิ่ม pool settings
 engine = create_engine(
     DATABASE_URL,
-    pool_pre_ping=True,  # ตรวจสอบ connection ก่อนใช้
-    pool_recycle=3600,   # recycle connection ทุก 1 ชั่วโมง
-    echo_pool=True       # debug pool connections
+    echo_pool=DB_ECHO_POOL,  # debug pool connections (log ทุก checkout - เปิดเฉพาะตอน debug)
+    **_pool_options(MeteredQueuePool)
 )
+track_hold_time(engine)
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+
+def _async_url(url: str):
+    """DATABASE_URL (psycopg2) -> URL สำหรับ asyncpg (asyncpg ไม่รู้จัก sslmode จึงย้ายไปเป็น connect_args)"""
+    async_url = make_url(url).set(drivername="postgresql+asyncpg")
+    sslmode = async_url.query.get("sslmode")
+    connect_args = {"ssl": sslmode} if sslmode and sslmode != "disable" else {}
+    if DB_PGBOUNCER:
+        # PgBouncer ส่ง statement ไปคนละ server connection ได้ -> ปิด cache และตั้งชื่อ statement ไม่ซ้ำ
+        async_url = async_url.update_query_dict({"prepared_statement_cache_size": "0"})
+        connect_args.update({
+            "statement_cache_size": 0,
+            "prepared_statement_name_func": lambda: f"__asyncpg_{uuid.uuid4().hex}__",
+        })
+    return async_url.difference_update_query(["sslmode"]), connect_args
+
+
+# ✅ engine แบบ async สำหรับ route ที่เป็น async def (ไม่ block event loop ของ uvicorn)
+# Celery / scheduler / thread ยังใช้ engine + SessionLocal แบบ sync ตามเดิม
+ASYNC_DATABASE_URL, _async_connect_args = _async_url(DATABASE_URL)
+async_engine = create_async_engine(
+    ASYNC_DATABASE_URL,
+    connect_args=_async_connect_args,
+    **_pool_options(MeteredAsyncQueuePool)
+)
+track_hold_time(async_engine.sync_engine)
+
+# expire_on_commit=False: ใช้ค่าของ object หลัง commit ได้โดยไม่ต้อง query ใหม่ (lazy load ใน async ไม่ได้)
+AsyncSessionLocal = async_sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+# ==================== Read replica ====================
+# session สำหรับ dependency ที่อ่านอย่างเดียว (dashboard / poller) - ห้าม flush (ดู _guard_read_only)
+# ใช้ replica เมื่อ lag ไม่เกิน REPLICA_MAX_LAG_SECONDS ไม่เช่นนั้น (หรือไม่มี replica) ใช้ primary
+replica_engine = None
+async_replica_engine = None
+if DATABASE_REPLICA_URL:
+    replica_engine = create_engine(DATABASE_REPLICA_URL, echo_pool=DB_ECHO_POOL, **_pool_options(MeteredQueuePool))
+    track_hold_time(replica_engine)
+    _replica_async_url, _replica_connect_args = _async_url(DATABASE_REPLICA_URL)
+    async_replica_engine = create_async_engine(
+        _replica_async_url,
+        connect_args=_replica_connect_args,
+        **_pool_options(MeteredAsyncQueuePool)
+    )
+    track_hold_time(async_replica_engine.sync_engine)
+
+_READ_ONLY = {"read_only": True}
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=replica_engine or engine, info=_READ_ONLY)
+PrimaryReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine, info=_READ_ONLY)
+AsyncReadSessionLocal = async_sessionmaker(
+    async_replica_engine or async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False, info=_READ_ONLY
+)
+AsyncPrimaryReadSessionLocal = async_sessionmaker(
+    async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False, info=_READ_ONLY
+)
+
+
+@event.listens_for(Session, "before_flush")
+def _guard_read_only(session, flush_context, instances):
+    if session.info.get("read_only"):
+        raise RuntimeError("Read-only session (replica) cannot write - use get_db / SessionLocal")
+
+
+# lag เป็น 0 เมื่อ replay ทัน WAL ที่รับมาแล้ว (primary ว่างนานๆ replay timestamp จะเก่าแต่ไม่ได้ล้าหลัง)
+REPLICA_LAG_SQL = text("""
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+""")
+
+
+class ReplicaHealth:
+    """ผลตรวจ lag ของ replica ล่าสุด (cache REPLICA_CHECK_INTERVAL วินาที ต่อโปรเซส)"""
+
+    def __init__(self):
+        self.lag = None
+        self.checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def due(self) -> bool:
+        return time.monotonic() - self.checked_at >= REPLICA_CHECK_INTERVAL
+
+    def usable(self) -> bool:
+        return self.lag is not None and self.lag <= REPLICA_MAX_LAG_SECONDS
+
+    def update(self, lag):
+        was_usable = self.usable()
+        with self._lock:
+            self.lag = lag
+            self.checked_at = time.monotonic()
+        if was_usable and not self.usable():
+            logger.warning(f"⚠️ Read replica unavailable (lag={lag}), reading from primary")
+        elif not was_usable and self.usable():
+            logger.info(f"✅ Read replica back (lag={lag:.2f}s)")
+
+    def check(self) -> bool:
+        if replica_engine is None:
+            return False
+        if self.due():
+            try:
+                with replica_engine.connect() as conn:
+                    self.update(float(conn.execute(REPLICA_LAG_SQL).scalar()))
+            except Exception as e:
+                logger.error(f"❌ Read replica check failed: {e}")
+                self.update(None)
+        return self.usable()
+
+    async def async_check(self) -> bool:
+        if async_replica_engine is None:
+            return False
+        if self.due():
+            try:
+                async with async_replica_engine.connect() as conn:
+                    self.update(float((await conn.execute(REPLICA_LAG_SQL)).scalar()))
+            except Exception as e:
+                logger.error(f"❌ Read replica check failed: {e}")
+                self.update(None)
+        return self.usable()
+
+
+replica_health = ReplicaHealth()
+
+
+def open_read_session() -> Session:
+    """session อ่านอย่างเดียว (replica ถ้าใช้ได้) สำหรับโค้ดนอก request เช่น poller - ต้อง close เอง"""
+    return ReadSessionLocal() if replica_health.check() else PrimaryReadSessionLocal()
+
 Base = declarative_base()
 
 def get_db():
@@ -31,4 +212,26 @@ def get_db():
         db.rollback()
         raise
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        try:
+            yield db
+        except Exception:
+            await db.rollback()
+            raise
+
+def get_read_db():
+    """dependency สำหรับ endpoint ที่อ่านอย่างเดียว (replica + fallback primary)"""
+    db = open_read_session()
+    try:
+        yield db
+    finally:
+        db.close()
+
+async def get_async_read_db():
+    """get_read_db แบบ AsyncSession"""
+    factory = AsyncReadSessionLocal if await replica_health.async_check() else AsyncPrimaryReadSessionLocal
+    async with factory() as db:
+        yield db
@@ -1,6 +1,7 @@
-from sqlalchemy import (Column, String, Integer, TIMESTAMP, ForeignKey, DateTime, 
-                        func, Text, Boolean, Interval, JSON, CheckConstraint, ARRAY, BigInteger, LargeBinary)
-from sqlalchemy.orm import relationship
+from sqlalchemy import (Column, String, Integer, TIMESTAMP, ForeignKey, DateTime, Date, 
+                        func, Text, Boolean, Interval, JSON, CheckConstraint, ARRAY, BigInteger, LargeBinary,
+                        UniqueConstraint)
+from sqlalchemy.orm import relationship, deferred, column_property
 from app.database.database import Base
 
 class FacebookPage(Base):
@@ -132,7 +133,12 @@ class CustomerTypeMessage(Base):
     display_order = Column(Integer, nullable=False)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
-    image_data = Column(LargeBinary)
+    # legacy - สื่อใหม่เก็บใน blob store; deferred ไม่ให้ query ทั่วไปดึง bytea (ใช้ undefer เมื่อต้องการ)
+    image_data = deferred(Column(LargeBinary))
+    has_legacy_media = column_property(image_data.columns[0].isnot(None))
+    media_digest = Column(String(64))
+    media_size = Column(BigInteger)
+    media_mime = Column(String(100))
 
     page = relationship("FacebookPage", back_populates="customer_type_messages")
     customer_type_custom = relationship("CustomerTypeCustom", back_populates="customer_type_messages")
@@ -185,7 +191,12 @@ class FBCustomMessage(Base):
     content = Column(Text, nullable=False)
     display_order = Column(Integer, nullable=False)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
-    image_data = Column(LargeBinary)
+    # legacy - สื่อใหม่เก็บใน blob store; deferred ไม่ให้ query ทั่วไปดึง bytea (ใช้ undefer เมื่อต้องการ)
+    image_data = deferred(Column(LargeBinary))
+    has_legacy_media = column_property(image_data.columns[0].isnot(None))
+    media_digest = Column(String(64))
+    media_size = Column(BigInteger)
+    media_mime = Column(String(100))
 
     message_set = relationship("MessageSets", back_populates="messages", foreign_keys=[message_set_id])
     page = relationship("FacebookPage", back_populates="fb_custom_messages", foreign_keys=[page_id])
@@ -245,6 +256,38 @@ class FBCustomerMiningStatus(Base):
 
     customer = relationship("FbCustomer", back_populates="mining_statuses", foreign_keys=[customer_id])
 
+class CustomerView(Base):
+    """ข้อมูลลูกค้าสำหรับหน้ารายชื่อ/SSE แบบ denormalized (1 row ต่อลูกค้า)
+
+    ดูแลโดย trigger ใน transaction เดียวกับการเขียน (refresh_customer_view ใน database/migrations.py) - อย่าเขียนตรง
+    """
+    __tablename__ = "customer_view"
+
+    customer_id = Column(Integer, ForeignKey("fb_customers.id", ondelete="CASCADE"), primary_key=True)
+    current_category_name = Column(String(100))
+    custom_category_id = Column(Integer)
+    custom_category_name = Column(String(100))
+    mining_status = Column(String)
+    mining_status_updated_at = Column(DateTime(timezone=True))
+    classifications_count = Column(Integer, nullable=False, default=0)
+    custom_classifications_count = Column(Integer, nullable=False, default=0)
+    refreshed_at = Column(DateTime(timezone=True), server_default=func.now())
+
+class CustomerDailyStats(Base):
+    """สถิติลูกค้ารายวันต่อเพจ (วันตามเวลาไทย) - trigger บน fb_customers บวก/ลบทีละ row (database/migrations.py)
+
+    - new_customers: ลูกค้าที่สร้างในวันนั้น (SUM ทุกวัน = ลูกค้าทั้งหมด)
+    - last_active_customers: ลูกค้าที่คุยล่าสุดในวันนั้น (ย้ายวันเมื่อ last_interaction_at เปลี่ยน)
+    - active_customers: ลูกค้าที่คุยในวันนั้น (สำหรับกราฟรายวัน ไม่ลดลง)
+    """
+    __tablename__ = "customer_daily_stats"
+
+    page_id = Column(Integer, ForeignKey("facebook_pages.ID", ondelete="CASCADE"), primary_key=True)
+    day = Column(Date, primary_key=True)
+    new_customers = Column(Integer, nullable=False, default=0)
+    last_active_customers = Column(Integer, nullable=False, default=0)
+    active_customers = Column(Integer, nullable=False, default=0)
+
 class RetargetTiersConfig(Base):
     __tablename__ = "retarget_tiers_config"
 
@@ -279,5 +322,54 @@ class CustomerMessage(Base):
     message_text = Column(Text, nullable=False)
     message_type = Column(Text, nullable=False)
     created_at = Column(TIMESTAMP(timezone=True), server_default=func.now())
+    # message id ของ Facebook (m_...) - ใช้กันข้อความซ้ำระหว่าง webhook กับ polling sync
+    mid = Column(Text, nullable=True, unique=True)
+
+    customer = relationship("FbCustomer", back_populates="customermessage", foreign_keys=[customer_id])
+class BroadcastCampaign(Base):
+    __tablename__ = "broadcast_campaigns"
+
+    id = Column(String(32), primary_key=True)
+    page_id = Column(String, nullable=False, index=True)
+    schedule_id = Column(String, nullable=True, index=True)
+    group_type = Column(String(50), nullable=True)
+    status = Column(String(20), nullable=False, default="queued")
+    total_recipients = Column(Integer, nullable=False, default=0)
+    total_chunks = Column(Integer, nullable=False, default=0)
+    completed_chunks = Column(Integer, nullable=False, default=0)
+    sent = Column(Integer, nullable=False, default=0)
+    failed = Column(Integer, nullable=False, default=0)
+    error = Column(Text, nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+    finished_at = Column(DateTime(timezone=True), nullable=True)
+
+    __table_args__ = (
+        CheckConstraint(
+            "status IN ('queued', 'running', 'completed', 'cancelled', 'failed')",
+            name="chk_broadcast_campaign_status"
+        ),
+    )
+
+class MessageSendLedger(Base):
+    __tablename__ = "message_send_ledger"
 
-    customer = relationship("FbCustomer", back_populates="customermessage", foreign_keys=[customer_id])
\ No newline at end of file
+    id = Column(BigInteger, primary_key=True)
+    campaign_key = Column(String(100), nullable=False)
+    message_key = Column(String(64), nullable=False)
+    psid = Column(String, nullable=False)
+    page_id = Column(String, nullable=True)
+    status = Column(String(20), nullable=False, default="pending")
+    graph_message_id = Column(String, nullable=True)
+    attempts = Column(Integer, nullable=False, default=1)
+    error = Column(Text, nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+    __table_args__ = (
+        UniqueConstraint("campaign_key", "message_key", "psid", name="uq_send_ledger_key"),
+        CheckConstraint(
+            "status IN ('pending', 'sent', 'failed', 'unknown')",
+            name="chk_send_ledger_status"
+        ),
+    )
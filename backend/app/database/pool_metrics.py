@@ -0,0 +1,131 @@
+"""
+Pool Metrics
+วัดการใช้ connection pool ของ SQLAlchemy ในโปรเซสนี้
+- checkout wait: เวลาที่รอ connection จาก pool (pool เต็ม = รอนาน / timeout)
+- hold time: เวลาที่ถือ connection ไว้ตั้งแต่ checkout จนคืน pool
+- saturation: connection ที่ถูกใช้อยู่ / ขนาดสูงสุด (pool_size + max_overflow)
+ค่าเป็นของโปรเซสเดียว (แต่ละ uvicorn worker / Celery child มี pool ของตัวเอง)
+"""
+
+import logging
+import os
+import threading
+import time
+from typing import Dict
+
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+logger = logging.getLogger(__name__)
+
+# รอ connection นานกว่านี้ = pool ใกล้เต็ม -> log เตือน
+DB_POOL_WAIT_WARN_MS = int(os.getenv("DB_POOL_WAIT_WARN_MS", 500))
+
+
+class PoolStats:
+    """สถิติแบบสะสม + ค่าสูงสุด (thread-safe)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.held = 0
+        self.hold_total = 0.0
+        self.hold_max = 0.0
+
+    def record_wait(self, seconds: float, timed_out: bool = False):
+        with self._lock:
+            if timed_out:
+                self.timeouts += 1
+                return
+            self.checkouts += 1
+            self.wait_total += seconds
+            self.wait_max = max(self.wait_max, seconds)
+
+    def record_hold(self, seconds: float):
+        with self._lock:
+            self.held += 1
+            self.hold_total += seconds
+            self.hold_max = max(self.hold_max, seconds)
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "wait_avg_ms": round(self.wait_total / self.checkouts * 1000, 2) if self.checkouts else 0.0,
+                "wait_max_ms": round(self.wait_max * 1000, 2),
+                "hold_avg_ms": round(self.hold_total / self.held * 1000, 2) if self.held else 0.0,
+                "hold_max_ms": round(self.hold_max * 1000, 2),
+            }
+
+
+class _MeteredPoolMixin:
+    """จับเวลาที่รอ connection ใน _do_get (จุดที่ QueuePool block เมื่อ pool เต็ม)"""
+
+    stats: PoolStats
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except PoolTimeoutError:
+            self.stats.record_wait(time.perf_counter() - start, timed_out=True)
+            logger.error(f"❌ DB pool exhausted: {self.status()}")
+            raise
+        waited = time.perf_counter() - start
+        self.stats.record_wait(waited)
+        if waited * 1000 >= DB_POOL_WAIT_WARN_MS:
+            logger.warning(f"⚠️ Waited {waited * 1000:.0f}ms for DB connection: {self.status()}")
+        return connection
+
+
+class MeteredQueuePool(_MeteredPoolMixin, QueuePool):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = PoolStats()
+
+
+class MeteredAsyncQueuePool(_MeteredPoolMixin, AsyncAdaptedQueuePool):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = PoolStats()
+
+
+def track_hold_time(engine):
+    """ผูก event checkout/checkin ของ pool เพื่อวัดเวลาที่ถือ connection"""
+    pool = engine.pool
+    if not hasattr(pool, "stats"):
+        return
+
+    @event.listens_for(pool, "checkout")
+    def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+        connection_record.info["checked_out_at"] = time.perf_counter()
+
+    @event.listens_for(pool, "checkin")
+    def _on_checkin(dbapi_connection, connection_record):
+        started = connection_record.info.pop("checked_out_at", None)
+        if started is not None:
+            pool.stats.record_hold(time.perf_counter() - started)
+
+
+def pool_metrics(engine) -> Dict:
+    pool = engine.pool
+    metrics = {"pool_class": type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        capacity = pool.size() + pool._max_overflow
+        in_use = pool.checkedout()
+        metrics.update({
+            "size": pool.size(),
+            "max_overflow": pool._max_overflow,
+            "checked_out": in_use,
+            "idle": pool.checkedin(),
+            "overflow": pool.overflow(),
+            "saturation": round(in_use / capacity, 4) if capacity > 0 else 0.0,
+        })
+    if hasattr(pool, "stats"):
+        metrics.update(pool.stats.snapshot())
+    return metrics
@@ -1,9 +1,15 @@
-from fastapi import APIRouter, Depends, HTTPException, Response
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
+from sqlalchemy import select
 from sqlalchemy.orm import Session
 from app.database.database import get_db
 from pydantic import BaseModel, Field
 from typing import List, Optional
 from app.database.models import FBCustomMessage, MessageSets
+from app.database import crud
+from app.service.attachment_cache import invalidate_digest
+from app.utils.blob_store import (store_media, media_fields_from_input, media_url, has_blob,
+                                  row_has_media, row_media_digest, load_row_media)
+from app.routes.media import media_response
 import base64
 import logging
 
@@ -58,16 +64,20 @@ def format_message_response(msg: FBCustomMessage, include_image: bool = False) -
         "message_type": msg.message_type,
         "content": msg.content,
         "display_order": msg.display_order,
-        "has_image": bool(msg.image_data),
+        "has_image": row_has_media(msg),
         "created_at": msg.created_at.isoformat() if msg.created_at else None
     }
     
-    if include_image and msg.image_data:
+    # สื่อใน blob store ส่งเป็น URL (image_base64 ใช้เป็น src ได้เหมือนเดิม)
+    response["media_url"] = media_url(msg.media_digest) if msg.media_digest else None
+    media = load_row_media(msg) if include_image and not msg.media_digest else None
+    if response["media_url"]:
+        response["image_base64"] = response["media_url"]
+    elif media:
         try:
-            image_base64 = base64.b64encode(msg.image_data).decode('utf-8')
-            media_type = "image" if msg.message_type == 'image' else "video"
-            media_subtype = "jpeg" if msg.message_type == 'image' else "mp4"
-            response["image_base64"] = f"data:{media_type}/{media_subtype};base64,{image_base64}"
+            image_base64 = base64.b64encode(media).decode('utf-8')
+            mime = msg.media_mime or ("image/jpeg" if msg.message_type == 'image' else "video/mp4")
+            response["image_base64"] = f"data:{mime};base64,{image_base64}"
         except Exception as e:
             logger.error(f"Error encoding image: {e}")
             response["image_base64"] = None
@@ -76,9 +86,17 @@ def format_message_response(msg: FBCustomMessage, include_image: bool = False) -
     
     return response
 
+def custom_messages_query(message_set_id: int):
+    """ข้อความใน message set (image_data เป็น deferred - ไม่ถูกดึงมากับรายการ)"""
+    return (
+        select(FBCustomMessage)
+        .where(FBCustomMessage.message_set_id == message_set_id)
+        .order_by(FBCustomMessage.display_order)
+    )
+
 def create_message_record(data: MessageCreate, db: Session) -> FBCustomMessage:
     """Create a new message record"""
-    image_binary = process_image_data(data.image_data_base64, data.message_type)
+    media_fields = media_fields_from_input(data.image_data_base64, data.message_type, process_image_data)
     
     msg = FBCustomMessage(
         message_set_id=data.message_set_id,
@@ -86,7 +104,7 @@ def create_message_record(data: MessageCreate, db: Session) -> FBCustomMessage:
         message_type=data.message_type,
         content=data.content,
         display_order=data.display_order,
-        image_data=image_binary
+        **(media_fields or store_media(None, data.message_type))
     )
     db.add(msg)
     return msg
@@ -160,25 +178,27 @@ def create_batch_custom_messages(data: MessageBatchCreate, db: Session = Depends
 @router.get("/custom_messages/{message_set_id}")
 def get_custom_messages(message_set_id: int, db: Session = Depends(get_db)):
     """Get all messages in a message set"""
-    messages = (db.query(FBCustomMessage)
-                .filter(FBCustomMessage.message_set_id == message_set_id)
-                .order_by(FBCustomMessage.display_order)
-                .all())
-    
+    messages = db.execute(custom_messages_query(message_set_id)).scalars().all()
     return [format_message_response(msg, include_image=True) for msg in messages]
 
-@router.get("/custom_message/{message_id}/image")
-def get_message_image(message_id: int, db: Session = Depends(get_db)):
-    """Get message image as binary"""
+@router.api_route("/custom_message/{message_id}/image", methods=["GET", "HEAD"])
+def get_message_image(message_id: int, request: Request, db: Session = Depends(get_db)):
+    """Get message image as binary (stream + Range/ETag เมื่ออยู่ใน blob store)"""
     msg = db.query(FBCustomMessage).filter(FBCustomMessage.id == message_id).first()
     if not msg:
         raise HTTPException(status_code=404, detail="Message not found")
     
-    if not msg.image_data:
+    if has_blob(msg.media_digest):
+        return media_response(request, msg.media_digest, msg.media_mime)
+    
+    # row เก่าที่ยังไม่ย้ายไป blob store
+    msg = crud.get_custom_message_with_media(db, message_id)
+    media = load_row_media(msg)
+    if not media:
         raise HTTPException(status_code=404, detail="No image found for this message")
     
-    media_type = "image/jpeg" if msg.message_type == 'image' else "video/mp4"
-    return Response(content=msg.image_data, media_type=media_type)
+    media_type = msg.media_mime or ("image/jpeg" if msg.message_type == 'image' else "video/mp4")
+    return Response(content=media, media_type=media_type)
 
 @router.put("/custom_message/{message_id}")
 def update_custom_message(message_id: int, data: MessageCreate, db: Session = Depends(get_db)):
@@ -193,12 +213,19 @@ def update_custom_message(message_id: int, data: MessageCreate, db: Session = De
     msg.display_order = data.display_order
     
     # Update image if provided
+    old_digest = row_media_digest(msg)
+    media_fields = None
     if data.image_data_base64:
-        msg.image_data = process_image_data(data.image_data_base64, data.message_type)
+        media_fields = media_fields_from_input(data.image_data_base64, data.message_type, process_image_data)
     elif data.message_type == 'text':
-        msg.image_data = None
+        media_fields = store_media(None, data.message_type)
+    if media_fields is not None:
+        for key, value in media_fields.items():
+            setattr(msg, key, value)
     
     db.commit()
+    if old_digest and old_digest != msg.media_digest:
+        invalidate_digest(old_digest)
     db.refresh(msg)
     return format_message_response(msg)
 
@@ -209,6 +236,8 @@ def delete_custom_message(id: int, db: Session = Depends(get_db)):
     if not msg:
         raise HTTPException(status_code=404, detail="Message not found")
     
+    old_digest = row_media_digest(msg)
     db.delete(msg)
     db.commit()
+    invalidate_digest(old_digest)
     return {"status": "deleted"}
\ No newline at end of file
@@ -11,12 +11,13 @@ Facebook Customers Component
 from fastapi import APIRouter, Depends, Query
 from fastapi.responses import JSONResponse
 from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from datetime import datetime, timedelta
 from typing import Optional
 import pytz
 
-from app.database import crud
-from app.database.database import get_db
+from app.database import crud, async_crud
+from app.database.database import get_db, get_async_db, get_async_read_db
 from app.service.facebook_api import fb_get
 from .auth import get_page_tokens
 from .conversations import get_user_info_from_psid, get_name_from_messages
@@ -33,10 +34,10 @@ async def get_customers(
     skip: int = 0, 
     limit: int = 100,
     search: str = None,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """ดึงรายชื่อลูกค้าทั้งหมดของเพจจาก database"""
-    page = crud.get_page_by_page_id(db, page_id)
+    page = await async_crud.get_page_by_page_id(db, page_id)
     if not page:
         return JSONResponse(
             status_code=400, 
@@ -44,20 +45,20 @@ async def get_customers(
         )
     
     if search:
-        customers = crud.search_customers(db, page.ID, search)
+        customers = await async_crud.search_customers(db, page.ID, search)
     else:
-        customers = crud.get_customers_by_page(db, page.ID, skip, limit)
+        customers = await async_crud.get_customers_by_page(db, page.ID, skip, limit)
     
     # แปลง format
     result = []
-    for customer in customers:
+    for customer, customer_type in customers:
         result.append({
             "id": customer.id,
             "psid": customer.customer_psid,
             "name": customer.name or f"User...{customer.customer_psid[-8:]}",
             "first_interaction": customer.first_interaction_at.isoformat() if customer.first_interaction_at else None,
             "last_interaction": customer.last_interaction_at.isoformat() if customer.last_interaction_at else None,
-            "customer_type": customer.customer_type_custom.type_name if customer.customer_type_custom else None
+            "customer_type": customer_type
         })
     
     return {
@@ -71,22 +72,23 @@ async def get_customers(
 async def get_customer_detail(
     page_id: str, 
     psid: str,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """ดึงข้อมูลลูกค้ารายคน"""
-    page = crud.get_page_by_page_id(db, page_id)
+    page = await async_crud.get_page_by_page_id(db, page_id)
     if not page:
         return JSONResponse(
             status_code=400, 
             content={"error": f"ไม่พบเพจ {page_id} ในระบบ"}
         )
     
-    customer = crud.get_customer_by_psid(db, page.ID, psid)
-    if not customer:
+    row = await async_crud.get_customer_by_psid(db, page.ID, psid)
+    if not row:
         return JSONResponse(
             status_code=404, 
             content={"error": "ไม่พบข้อมูลลูกค้า"}
         )
+    customer, customer_type_custom = row
     
     return {
         "id": customer.id,
@@ -94,8 +96,8 @@ async def get_customer_detail(
         "name": customer.name,
         "first_interaction": customer.first_interaction_at.isoformat() if customer.first_interaction_at else None,
         "last_interaction": customer.last_interaction_at.isoformat() if customer.last_interaction_at else None,
-        "customer_type_custom": customer.customer_type_custom.type_name if customer.customer_type_custom else None,
-        "customer_type_knowledge": customer.customer_type_knowledge.type_name if customer.customer_type_knowledge else None,
+        "customer_type_custom": customer_type_custom,
+        "customer_type_knowledge": customer.current_category.type_name if customer.current_category else None,
         "created_at": customer.created_at.isoformat(),
         "updated_at": customer.updated_at.isoformat()
     }
@@ -106,34 +108,32 @@ async def update_customer(
     page_id: str, 
     psid: str,
     customer_data: dict,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """อัพเดทข้อมูลลูกค้า"""
-    page = crud.get_page_by_page_id(db, page_id)
+    page = await async_crud.get_page_by_page_id(db, page_id)
     if not page:
         return JSONResponse(
             status_code=400, 
             content={"error": f"ไม่พบเพจ {page_id} ในระบบ"}
         )
     
-    customer = crud.get_customer_by_psid(db, page.ID, psid)
-    if not customer:
+    row = await async_crud.get_customer_by_psid(db, page.ID, psid)
+    if not row:
         return JSONResponse(
             status_code=404, 
             content={"error": "ไม่พบข้อมูลลูกค้า"}
         )
+    customer = row[0]
     
-    # อัพเดทข้อมูล
+    # อัพเดทข้อมูล (Knowledge Group เก็บใน current_category_id / User Group ผ่าน classification)
     if "name" in customer_data:
         customer.name = customer_data["name"]
-    if "customer_type_custom_id" in customer_data:
-        customer.customer_type_custom_id = customer_data["customer_type_custom_id"]
     if "customer_type_knowledge_id" in customer_data:
-        customer.customer_type_knowledge_id = customer_data["customer_type_knowledge_id"]
+        customer.current_category_id = customer_data["customer_type_knowledge_id"]
     
     customer.updated_at = datetime.now()
-    db.commit()
-    db.refresh(customer)
+    await db.commit()
     
     return {"status": "success", "message": "อัพเดทข้อมูลสำเร็จ"}
 
@@ -238,22 +238,25 @@ async def sync_facebook_customers_enhanced(
 @router.get("/customer-statistics/{page_id}")
 async def get_customer_statistics(
     page_id: str,
-    db: Session = Depends(get_db)
+    days: int = Query(0, ge=0, le=365),
+    db: AsyncSession = Depends(get_async_read_db)
 ):
-    """ดึงสถิติลูกค้าของเพจ"""
-    page = crud.get_page_by_page_id(db, page_id)
+    """ดึงสถิติลูกค้าของเพจ (days > 0 = แนบกราฟรายวันย้อนหลัง days วันใน daily)"""
+    page = await async_crud.get_page_by_page_id(db, page_id)
     if not page:
         return JSONResponse(
             status_code=400, 
             content={"error": f"ไม่พบเพจ {page_id} ในระบบ"}
         )
     
-    # เปลี่ยนจาก page.id เป็น page.ID (uppercase)
-    stats = crud.get_customer_statistics(db, page.ID)  # ✅ แก้ไขตรงนี้
+    stats = await async_crud.get_customer_statistics(db, page.ID)
     
-    return {
+    response = {
         "page_id": page_id,
         "page_name": page.page_name,
         "statistics": stats,
         "generated_at": datetime.now().isoformat()
-    }
\ No newline at end of file
+    }
+    if days:
+        response["daily"] = await async_crud.get_customer_daily_stats(db, page.ID, days)
+    return response
\ No newline at end of file
@@ -10,13 +10,15 @@ Facebook Customer Groups Component
 
 from fastapi import APIRouter, Depends, HTTPException
 from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from typing import List, Optional
+from sqlalchemy import func, select
 from datetime import datetime
 from pydantic import BaseModel
 import logging
 
-from app.database import crud, models
-from app.database.database import get_db
+from app.database import crud, models, async_crud
+from app.database.database import get_db, get_async_db, get_async_read_db
 
 # ==================== Configuration ====================
 router = APIRouter()
@@ -55,7 +57,7 @@ class CustomerGroupResponse(BaseModel):
 # ==================== User Groups APIs ====================
 
 @router.post("/customer-groups")
-async def create_customer_group(
+def create_customer_group(
     group_data: CustomerGroupCreate,
     db: Session = Depends(get_db)
 ):
@@ -92,41 +94,11 @@ async def create_customer_group(
 async def get_customer_groups(
     page_id: int,
     include_inactive: bool = False,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_read_db)
 ):
     """ดึงกลุ่มลูกค้าทั้งหมดของเพจ"""
     try:
-        query = db.query(models.CustomerTypeCustom).filter(
-            models.CustomerTypeCustom.page_id == page_id
-        )
-        
-        if not include_inactive:
-            query = query.filter(models.CustomerTypeCustom.is_active == True)
-        
-        groups = query.order_by(models.CustomerTypeCustom.created_at.desc()).all()
-        
-        result = []
-        for group in groups:
-            # นับจำนวนลูกค้าโดยใช้ query แทนการเข้าถึง relationship โดยตรง
-            customer_count = db.query(models.FbCustomer).filter(
-                models.FbCustomer.page_id == page_id,
-                models.FbCustomer.current_category_id == group.id  # ใช้ current_category_id
-            ).count()
-            
-            result.append({
-                "id": group.id,
-                "page_id": group.page_id,
-                "type_name": group.type_name,
-                "keywords": group.keywords or [],
-                "examples": group.examples or [],
-                "rule_description": group.rule_description,
-                "is_active": group.is_active,
-                "created_at": group.created_at,
-                "updated_at": group.updated_at,
-                "customer_count": customer_count  # ใช้ค่าที่นับมา
-            })
-        
-        return result
+        return await async_crud.get_customer_groups(db, page_id, include_inactive)
     except Exception as e:
         logger.error(f"Error fetching customer groups: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -134,16 +106,20 @@ async def get_customer_groups(
 @router.get("/customer-group/{group_id}")
 async def get_customer_group(
     group_id: int,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """ดึงข้อมูลกลุ่มลูกค้าตาม ID"""
-    group = db.query(models.CustomerTypeCustom).filter(
-        models.CustomerTypeCustom.id == group_id
-    ).first()
+    group = await db.get(models.CustomerTypeCustom, group_id)
     
     if not group:
         raise HTTPException(status_code=404, detail="Group not found")
     
+    customer_count = (await db.execute(
+        select(func.count(models.FBCustomerCustomClassification.customer_id.distinct())).where(
+            models.FBCustomerCustomClassification.new_category_id == group_id
+        )
+    )).scalar() or 0
+    
     return {
         "id": group.id,
         "page_id": group.page_id,
@@ -154,11 +130,11 @@ async def get_customer_group(
         "is_active": group.is_active,
         "created_at": group.created_at,
         "updated_at": group.updated_at,
-        "customer_count": len(group.customers)
+        "customer_count": customer_count
     }
 
 @router.put("/customer-groups/{group_id}")
-async def update_customer_group(
+def update_customer_group(
     group_id: int,
     group_update: CustomerGroupUpdate,
     db: Session = Depends(get_db)
@@ -200,7 +176,7 @@ async def update_customer_group(
         raise HTTPException(status_code=400, detail=str(e))
 
 @router.delete("/customer-groups/{group_id}")
-async def delete_customer_group(
+def delete_customer_group(
     group_id: int,
     hard_delete: bool = False,
     db: Session = Depends(get_db)
@@ -235,7 +211,7 @@ async def delete_customer_group(
 # ==================== Auto-Grouping API ====================
 
 @router.post("/auto-group-customer")
-async def auto_group_customer(
+def auto_group_customer(
     page_id: str,
     customer_psid: str,
     message_text: str,
@@ -291,11 +267,11 @@ async def auto_group_customer(
 
 @router.get("/customer-type-knowledge")
 async def get_all_customer_type_knowledge(
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """ดึงข้อมูล customer type knowledge ทั้งหมด"""
     try:
-        knowledge_types = db.query(models.CustomerTypeKnowledge).all()
+        knowledge_types = await async_crud.get_all_customer_type_knowledge(db)
         
         result = []
         for kt in knowledge_types:
@@ -321,31 +297,23 @@ async def get_all_customer_type_knowledge(
 @router.get("/page-customer-type-knowledge/{page_id}")
 async def get_page_customer_type_knowledge(
     page_id: str,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """ดึง knowledge types ที่เชื่อมกับ page นี้"""
     try:
         # หา page จาก Facebook page ID
-        page = crud.get_page_by_page_id(db, page_id)
+        page = await async_crud.get_page_by_page_id(db, page_id)
         if not page:
             logger.warning(f"Page not found for page_id: {page_id}")
             return []
         
         page_db_id = page.ID
         
-        # ดึง records จากตาราง page_customer_type_knowledge
-        page_knowledge_records = db.query(models.PageCustomerTypeKnowledge).filter(
-            models.PageCustomerTypeKnowledge.page_id == page_db_id
-        ).all()
+        # ดึง records จากตาราง page_customer_type_knowledge (ถ้าไม่มี records สำหรับ page นี้ จะสร้างขึ้นมาใหม่)
+        page_knowledge_records = await async_crud.get_page_knowledge_records(db, page_db_id)
         
         logger.info(f"Found {len(page_knowledge_records)} page_knowledge records for page {page_id}")
         
-        # ถ้าไม่มี records สำหรับ page นี้ ให้สร้างขึ้นมาใหม่
-        if not page_knowledge_records:
-            page_knowledge_records = await _create_default_page_knowledge_records(
-                db, page_db_id
-            )
-        
         # สร้าง response - แก้ไขการเข้าถึง relationship
         result = []
         for pk_record in page_knowledge_records:
@@ -375,11 +343,11 @@ async def get_page_customer_type_knowledge(
         
     except Exception as e:
         logger.error(f"Error fetching page customer type knowledge: {e}")
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.put("/page-customer-type-knowledge/{page_id}/{knowledge_id}/toggle")
-async def toggle_page_knowledge_type(
+def toggle_page_knowledge_type(
     page_id: str,
     knowledge_id: int,
     db: Session = Depends(get_db)
@@ -441,7 +409,7 @@ async def toggle_page_knowledge_type(
 # ==================== Debug APIs ====================
 
 @router.get("/debug/knowledge-types")
-async def debug_knowledge_types(db: Session = Depends(get_db)):
+def debug_knowledge_types(db: Session = Depends(get_db)):
     """Debug endpoint สำหรับดู knowledge types ทั้งหมด"""
     try:
         knowledge_types = db.query(models.CustomerTypeKnowledge).all()
@@ -462,45 +430,8 @@ async def debug_knowledge_types(db: Session = Depends(get_db)):
         logger.error(f"Debug error: {e}")
         return {"error": str(e)}
 
-# ==================== Helper Functions ====================
-
-# API สำหรับสร้าง default page_customer_type_knowledge records
-async def _create_default_page_knowledge_records(db: Session, page_db_id: int):
-    """Helper function สำหรับสร้าง default page_customer_type_knowledge records"""
-    logger.info(f"Creating default page_customer_type_knowledge records for page {page_db_id}")
-    
-    # ดึง knowledge types ทั้งหมด
-    all_knowledge_types = db.query(models.CustomerTypeKnowledge).all()
-    
-    # สร้าง page_customer_type_knowledge records สำหรับ page นี้
-    created_records = []
-    for kt in all_knowledge_types:
-        new_record = models.PageCustomerTypeKnowledge(
-            page_id=page_db_id,
-            customer_type_knowledge_id=kt.id,
-            is_enabled=True
-        )
-        db.add(new_record)
-        created_records.append(new_record)
-    
-    try:
-        db.commit()
-        logger.info(f"Created {len(all_knowledge_types)} page_knowledge records")
-        
-        # Refresh records เพื่อโหลด relationships
-        for record in created_records:
-            db.refresh(record)
-        
-        return created_records
-        
-    except Exception as e:
-        db.rollback()
-        logger.error(f"Error creating page_knowledge records: {e}")
-        return []
-    
-# เพิ่ม API สำหรับแก้ไข knowledge type
 @router.put("/customer-type-knowledge/{knowledge_id}")
-async def update_customer_type_knowledge(
+def update_customer_type_knowledge(
     knowledge_id: int,
     update_data: dict,
     db: Session = Depends(get_db)
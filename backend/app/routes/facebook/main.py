@@ -15,6 +15,7 @@ from .groups import router as groups_router
 from .schedules import router as schedules_router
 from .file_search import router as file_search_router
 from .sse import router as sse_router
+from .ws import router as ws_router
 from .schedules import router as schedules_router
 from .imported_customers import router as imported_customers_router
 from .psids_sync import router as psids_sync_router
@@ -33,6 +34,7 @@ router.include_router(groups_router, tags=["Facebook Groups"])
 router.include_router(schedules_router, tags=["Facebook Schedules"])
 router.include_router(file_search_router, tags=["File Search"])
 router.include_router(sse_router, tags=["SSE"])
+router.include_router(ws_router, tags=["WebSocket"])
 router.include_router(psids_sync_router, tags=["psids_sync"])
 router.include_router(schedules_router, tags=["Facebook Schedules"])
 router.include_router(imported_customers_router, tags=["Facebook ImportedCustomers"])
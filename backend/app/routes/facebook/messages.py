@@ -4,21 +4,34 @@ from pydantic import BaseModel
 from typing import Optional
 from fastapi.responses import StreamingResponse
 from app.database.database import get_db
-from app.database import crud
 from app.celery_task.message_sender import send_message_task
 from app.utils.redis_helper import get_page_token
 from app.database.models import CustomerMessage
+from app.service.facebook_api import resolve_image_path, resolve_video_path
+from app.utils.blob_store import put_blob
+import asyncio
 import io
 import logging
+import os
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
 
 class SendMessageRequest(BaseModel):
     message: Optional[str] = None
-    type: Optional[str] = "text"  # "text" หรือ "image"
+    type: Optional[str] = "text"  # "text", "image" หรือ "video"
     is_system_message: Optional[bool] = False
 
+def store_local_media(path_or_url: str, media_type: str) -> Optional[str]:
+    """อ่านไฟล์สื่อแล้วเก็บลง blob store - คืนค่า digest (None ถ้าไม่พบไฟล์)"""
+    if not path_or_url:
+        return None
+    full_path = resolve_image_path(path_or_url) if media_type == "image" else resolve_video_path(path_or_url)
+    if not os.path.isfile(full_path):
+        return None
+    with open(full_path, "rb") as f:
+        return put_blob(f.read())
+
 @router.post("/send/{page_id}/{psid}")
 async def send_user_message(
     page_id: str,
@@ -27,8 +40,8 @@ async def send_user_message(
     db: Session = Depends(get_db)
 ):
     """
-    ส่งข้อความหรือรูปภาพจาก DB ผ่าน Celery
-    - ถ้า type="image" จะดึง binary จาก DB
+    ส่งข้อความหรือรูปภาพผ่าน Celery
+    - ถ้า type="image"/"video" จะเก็บไฟล์ลง blob store แล้วส่งแค่ digest ให้ worker
     - fallback เป็นข้อความถ้าไม่มีรูป
     """
     try:
@@ -37,13 +50,11 @@ async def send_user_message(
         if not access_token:
             raise HTTPException(status_code=400, detail="Page token not found")
 
-        # 🔍 ถ้าเป็นรูป ให้ดึง binary จาก DB
-        image_binary = None
-        if req.type == "image":
-            customer_msg = crud.get_customer_message_by_psid(db, psid)
-            if customer_msg and customer_msg.message_binary:
-                image_binary = customer_msg.message_binary
-            else:
+        # 🔍 ถ้าเป็นสื่อ ให้เก็บลง blob store (broker รับแค่ digest)
+        media_digest = None
+        if req.type in ("image", "video"):
+            media_digest = await asyncio.to_thread(store_local_media, req.message, req.type)
+            if not media_digest:
                 # fallback เป็นข้อความ
                 req.type = "text"
                 if not req.message:
@@ -55,7 +66,7 @@ async def send_user_message(
             psid=psid,
             message=req.message,
             msg_type=req.type,
-            image_binary=image_binary,
+            media_digest=media_digest,
             is_system_message=req.is_system_message
         )
 
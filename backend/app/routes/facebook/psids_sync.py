@@ -15,6 +15,8 @@ from app.utils.redis_helper import get_page_token
 
 """
    -ใช้สำหรับดึงข้อมูลข้อความจาก Facebook มาเก็บในตาราง customer_messages
+   -ข้อความปกติถูกบันทึกจาก webhook แล้ว (webhook_ingest) ส่วนนี้ใช้เติมข้อความที่ webhook ตกหล่น
+    โดยใช้ mid (id ของข้อความ) กันซ้ำ
 """
 
 router = APIRouter()
@@ -105,7 +107,7 @@ def fetch_all_messages_for_conversation(convo_id: str, access_token: str, since_
     """
     messages: List[Dict[str, Any]] = []
     endpoint = f"{convo_id}/messages"
-    params = {"fields": "created_time,from,message,attachments", "limit": 50}
+    params = {"fields": "id,created_time,from,message,attachments", "limit": 50}
 
     try:
         page = fb_get(endpoint, params, access_token)
@@ -237,15 +239,17 @@ def insert_customer_messages_from_conversations(
             if sender_id and sender_id != page_id_str:
                 customer_id = lookup_customer_id(db, page_db_id, sender_id)
 
-            # dedupe check: conversation_id + sender_id + created_at
+            # dedupe check: mid (ข้อความจาก webhook) หรือ conversation_id + sender_id + created_at (ข้อมูลเก่า)
             check_sql = text("""
                 SELECT 1 FROM customer_messages
-                WHERE conversation_id = :convo_id
-                AND sender_id = :sender_id
-                AND created_at = :created_at
+                WHERE mid = :mid
+                OR (conversation_id = :convo_id
+                    AND sender_id = :sender_id
+                    AND created_at = :created_at)
                 LIMIT 1
             """)
             exists = db.execute(check_sql, {
+                "mid": m.get("id"),
                 "convo_id": convo_id,
                 "sender_id": sender_id,
                 "created_at": created_bkk
@@ -261,15 +265,17 @@ def insert_customer_messages_from_conversations(
                 "sender_name": sender_name,
                 "message_text": message_text,
                 "message_type": message_type,
-                "created_at": created_bkk
+                "created_at": created_bkk,
+                "mid": m.get("id")
             })
 
             if len(batch_values) >= batch_size:
                 insert_sql = text("""
                     INSERT INTO customer_messages
-                    (customer_id, conversation_id, sender_id, sender_name, message_text, message_type, created_at)
+                    (customer_id, conversation_id, sender_id, sender_name, message_text, message_type, created_at, mid)
                     VALUES
-                    (:customer_id, :conversation_id, :sender_id, :sender_name, :message_text, :message_type, :created_at)
+                    (:customer_id, :conversation_id, :sender_id, :sender_name, :message_text, :message_type, :created_at, :mid)
+                    ON CONFLICT (mid) DO NOTHING
                 """)
                 db.execute(insert_sql, batch_values)
                 db.commit()
@@ -280,9 +286,10 @@ def insert_customer_messages_from_conversations(
     if batch_values:
         insert_sql = text("""
             INSERT INTO customer_messages
-            (customer_id, conversation_id, sender_id, sender_name, message_text, message_type, created_at)
+            (customer_id, conversation_id, sender_id, sender_name, message_text, message_type, created_at, mid)
             VALUES
-            (:customer_id, :conversation_id, :sender_id, :sender_name, :message_text, :message_type, :created_at)
+            (:customer_id, :conversation_id, :sender_id, :sender_name, :message_text, :message_type, :created_at, :mid)
+            ON CONFLICT (mid) DO NOTHING
         """)
         db.execute(insert_sql, batch_values)
         db.commit()
@@ -18,6 +18,9 @@ from app.database import models
 from fastapi.responses import JSONResponse
 
 from app.service.message_scheduler import message_scheduler
+from app.service.broadcast_engine import broadcast_engine
+from app.celery_task.broadcast_tasks import cancel_campaign
+from app.service.send_ledger import reset_schedule_epoch
 from .auth import get_page_tokens
 
 router = APIRouter()
@@ -41,6 +44,7 @@ async def activate_schedule(request: Request):
     # Reset sent tracking สำหรับ schedule นี้
     schedule_id = str(schedule['id'])
     message_scheduler.sent_tracking[schedule_id] = set()
+    reset_schedule_epoch(schedule_id)
     
     # ตรวจสอบและแก้ไขข้อมูล schedule
     if 'pageId' not in schedule and page_id:
@@ -115,6 +119,7 @@ async def test_user_inactivity(page_id: str, minutes: int = 1):
     
     # Reset tracking สำหรับการทดสอบ
     message_scheduler.sent_tracking["999"] = set()
+    reset_schedule_epoch("999")
     
     # อัพเดท page tokens ก่อนทดสอบ
     page_tokens = get_page_tokens()
@@ -138,8 +143,81 @@ async def test_user_inactivity(page_id: str, minutes: int = 1):
 async def reset_schedule_tracking(schedule_id: str):
     """Reset tracking data ของ schedule"""
     message_scheduler.sent_tracking[schedule_id] = set()
+    # เริ่ม ledger รอบใหม่ เพื่อให้ส่งหาผู้รับเดิมได้อีกครั้ง
+    reset_schedule_epoch(schedule_id)
     return {"status": "success", "message": f"Reset tracking for schedule {schedule_id}"}
 
+# API สำหรับดูความคืบหน้าของ broadcast jobs ของเพจ
+@router.get("/broadcast/jobs/{page_id}")
+async def get_broadcast_jobs(page_id: str):
+    """ดู broadcast jobs (กำลังส่ง + ล่าสุด) ของเพจ"""
+    jobs = broadcast_engine.list_jobs(page_id)
+    return {"page_id": page_id, "jobs": jobs, "count": len(jobs)}
+
+# API สำหรับดูความคืบหน้าของ broadcast job เดียว
+@router.get("/broadcast/job/{job_id}")
+async def get_broadcast_job(job_id: str):
+    """ดูสถานะ broadcast job"""
+    job = broadcast_engine.get_job(job_id)
+    if not job:
+        return JSONResponse(status_code=404, content={"error": "Broadcast job not found"})
+    return job
+
+# API สำหรับยกเลิก broadcast job ที่กำลังส่ง
+@router.post("/broadcast/job/{job_id}/cancel")
+async def cancel_broadcast_job(job_id: str):
+    """ยกเลิก broadcast job (ข้อความที่ส่งไปแล้วจะไม่ถูกย้อนกลับ)"""
+    if not broadcast_engine.cancel(job_id):
+        return JSONResponse(status_code=404, content={"error": "Broadcast job not found or already finished"})
+    return {"status": "success", "message": f"Cancelling broadcast job {job_id}"}
+
+def _campaign_to_dict(campaign: models.BroadcastCampaign) -> Dict[str, Any]:
+    return {
+        "id": campaign.id,
+        "page_id": campaign.page_id,
+        "schedule_id": campaign.schedule_id,
+        "group_type": campaign.group_type,
+        "status": campaign.status,
+        "total_recipients": campaign.total_recipients,
+        "total_chunks": campaign.total_chunks,
+        "completed_chunks": campaign.completed_chunks,
+        "sent": campaign.sent,
+        "failed": campaign.failed,
+        "error": campaign.error,
+        "created_at": campaign.created_at.isoformat() if campaign.created_at else None,
+        "finished_at": campaign.finished_at.isoformat() if campaign.finished_at else None,
+    }
+
+# API สำหรับดู campaigns ที่ส่งผ่าน Celery ของเพจ
+@router.get("/broadcast/campaigns/{page_id}")
+async def get_broadcast_campaigns(page_id: str, limit: int = 50, db: Session = Depends(get_db)):
+    """ดู campaigns ล่าสุดของเพจ"""
+    campaigns = db.query(models.BroadcastCampaign).filter(
+        models.BroadcastCampaign.page_id == page_id
+    ).order_by(models.BroadcastCampaign.created_at.desc()).limit(limit).all()
+    return {
+        "page_id": page_id,
+        "campaigns": [_campaign_to_dict(c) for c in campaigns],
+        "count": len(campaigns)
+    }
+
+# API สำหรับดูสถานะ campaign
+@router.get("/broadcast/campaign/{campaign_id}")
+async def get_broadcast_campaign(campaign_id: str, db: Session = Depends(get_db)):
+    """ดูสถานะ campaign"""
+    campaign = db.query(models.BroadcastCampaign).filter(models.BroadcastCampaign.id == campaign_id).first()
+    if not campaign:
+        return JSONResponse(status_code=404, content={"error": "Campaign not found"})
+    return _campaign_to_dict(campaign)
+
+# API สำหรับยกเลิก campaign
+@router.post("/broadcast/campaign/{campaign_id}/cancel")
+async def cancel_broadcast_campaign(campaign_id: str):
+    """ยกเลิก campaign (chunk ที่กำลังส่งอยู่จะส่งต่อจนจบ chunk)"""
+    if not cancel_campaign(campaign_id):
+        return JSONResponse(status_code=404, content={"error": "Campaign not found or already finished"})
+    return {"status": "success", "message": f"Cancelled campaign {campaign_id}"}
+
 # API สำหรับดูสถานะของระบบ scheduler
 @router.get("/schedule/system-status")
 async def get_system_status():
@@ -1,13 +1,13 @@
 # backend/app/routes/facebook/sse.py
-from fastapi import APIRouter, Request, Depends
+from fastapi import APIRouter, Request
 from fastapi.responses import StreamingResponse
-from sqlalchemy.orm import Session
-from app.database.database import get_db
-from app.database import crud
+from app.service.sse_broker import sse_broker, publish
+from app.service.sse_poller import customer_change_poller
 import asyncio
 import json
+import os
 from datetime import datetime
-from typing import AsyncGenerator
+from typing import AsyncGenerator, Optional
 import logging
 
 router = APIRouter()
@@ -16,93 +16,52 @@ logger = logging.getLogger(__name__)
 # Store active connections
 active_connections = {}
 
-# เพิ่ม queue สำหรับ customer type updates
-customer_type_update_queue = asyncio.Queue()
+# ส่ง heartbeat เฉพาะเมื่อไม่มี event นานเท่านี้
+HEARTBEAT_INTERVAL = int(os.getenv("SSE_HEARTBEAT_INTERVAL", 15))
 
-async def event_generator(page_id: str, db: Session) -> AsyncGenerator:
-    """Generate SSE events for real-time updates"""
+def format_event(event: dict, event_id: Optional[str] = None) -> str:
+    prefix = f"id: {event_id}\n" if event_id else ""
+    return f"{prefix}data: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+async def event_generator(page_id: str, last_event_id: Optional[str] = None) -> AsyncGenerator:
+    """Generate SSE events for real-time updates
+
+    ไม่ถือ DB session - การเปลี่ยนแปลงของลูกค้ามาจาก change feed / poller ตัวเดียวต่อเพจ
+    และ update อื่นๆ ผ่าน sse_broker
+    last_event_id: id ของ event สุดท้ายที่ client ได้รับ -> ส่ง event ที่พลาดไปก่อน (หรือ resync ถ้า buffer ล้น)
+    """
     client_id = f"{page_id}_{datetime.now().timestamp()}"
     active_connections[client_id] = True
+    # ✅ รับ event ของเพจนี้จากทุกโปรเซสผ่าน broker (ทุก connection ได้ทุก event)
+    # subscribe ก่อน replay เพื่อไม่ให้ event ที่เข้ามาระหว่าง replay หายไป
+    subscription = await sse_broker.subscribe(page_id)
+    customer_change_poller.watch(page_id)
     
     try:
-        last_check = datetime.now()
-        
+        for event_id, event in await subscription.replay(last_event_id):
+            yield format_event(event, event_id)
+
         while active_connections.get(client_id, False):
             try:
-                try:
-                    # ✅ ตรวจสอบ queue updates ตาม page_id
-                    try:
-                        update = await asyncio.wait_for(
-                            customer_type_update_queue.get(), 
-                            timeout=1.0
-                        )
-                        
-                        # ✅ ส่งเฉพาะข้อมูลที่ตรงกับ page_id
-                        if update.get('page_id') == page_id:
-                            yield f"data: {json.dumps({'type': 'customer_type_update', 'data': [update]})}\n\n"
-                            logger.info(f"Sent customer type update for {update['psid']} on page {page_id}")
-                            
-                    except asyncio.TimeoutError:
-                        pass
-                    
-                    # Check for new/updated customers
-                    page = crud.get_page_by_page_id(db, page_id)
-                    if page:
-                        customers = crud.get_customers_updated_after(
-                            db, page.ID, last_check
-                        )
-                        
-                        if customers:
-                            updates = []
-                            for customer in customers:
-                                knowledge_name = None
-                                if customer.current_category:
-                                    knowledge_name = customer.current_category.type_name
-                                
-                                update_data = {
-                                    'id': customer.id,
-                                    'psid': customer.customer_psid,
-                                    'name': customer.name or f"User...{customer.customer_psid[-8:]}",
-                                    'first_interaction': customer.first_interaction_at.isoformat() if customer.first_interaction_at else None,
-                                    'last_interaction': customer.last_interaction_at.isoformat() if customer.last_interaction_at else None,
-                                    'source_type': customer.source_type,
-                                    'current_category_id': customer.current_category_id,
-                                    'current_category_name': knowledge_name,
-                                    'mining_status': customer.mining_statuses[0].status if customer.mining_statuses else 'ยังไม่ขุด',
-                                    'action': 'update'
-                                }
-                                updates.append(update_data)
-                            
-                            yield f"data: {json.dumps({'type': 'customer_update', 'data': updates})}\n\n"
-                            last_check = datetime.now()
-                    
-                    db.commit()
-                    
-                except Exception as e:
-                    db.rollback()
-                    logger.error(f"Database error in SSE for page {page_id}: {e}")
-                
-                # Send heartbeat
-                yield f"data: {json.dumps({'type': 'heartbeat', 'timestamp': datetime.now().isoformat()})}\n\n"
-                
-                await asyncio.sleep(5)
+                # ✅ event ที่รวม state ล่าสุดต่อ psid ภายใน flush window
+                events = await subscription.next_events(HEARTBEAT_INTERVAL)
+                if events is None:
+                    # Send heartbeat (เฉพาะตอน idle)
+                    yield f"data: {json.dumps({'type': 'heartbeat', 'timestamp': datetime.now().isoformat()})}\n\n"
+                    continue
+                for event_id, event in events:
+                    yield format_event(event, event_id)
                 
             except Exception as e:
                 logger.error(f"Error in SSE generator for page {page_id}: {e}")
-                try:
-                    db.rollback()
-                except:
-                    pass
                 yield f"data: {json.dumps({'type': 'error', 'message': 'Connection error'})}\n\n"
                 await asyncio.sleep(5)
                 
     finally:
         active_connections.pop(client_id, None)
+        customer_change_poller.unwatch(page_id)
+        await sse_broker.unsubscribe(page_id, subscription)
         logger.info(f"SSE connection closed for {client_id}")
-        try:
-            db.rollback()
-        except:
-            pass
 
 # Helper function สำหรับส่ง customer type update
 async def send_customer_type_update(page_id: str, psid: str, customer_type_name: str = None, customer_type_custom_id: int = None, customer_type_knowledge_name: str = None, customer_type_knowledge_id: int = None):
@@ -125,33 +84,30 @@ async def send_customer_type_update(page_id: str, psid: str, customer_type_name:
     if customer_type_knowledge_id is not None:
         update['customer_type_knowledge_id'] = customer_type_knowledge_id
     
-    await customer_type_update_queue.put(update)
-    logger.info(f"Queued customer type update for {psid}")
+    # publish เป็น Redis แบบ sync (XADD + PUBLISH) - ไม่ block event loop
+    await asyncio.to_thread(publish, page_id, update)
+    logger.info(f"Published customer type update for {psid}")
 
 @router.get("/sse/customers/{page_id}")
 async def customer_updates_stream(
     page_id: str,
     request: Request,
-    db: Session = Depends(get_db)
+    last_event_id: Optional[str] = None
 ):
-    """SSE endpoint for real-time customer updates"""
+    """SSE endpoint for real-time customer updates (ไม่ใช้ DB connection จาก pool ตลอดอายุ connection)
+
+    รองรับ Last-Event-ID (header ที่ EventSource ส่งเองตอน reconnect หรือ query ?last_event_id=)
+    """
+    resume_from = request.headers.get("last-event-id") or last_event_id
     
-    # สร้าง generator function ใหม่ที่จัดการ db session อย่างถูกต้อง
     async def safe_event_stream():
         try:
-            async for event in event_generator(page_id, db):
+            async for event in event_generator(page_id, resume_from):
                 if await request.is_disconnected():
                     break
                 yield event
         except Exception as e:
             logger.error(f"SSE stream error: {e}")
-        finally:
-            # ทำ cleanup
-            try:
-                db.rollback()
-                db.close()
-            except:
-                pass
     
     return StreamingResponse(
         safe_event_stream(),
@@ -5,20 +5,27 @@ API นี้คือ จุดศูนย์กลาง สำหรับ f
 - จำนวนลูกค้าใหม่วันนี้
 - จำนวนลูกค้าที่ inactive
 - การแบ่งกลุ่มลูกค้าตาม type/knowledge
+- จำนวนลูกค้าใหม่ / ลูกค้าที่คุยรายวัน (?days=)
+
+ตัวเลขอ่านจาก rollup รายวัน customer_daily_stats จึงใช้เวลาเท่ากันไม่ว่าเพจจะมีลูกค้ากี่คน
 
 """
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, Query
 from sqlalchemy.orm import Session
 from app.database import crud
-from app.database.database import get_db
+from app.database.database import get_read_db
 from datetime import datetime
 from fastapi.responses import JSONResponse
 
 router = APIRouter()
 
 @router.get("/customer-statistics/{page_id}")
-async def get_customer_statistics(page_id: str, db: Session = Depends(get_db)):
-    """ดึงสถิติลูกค้าของเพจ"""
+def get_customer_statistics(
+    page_id: str,
+    days: int = Query(0, ge=0, le=365),
+    db: Session = Depends(get_read_db)
+):
+    """ดึงสถิติลูกค้าของเพจ (days > 0 = แนบกราฟรายวันย้อนหลัง days วันใน daily)"""
     # ดึง page จาก page_id string
     page = crud.get_page_by_page_id(db, page_id)
     if not page:
@@ -30,9 +37,12 @@ async def get_customer_statistics(page_id: str, db: Session = Depends(get_db)):
     # ใช้ page.ID (uppercase) เมื่อเรียก function
     stats = crud.get_customer_statistics(db, page.ID)
     
-    return {
+    response = {
         "page_id": page_id,
         "page_name": page.page_name,
         "statistics": stats,
         "generated_at": datetime.now().isoformat()
-    }
\ No newline at end of file
+    }
+    if days:
+        response["daily"] = crud.get_customer_daily_stats(db, page.ID, days)
+    return response
\ No newline at end of file
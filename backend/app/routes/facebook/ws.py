@@ -0,0 +1,155 @@
+# backend/app/routes/facebook/ws.py
+"""
+WebSocket สำหรับ real-time update หลายเพจใน connection เดียว
+- ใช้ sse_broker / poller / replay buffer ชุดเดียวกับ /sse/customers/{page_id}
+- client เปลี่ยนเพจที่ติดตามได้โดยไม่ต้อง reconnect
+
+ข้อความจาก client:
+    {"action": "subscribe", "page_id": "...", "last_seq": "...", "types": ["customer_update"]}
+    {"action": "unsubscribe", "page_id": "..."}
+    {"action": "ping"}
+ข้อความจาก server:
+    {"page_id": "...", "seq": "...", "type": "customer_update" | "customer_type_update" | "resync", "data": [...]}
+    seq คือ event id ของเพจนั้น (เรียงลำดับต่อเพจ) - ส่งกลับมาเป็น last_seq ตอน subscribe ใหม่เพื่อรับ event ที่พลาดไป
+    {"type": "seq", "page_id": "...", "seq": "..."} - ชุดที่ event ถูกกรองด้วย types ทั้งหมด (อัปเดต seq อย่างเดียว)
+    {"type": "subscribed" | "unsubscribed", "page_id": "..."}, {"type": "heartbeat"}, {"type": "error", "message": "..."}
+"""
+
+from fastapi import APIRouter, WebSocket, WebSocketDisconnect
+from app.service.sse_broker import sse_broker
+from app.service.sse_poller import customer_change_poller
+import asyncio
+import json
+import os
+from datetime import datetime
+from typing import Dict, List, Optional
+import logging
+
+router = APIRouter()
+logger = logging.getLogger(__name__)
+
+WS_HEARTBEAT_INTERVAL = int(os.getenv("WS_HEARTBEAT_INTERVAL", 15))
+# จำนวนเพจสูงสุดต่อ connection
+WS_MAX_PAGES = int(os.getenv("WS_MAX_PAGES", 100))
+
+
+class CustomerSocket:
+    """connection หนึ่ง: 1 task ต่อเพจที่ subscribe ส่ง event เข้า socket เดียวกัน"""
+
+    def __init__(self, websocket: WebSocket):
+        self.websocket = websocket
+        self.pages: Dict[str, asyncio.Task] = {}
+        self._send_lock = asyncio.Lock()
+        self.last_send = asyncio.get_running_loop().time()
+
+    async def send(self, message: Dict):
+        async with self._send_lock:
+            await self.websocket.send_text(json.dumps(message, ensure_ascii=False, default=str))
+            self.last_send = asyncio.get_running_loop().time()
+
+    async def subscribe(self, page_id: str, last_seq: Optional[str], types: Optional[List[str]]):
+        if page_id in self.pages:
+            await self.unsubscribe(page_id, notify=False)
+        # task ที่จบไปแล้ว (subscription ปิดเพราะ error) ไม่นับเป็นเพจที่ติดตามอยู่
+        self.pages = {pid: task for pid, task in self.pages.items() if not task.done()}
+        if len(self.pages) >= WS_MAX_PAGES:
+            await self.send({'type': 'error', 'page_id': page_id, 'message': f'Too many pages (max {WS_MAX_PAGES})'})
+            return
+        self.pages[page_id] = asyncio.create_task(self._forward(page_id, last_seq, set(types or ())))
+
+    async def unsubscribe(self, page_id: str, notify: bool = True):
+        task = self.pages.pop(page_id, None)
+        if task:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        if notify:
+            await self.send({'type': 'unsubscribed', 'page_id': page_id})
+
+    async def _forward(self, page_id: str, last_seq: Optional[str], types: set):
+        # subscribe ก่อน replay เพื่อไม่ให้ event ที่เข้ามาระหว่าง replay หายไป
+        subscription = await sse_broker.subscribe(page_id)
+        customer_change_poller.watch(page_id)
+        try:
+            await self.send({'type': 'subscribed', 'page_id': page_id})
+            events = await subscription.replay(last_seq)
+            while True:
+                unsent_seq = None
+                for seq, event in events or ():
+                    # resync ส่งเสมอ / event อื่นกรองตาม types ที่ขอ
+                    if types and event.get('type') != 'resync' and event.get('type') not in types:
+                        unsent_seq = seq or unsent_seq
+                        continue
+                    message = {'page_id': page_id, **event}
+                    if seq:
+                        message['seq'] = seq
+                        unsent_seq = None
+                    await self.send(message)
+                # seq ของชุดอยู่กับ event ที่ถูกกรองทิ้ง -> ส่ง seq ให้ client อย่างเดียว (reconnect จะไม่ replay ซ้ำ)
+                if unsent_seq:
+                    await self.send({'type': 'seq', 'page_id': page_id, 'seq': unsent_seq})
+                events = await subscription.next_events(WS_HEARTBEAT_INTERVAL)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"❌ WebSocket forward error for page {page_id}: {e}")
+            # client ต้อง subscribe ใหม่ (ส่ง last_seq ล่าสุดเพื่อรับ event ที่พลาดไป)
+            try:
+                await self.send({'type': 'error', 'page_id': page_id, 'message': 'Subscription closed'})
+            except Exception:
+                pass
+        finally:
+            customer_change_poller.unwatch(page_id)
+            await sse_broker.unsubscribe(page_id, subscription)
+
+    async def handle(self, message: Dict):
+        action = message.get('action')
+        page_id = message.get('page_id')
+        if action == 'ping':
+            await self.send({'type': 'pong', 'timestamp': datetime.now().isoformat()})
+        elif action in ('subscribe', 'unsubscribe') and isinstance(page_id, str) and page_id:
+            if action == 'subscribe':
+                await self.subscribe(page_id, message.get('last_seq'), message.get('types'))
+            else:
+                await self.unsubscribe(page_id)
+        else:
+            await self.send({'type': 'error', 'message': f'Invalid message: {message}'})
+
+    async def close(self):
+        for page_id in list(self.pages):
+            await self.unsubscribe(page_id, notify=False)
+
+
+@router.websocket("/ws/customers")
+async def customer_updates_socket(websocket: WebSocket):
+    """real-time update ของลูกค้าหลายเพจผ่าน WebSocket เดียว (แทนการเปิด SSE 1 stream ต่อเพจ)"""
+    await websocket.accept()
+    connection = CustomerSocket(websocket)
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            try:
+                raw = await asyncio.wait_for(websocket.receive_text(), timeout=WS_HEARTBEAT_INTERVAL)
+            except asyncio.TimeoutError:
+                # Send heartbeat (เฉพาะตอน idle)
+                if loop.time() - connection.last_send >= WS_HEARTBEAT_INTERVAL:
+                    await connection.send({'type': 'heartbeat', 'timestamp': datetime.now().isoformat()})
+                continue
+
+            try:
+                message = json.loads(raw)
+            except ValueError:
+                await connection.send({'type': 'error', 'message': 'Invalid JSON'})
+                continue
+            if isinstance(message, dict):
+                await connection.handle(message)
+            else:
+                await connection.send({'type': 'error', 'message': 'Invalid message'})
+
+    except WebSocketDisconnect:
+        pass
+    except Exception as e:
+        logger.error(f"❌ WebSocket error: {e}")
+    finally:
+        page_count = len(connection.pages)
+        await connection.close()
+        logger.info(f"WebSocket connection closed ({page_count} pages)")
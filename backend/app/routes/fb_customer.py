@@ -1,11 +1,12 @@
 # backend/app/routes/fb_customer.py
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query
 from sqlalchemy.orm import Session, joinedload
 from typing import List, Dict, Any, Optional
-from sqlalchemy import or_, and_
-from app.database.models import FbCustomer, FacebookPage, FBCustomerCustomClassification
-from app.database.database import get_db
+from app.database.models import FbCustomer, FacebookPage
+from app.database import crud
+from app.database.database import get_db, get_read_db
 from app.database.schemas import FbCustomerSchema
+import base64
 import logging
 from datetime import datetime
 
@@ -13,73 +14,16 @@ router = APIRouter()
 logger = logging.getLogger(__name__)
 
 # =============== Helper Functions ===============
-def get_customer_data(customer: FbCustomer) -> dict:
-    """Format customer data for response"""
-    # Get latest custom classification
-    latest_custom = None
-    if customer.custom_classifications:
-        latest_custom = max(
-            customer.custom_classifications,
-            key=lambda x: x.classified_at,
-            default=None
-        )
-    
-    # Get latest mining status
-    mining_status = "ยังไม่ขุด"
-    mining_updated_at = None
-    
-    if customer.mining_statuses:
-        latest_mining = max(
-            customer.mining_statuses,
-            key=lambda x: x.created_at,
-            default=None
-        )
-        if latest_mining:
-            mining_status = latest_mining.status
-            mining_updated_at = latest_mining.created_at.isoformat()
-    
-    return {
-        "id": customer.id,
-        "page_id": customer.page_id,
-        "customer_psid": customer.customer_psid,
-        "name": customer.name,
-        "first_interaction_at": customer.first_interaction_at.isoformat() if customer.first_interaction_at else None,
-        "last_interaction_at": customer.last_interaction_at.isoformat() if customer.last_interaction_at else None,
-        "created_at": customer.created_at.isoformat() if customer.created_at else None,
-        "updated_at": customer.updated_at.isoformat() if customer.updated_at else None,
-        "source_type": customer.source_type,
-        
-        # Knowledge Category
-        "current_category_id": customer.current_category_id,
-        "current_category_name": customer.current_category.type_name if customer.current_category else None,
-        
-        # Custom Category
-        "custom_category_id": latest_custom.new_category_id if latest_custom else None,
-        "custom_category_name": (
-            latest_custom.new_category.type_name 
-            if latest_custom and latest_custom.new_category 
-            else None
-        ),
-        
-        # Classifications count
-        "classifications_count": len(customer.classifications),
-        "custom_classifications_count": len(customer.custom_classifications),
-        
-        # Mining status
-        "mining_status": mining_status,
-        "mining_status_updated_at": mining_updated_at
-    }
+def encode_cursor(last_interaction_at: str, customer_id: int) -> str:
+    """cursor ของหน้าถัดไป = (last_interaction_at, id) ของรายการสุดท้าย"""
+    return base64.urlsafe_b64encode(f"{last_interaction_at}|{customer_id}".encode()).decode()
 
-def build_customer_query(db: Session, page_id: int):
-    """Build optimized query with eager loading"""
-    return db.query(FbCustomer).options(
-        joinedload(FbCustomer.current_category),
-        joinedload(FbCustomer.classifications),
-        joinedload(FbCustomer.custom_classifications).joinedload(
-            FBCustomerCustomClassification.new_category
-        ),
-        joinedload(FbCustomer.mining_statuses)
-    ).filter(FbCustomer.page_id == page_id)
+def decode_cursor(cursor: str) -> tuple:
+    try:
+        last_interaction_at, customer_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(last_interaction_at), int(customer_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
 
 # =============== API Endpoints ===============
 @router.get("/fb-customers", response_model=List[FbCustomerSchema])
@@ -96,35 +40,61 @@ def get_customer_by_id(customer_id: int, db: Session = Depends(get_db)):
     return customer
 
 @router.get("/fb-customers/by-page/{page_id}")
-def get_customers_by_page(page_id: str, db: Session = Depends(get_db)):
+def get_customers_by_page(page_id: str, db: Session = Depends(get_read_db)):
     """Get customers by Facebook page with optimized query"""
     # Get page
     page = db.query(FacebookPage).filter(FacebookPage.page_id == page_id).first()
     if not page:
         raise HTTPException(status_code=404, detail=f"Page not found: {page_id}")
 
-    install_date = page.created_at
+    # ชื่อหมวด / mining status / จำนวน อ่านจาก customer_view (ไม่ต้องโหลด collection มาคำนวณใน Python)
+    return crud.list_customers_page(db, page, limit=None)
 
-    # Build optimized query with eager loading
-    customers_query = build_customer_query(db, page.ID)
-    
-    # Apply filters
-    customers = customers_query.filter(
-        and_(
-            FbCustomer.first_interaction_at.isnot(None),
-            FbCustomer.last_interaction_at.isnot(None),
-            or_(
-                FbCustomer.source_type == 'new',
-                and_(
-                    FbCustomer.source_type == 'imported',
-                    FbCustomer.last_interaction_at > install_date
-                )
-            )
-        )
-    ).order_by(FbCustomer.last_interaction_at.desc()).all()
+@router.get("/fb-customers/by-page/{page_id}/paginated")
+def list_customers_by_page(
+    page_id: str,
+    limit: int = Query(100, ge=1, le=500),
+    cursor: Optional[str] = None,
+    category_id: Optional[int] = None,
+    custom_category_id: Optional[int] = None,
+    mining_status: Optional[str] = None,
+    source_type: Optional[str] = None,
+    inactive_min_days: Optional[int] = Query(None, ge=0),
+    inactive_max_days: Optional[int] = Query(None, ge=0),
+    name_prefix: Optional[str] = None,
+    db: Session = Depends(get_read_db)
+):
+    """Get customers by Facebook page ทีละหน้า (keyset pagination) พร้อม filter ฝั่ง server
 
-    # Format response using helper function
-    return [get_customer_data(customer) for customer in customers]
+    ส่ง next_cursor กลับมาเป็น ?cursor= เพื่อดึงหน้าถัดไป (None = หน้าสุดท้าย)
+    ข้อมูลแต่ละรายการเหมือน /fb-customers/by-page/{page_id}
+    """
+    page = db.query(FacebookPage).filter(FacebookPage.page_id == page_id).first()
+    if not page:
+        raise HTTPException(status_code=404, detail=f"Page not found: {page_id}")
+
+    customers = crud.list_customers_page(
+        db, page,
+        limit=limit + 1,
+        after=decode_cursor(cursor) if cursor else None,
+        category_id=category_id,
+        custom_category_id=custom_category_id,
+        mining_status=mining_status,
+        source_type=source_type,
+        inactive_min_days=inactive_min_days,
+        inactive_max_days=inactive_max_days,
+        name_prefix=name_prefix,
+    )
+
+    has_more = len(customers) > limit
+    customers = customers[:limit]
+    last = customers[-1] if customers else None
+    return {
+        "customers": customers,
+        "count": len(customers),
+        "has_more": has_more,
+        "next_cursor": encode_cursor(last["last_interaction_at"], last["id"]) if has_more else None,
+    }
 
 @router.get("/debug/customer-types/{page_id}")
 def debug_customer_types(page_id: str, db: Session = Depends(get_db)):
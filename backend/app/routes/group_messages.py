@@ -8,15 +8,21 @@ Group Messages Component
 """
 
 from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from typing import List, Optional, Union, Dict, Any
 from datetime import datetime, timedelta
 from pydantic import BaseModel
+import asyncio
 import logging
 import base64
 
-from app.database import models, crud
-from app.database.database import get_db
+from app.database import models, crud, async_crud
+from app.database.database import get_db, get_async_db
+from app.service.attachment_cache import invalidate_digest
+from app.utils.blob_store import (store_media, media_fields_from_input, media_url,
+                                  row_has_media, row_media_digest, load_row_media)
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
@@ -79,19 +85,27 @@ def format_message_with_media(msg: models.CustomerTypeMessage) -> dict:
         "content": msg.content,
         "display_order": msg.display_order,
         "created_at": msg.created_at.isoformat() if msg.created_at else None,
-        "has_image": bool(msg.image_data),
-        "has_media": bool(msg.image_data),
+        "has_image": row_has_media(msg),
+        "has_media": row_has_media(msg),
         "image_base64": None,
-        "media_base64": None
+        "media_base64": None,
+        "media_url": media_url(msg.media_digest) if msg.media_digest else None
     }
     
-    if msg.image_data:
+    # สื่อใน blob store ส่งเป็น URL แทน base64 (frontend ใช้เป็น src ได้เหมือนเดิม)
+    if result["media_url"]:
+        if msg.message_type in ('image', 'video'):
+            result["image_base64"] = result["media_url"]
+        result["media_base64"] = result["media_url"]
+        return result
+    
+    media = load_row_media(msg)
+    if media:
         try:
-            media_base64 = base64.b64encode(msg.image_data).decode('utf-8')
-            if msg.message_type == 'image':
-                result["image_base64"] = f"data:image/jpeg;base64,{media_base64}"
-            elif msg.message_type == 'video':
-                result["image_base64"] = f"data:video/mp4;base64,{media_base64}"
+            media_base64 = base64.b64encode(media).decode('utf-8')
+            if msg.message_type in ('image', 'video'):
+                mime = msg.media_mime or ("image/jpeg" if msg.message_type == 'image' else "video/mp4")
+                result["image_base64"] = f"data:{mime};base64,{media_base64}"
             result["media_base64"] = result["image_base64"]
         except Exception as e:
             logger.error(f"Error encoding media: {e}")
@@ -128,6 +142,78 @@ def parse_interval_string(interval_str: Optional[str]) -> Optional[timedelta]:
     except (ValueError, IndexError):
         return None
 
+def group_messages_query(page_id: int, group_id: int):
+    """ข้อความของ User Group (ไม่ดึง image_data - ดู format_messages_with_media)"""
+    return (
+        select(models.CustomerTypeMessage)
+        .where(
+            models.CustomerTypeMessage.page_id == page_id,
+            models.CustomerTypeMessage.customer_type_custom_id == group_id
+        )
+        .order_by(models.CustomerTypeMessage.display_order)
+    )
+
+def knowledge_group_messages_query(page_db_id: int, knowledge_id: int):
+    """ข้อความของ Knowledge Group ของเพจ (page DB ID)"""
+    return (
+        select(models.CustomerTypeMessage)
+        .join(
+            models.PageCustomerTypeKnowledge,
+            models.CustomerTypeMessage.page_customer_type_knowledge_id == models.PageCustomerTypeKnowledge.id
+        )
+        .where(
+            models.PageCustomerTypeKnowledge.page_id == page_db_id,
+            models.PageCustomerTypeKnowledge.customer_type_knowledge_id == knowledge_id
+        )
+        .order_by(models.CustomerTypeMessage.display_order)
+    )
+
+def group_message_ids_query(page_id: int, group_id: str):
+    """id ข้อความของกลุ่ม (user group หรือ knowledge_/group_knowledge_) ใช้เป็น subquery"""
+    if group_id.startswith('knowledge_') or group_id.startswith('group_knowledge_'):
+        knowledge_id = int(group_id.replace('group_knowledge_', '').replace('knowledge_', ''))
+        return select(models.CustomerTypeMessage.id).join(
+            models.PageCustomerTypeKnowledge,
+            models.CustomerTypeMessage.page_customer_type_knowledge_id == models.PageCustomerTypeKnowledge.id
+        ).where(
+            models.PageCustomerTypeKnowledge.page_id == page_id,
+            models.PageCustomerTypeKnowledge.customer_type_knowledge_id == knowledge_id
+        )
+    return select(models.CustomerTypeMessage.id).where(
+        models.CustomerTypeMessage.page_id == page_id,
+        models.CustomerTypeMessage.customer_type_custom_id == int(group_id)
+    )
+
+def message_schedules_query(message_ids):
+    """schedule ของข้อความ (ไม่ join ข้อความ จึงไม่แตะ image_data)"""
+    return (
+        select(models.MessageSchedule)
+        .where(models.MessageSchedule.customer_type_message_id.in_(message_ids))
+        .order_by(models.MessageSchedule.id)
+    )
+
+def schedule_summary_messages_query(page_id: int, group_ids: List[int]):
+    """(group_id, message_id) ของทุกกลุ่มใน query เดียว - เลือกแค่ 2 column"""
+    return (
+        select(models.CustomerTypeMessage.customer_type_custom_id, models.CustomerTypeMessage.id)
+        .where(
+            models.CustomerTypeMessage.page_id == page_id,
+            models.CustomerTypeMessage.customer_type_custom_id.in_(group_ids)
+        )
+        .order_by(models.CustomerTypeMessage.id)
+    )
+
+async def format_messages_with_media(db: AsyncSession, messages: List[models.CustomerTypeMessage]) -> List[dict]:
+    """format_message_with_media หลายรายการใน thread (อ่านสื่อจาก blob store เป็น disk I/O)
+
+    row ที่มี media_digest ส่งเป็น media_url (ไม่โหลด bytes) - โหลด image_data เฉพาะ row เก่าที่ยังไม่ย้าย
+    (AsyncSession lazy load ไม่ได้ จึงโหลดตรงนี้แทนการ undefer ทั้ง query)
+    """
+    for msg in messages:
+        if msg.has_legacy_media and not msg.media_digest:
+            await db.refresh(msg, ["image_data"])
+    return await asyncio.to_thread(lambda: [format_message_with_media(msg) for msg in messages])
+
 def format_interval_to_string(interval: Optional[timedelta]) -> Optional[str]:
     """Convert timedelta to string"""
     if not interval:
@@ -144,7 +230,7 @@ def format_interval_to_string(interval: Optional[timedelta]) -> Optional[str]:
     else:
         return f"{int(total_seconds / 604800)} weeks"
 
-async def get_or_create_page_knowledge(
+def get_or_create_page_knowledge(
     db: Session, 
     page_id: int, 
     knowledge_id: int
@@ -169,13 +255,13 @@ async def get_or_create_page_knowledge(
 
 # ==================== User Group Messages APIs ====================
 @router.post("/group-messages")
-async def create_group_message(
+def create_group_message(
     message_data: GroupMessageCreate,
     db: Session = Depends(get_db)
 ):
     """Create new group message with media support"""
     try:
-        image_binary = process_media_data(message_data.image_data_base64, message_data.message_type)
+        media_fields = media_fields_from_input(message_data.image_data_base64, message_data.message_type, process_media_data)
         
         db_message = models.CustomerTypeMessage(
             page_id=message_data.page_id,
@@ -183,7 +269,7 @@ async def create_group_message(
             message_type=message_data.message_type,
             content=message_data.content,
             display_order=message_data.display_order,
-            image_data=image_binary
+            **(media_fields or store_media(None, message_data.message_type))
         )
         
         db.add(db_message)
@@ -197,7 +283,7 @@ async def create_group_message(
             "message_type": db_message.message_type,
             "content": db_message.content,
             "display_order": db_message.display_order,
-            "has_image": bool(db_message.image_data),
+            "has_image": row_has_media(db_message),
             "created_at": db_message.created_at.isoformat() if db_message.created_at else None
         }
         
@@ -210,18 +296,14 @@ async def create_group_message(
 async def get_group_messages(
     page_id: int,
     group_id: int,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Get all messages for a user group"""
-    messages = db.query(models.CustomerTypeMessage).filter(
-        models.CustomerTypeMessage.page_id == page_id,
-        models.CustomerTypeMessage.customer_type_custom_id == group_id
-    ).order_by(models.CustomerTypeMessage.display_order).all()
-    
-    return [format_message_with_media(msg) for msg in messages]
+    result = await db.execute(group_messages_query(page_id, group_id))
+    return await format_messages_with_media(db, result.scalars().all())
 
 @router.put("/group-messages/{message_id}")
-async def update_group_message(
+def update_group_message(
     message_id: int,
     update_data: GroupMessageUpdate,
     db: Session = Depends(get_db)
@@ -237,17 +319,25 @@ async def update_group_message(
     # Update only provided fields
     update_dict = update_data.dict(exclude_unset=True)
     
+    old_digest = row_media_digest(message)
     if 'image_data_base64' in update_dict:
         image_data = update_dict.pop('image_data_base64')
-        message.image_data = process_media_data(image_data, update_dict.get('message_type', message.message_type))
+        message_type = update_dict.get('message_type', message.message_type)
+        media_fields = media_fields_from_input(image_data, message_type, process_media_data)
+        for key, value in (media_fields or {}).items():
+            setattr(message, key, value)
     
     for key, value in update_dict.items():
         setattr(message, key, value)
     
     if update_dict.get('message_type') == 'text':
-        message.image_data = None
+        for key, value in store_media(None, 'text').items():
+            setattr(message, key, value)
     
     db.commit()
+    # สื่อเปลี่ยน -> ลบ attachment_id ของสื่อเดิม
+    if old_digest and old_digest != message.media_digest:
+        invalidate_digest(old_digest)
     db.refresh(message)
     
     return {
@@ -255,11 +345,11 @@ async def update_group_message(
         "message_type": message.message_type,
         "content": message.content,
         "display_order": message.display_order,
-        "has_image": bool(message.image_data)
+        "has_image": row_has_media(message)
     }
 
 @router.delete("/group-messages/{message_id}")
-async def delete_group_message(
+def delete_group_message(
     message_id: int,
     db: Session = Depends(get_db)
 ):
@@ -271,14 +361,16 @@ async def delete_group_message(
     if not message:
         raise HTTPException(status_code=404, detail="Message not found")
     
+    old_digest = row_media_digest(message)
     db.delete(message)
     db.commit()
+    invalidate_digest(old_digest)
     
     return {"status": "success"}
 
 # ==================== Knowledge Group Messages APIs ====================
 @router.post("/knowledge-group-messages")
-async def create_knowledge_group_message(
+def create_knowledge_group_message(
     message_data: GroupMessageCreate,
     db: Session = Depends(get_db)
 ):
@@ -296,9 +388,9 @@ async def create_knowledge_group_message(
         if not page:
             raise HTTPException(status_code=404, detail=f"Page not found: {page_id_str}")
         
-        page_knowledge = await get_or_create_page_knowledge(db, page.ID, knowledge_id)
+        page_knowledge = get_or_create_page_knowledge(db, page.ID, knowledge_id)
         
-        image_binary = process_media_data(message_data.image_data_base64, message_data.message_type)
+        media_fields = media_fields_from_input(message_data.image_data_base64, message_data.message_type, process_media_data)
         
         db_message = models.CustomerTypeMessage(
             page_id=page.ID,
@@ -307,7 +399,7 @@ async def create_knowledge_group_message(
             message_type=message_data.message_type,
             content=message_data.content,
             display_order=message_data.display_order,
-            image_data=image_binary
+            **(media_fields or store_media(None, message_data.message_type))
         )
         
         db.add(db_message)
@@ -321,7 +413,7 @@ async def create_knowledge_group_message(
             "message_type": db_message.message_type,
             "content": db_message.content,
             "display_order": db_message.display_order,
-            "has_image": bool(db_message.image_data),
+            "has_image": row_has_media(db_message),
             "created_at": db_message.created_at.isoformat() if db_message.created_at else None
         }
         
@@ -334,37 +426,26 @@ async def create_knowledge_group_message(
 async def get_knowledge_group_messages(
     page_id: str,
     knowledge_id: Union[int, str],
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Get messages for knowledge group"""
     try:
         if isinstance(knowledge_id, str):
             knowledge_id = int(knowledge_id)
         
-        page = crud.get_page_by_page_id(db, page_id)
+        page = await async_crud.get_page_by_page_id(db, page_id)
         if not page:
             return []
         
-        page_knowledge = db.query(models.PageCustomerTypeKnowledge).filter(
-            models.PageCustomerTypeKnowledge.page_id == page.ID,
-            models.PageCustomerTypeKnowledge.customer_type_knowledge_id == knowledge_id
-        ).first()
-        
-        if not page_knowledge:
-            return []
-        
-        messages = db.query(models.CustomerTypeMessage).filter(
-            models.CustomerTypeMessage.page_customer_type_knowledge_id == page_knowledge.id
-        ).order_by(models.CustomerTypeMessage.display_order).all()
-        
-        return [format_message_with_media(msg) for msg in messages]
+        result = await db.execute(knowledge_group_messages_query(page.ID, knowledge_id))
+        return await format_messages_with_media(db, result.scalars().all())
         
     except Exception as e:
         logger.error(f"Error fetching knowledge group messages: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.delete("/knowledge-group-messages/{message_id}")
-async def delete_knowledge_group_message(
+def delete_knowledge_group_message(
     message_id: int,
     db: Session = Depends(get_db)
 ):
@@ -376,21 +457,23 @@ async def delete_knowledge_group_message(
     if not message:
         raise HTTPException(status_code=404, detail="Message not found")
     
+    old_digest = row_media_digest(message)
     db.delete(message)
     db.commit()
+    invalidate_digest(old_digest)
     
     return {"status": "success"}
 
 # ==================== Batch Operations ====================
 @router.post("/group-messages/batch")
-async def create_batch_group_messages(
+def create_batch_group_messages(
     messages: List[GroupMessageCreate],
     db: Session = Depends(get_db)
 ):
     """Create multiple messages in batch"""
     try:
         for msg_data in messages:
-            image_binary = process_media_data(msg_data.image_data_base64, msg_data.message_type)
+            media_fields = media_fields_from_input(msg_data.image_data_base64, msg_data.message_type, process_media_data)
             
             db_message = models.CustomerTypeMessage(
                 page_id=msg_data.page_id,
@@ -398,7 +481,7 @@ async def create_batch_group_messages(
                 message_type=msg_data.message_type,
                 content=msg_data.content,
                 display_order=msg_data.display_order,
-                image_data=image_binary
+                **(media_fields or store_media(None, msg_data.message_type))
             )
             db.add(db_message)
         
@@ -411,7 +494,7 @@ async def create_batch_group_messages(
         raise HTTPException(status_code=400, detail=str(e))
 
 @router.delete("/group-messages/{page_id}/{group_id}/all")
-async def delete_all_group_messages(
+def delete_all_group_messages(
     page_id: int,
     group_id: int,
     db: Session = Depends(get_db)
@@ -427,7 +510,7 @@ async def delete_all_group_messages(
 
 # ==================== Message Schedules APIs ====================
 @router.post("/message-schedules")
-async def create_message_schedule(
+def create_message_schedule(
     schedule_data: MessageScheduleCreate,
     db: Session = Depends(get_db)
 ):
@@ -467,41 +550,12 @@ async def create_message_schedule(
 async def get_group_schedules(
     page_id: int,
     group_id: str,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Get all schedules for a group"""
     try:
-        message_ids = []
-        
-        # Check if knowledge group
-        if group_id.startswith('knowledge_') or group_id.startswith('group_knowledge_'):
-            knowledge_id = int(group_id.replace('group_knowledge_', '').replace('knowledge_', ''))
-            
-            messages = db.query(models.CustomerTypeMessage).join(
-                models.PageCustomerTypeKnowledge,
-                models.CustomerTypeMessage.page_customer_type_knowledge_id == models.PageCustomerTypeKnowledge.id
-            ).filter(
-                models.PageCustomerTypeKnowledge.page_id == page_id,
-                models.PageCustomerTypeKnowledge.customer_type_knowledge_id == knowledge_id
-            ).all()
-            
-            message_ids = [msg.id for msg in messages]
-        else:
-            # User group
-            group_id_int = int(group_id)
-            messages = db.query(models.CustomerTypeMessage).filter(
-                models.CustomerTypeMessage.page_id == page_id,
-                models.CustomerTypeMessage.customer_type_custom_id == group_id_int
-            ).all()
-            
-            message_ids = [msg.id for msg in messages]
-        
-        if not message_ids:
-            return []
-        
-        schedules = db.query(models.MessageSchedule).filter(
-            models.MessageSchedule.customer_type_message_id.in_(message_ids)
-        ).all()
+        result = await db.execute(message_schedules_query(group_message_ids_query(page_id, group_id)))
+        schedules = result.scalars().all()
         
         return [
             {
@@ -522,7 +576,7 @@ async def get_group_schedules(
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.put("/message-schedules/{schedule_id}")
-async def update_message_schedule(
+def update_message_schedule(
     schedule_id: int,
     update_data: MessageScheduleUpdate,
     db: Session = Depends(get_db)
@@ -560,7 +614,7 @@ async def update_message_schedule(
     }
 
 @router.delete("/message-schedules/{schedule_id}")
-async def delete_message_schedule(
+def delete_message_schedule(
     schedule_id: int,
     db: Session = Depends(get_db)
 ):
@@ -578,7 +632,7 @@ async def delete_message_schedule(
     return {"status": "success"}
 
 @router.delete("/message-schedules/knowledge-group/{page_id}/{knowledge_id}")
-async def delete_knowledge_group_schedules(
+def delete_knowledge_group_schedules(
     page_id: str,
     knowledge_id: int,
     db: Session = Depends(get_db)
@@ -625,7 +679,7 @@ async def delete_knowledge_group_schedules(
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.delete("/group-schedule/{page_id}/{group_id}")
-async def delete_group_schedule(
+def delete_group_schedule(
     page_id: int,
     group_id: int,
     db: Session = Depends(get_db)
@@ -662,7 +716,7 @@ async def delete_group_schedule(
         raise HTTPException(status_code=400, detail=str(e))
 
 @router.delete("/message-schedules/delete-by-group")
-async def delete_schedules_by_group(
+def delete_schedules_by_group(
     page_id: str,
     group_id: str,
     db: Session = Depends(get_db)
@@ -722,7 +776,7 @@ async def delete_schedules_by_group(
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.post("/message-schedules/batch")
-async def create_batch_schedules(
+def create_batch_schedules(
     schedules: List[MessageScheduleCreate],
     db: Session = Depends(get_db)
 ):
@@ -749,7 +803,7 @@ async def create_batch_schedules(
         raise HTTPException(status_code=400, detail=str(e))
 
 @router.post("/group-schedule/{page_id}/{group_id}")
-async def create_group_schedule(
+def create_group_schedule(
     page_id: int,
     group_id: int,
     schedule_data: MessageScheduleCreate,
@@ -801,46 +855,54 @@ async def create_group_schedule(
 @router.get("/group-schedule-summary/{page_id}")
 async def get_group_schedule_summaries(
     page_id: int,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Get schedule summaries for each group"""
     try:
         # Get all groups
-        groups = db.query(models.CustomerTypeCustom).filter(
-            models.CustomerTypeCustom.page_id == page_id,
-            models.CustomerTypeCustom.is_active == True
-        ).all()
+        groups = (await db.execute(
+            select(models.CustomerTypeCustom).where(
+                models.CustomerTypeCustom.page_id == page_id,
+                models.CustomerTypeCustom.is_active == True
+            )
+        )).scalars().all()
+        if not groups:
+            return []
         
-        summaries = []
+        # Get group messages (ทุกกลุ่มใน query เดียว)
+        messages_by_group: Dict[int, List[int]] = {}
+        message_rows = await db.execute(
+            schedule_summary_messages_query(page_id, [group.id for group in groups])
+        )
+        for group_id, message_id in message_rows:
+            messages_by_group.setdefault(group_id, []).append(message_id)
         
+        # Get first schedule of each group's first message as representative
+        first_message_ids = [ids[0] for ids in messages_by_group.values()]
+        schedules: Dict[int, models.MessageSchedule] = {}
+        if first_message_ids:
+            schedule_rows = await db.execute(message_schedules_query(first_message_ids))
+            for schedule in schedule_rows.scalars():
+                schedules.setdefault(schedule.customer_type_message_id, schedule)
+        
+        summaries = []
         for group in groups:
-            # Get group messages
-            messages = db.query(models.CustomerTypeMessage).filter(
-                models.CustomerTypeMessage.page_id == page_id,
-                models.CustomerTypeMessage.customer_type_custom_id == group.id
-            ).all()
-            
-            if messages:
-                # Get first schedule as representative
-                first_message_id = messages[0].id
-                schedule = db.query(models.MessageSchedule).filter(
-                    models.MessageSchedule.customer_type_message_id == first_message_id
-                ).first()
-                
-                if schedule:
-                    summaries.append({
-                        "group_id": group.id,
-                        "group_name": group.type_name,
-                        "message_count": len(messages),
-                        "send_type": schedule.send_type,
-                        "scheduled_at": schedule.scheduled_at,
-                        "send_after_inactive": format_interval_to_string(schedule.send_after_inactive),
-                        "frequency": schedule.frequency,
-                        "created_at": schedule.created_at
-                    })
+            messages = messages_by_group.get(group.id)
+            schedule = schedules.get(messages[0]) if messages else None
+            if schedule:
+                summaries.append({
+                    "group_id": group.id,
+                    "group_name": group.type_name,
+                    "message_count": len(messages),
+                    "send_type": schedule.send_type,
+                    "scheduled_at": schedule.scheduled_at,
+                    "send_after_inactive": format_interval_to_string(schedule.send_after_inactive),
+                    "frequency": schedule.frequency,
+                    "created_at": schedule.created_at
+                })
         
         return summaries
         
     except Exception as e:
         logger.error(f"Error getting group schedule summaries: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=str(e))
@@ -0,0 +1,102 @@
+"""
+Media Component
+จัดการ:
+- ให้บริการไฟล์สื่อจาก blob store ด้วย URL ตาม digest (/media/{digest})
+- รองรับ HTTP Range (เล่นวิดีโอ/seek โดยไม่ต้องโหลดทั้งไฟล์)
+- ETag = digest และ cache แบบ immutable (เนื้อหาของ URL ไม่มีวันเปลี่ยน)
+"""
+
+from fastapi import APIRouter, HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
+from typing import Optional, Tuple
+import os
+import re
+import logging
+
+from app.utils.blob_store import blob_path, guess_mime
+
+router = APIRouter()
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 256 * 1024
+DIGEST_RE = re.compile(r"^[0-9a-f]{64}$")
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+def parse_range(range_header: str, size: int) -> Optional[Tuple[int, int]]:
+    """แปลง Range header (bytes=start-end) เป็น (start, end) แบบ inclusive - รองรับช่วงเดียว"""
+    match = re.match(r"^bytes=(\d*)-(\d*)$", range_header.strip())
+    if not match or (not match.group(1) and not match.group(2)):
+        return None
+
+    start_str, end_str = match.groups()
+    if start_str:
+        start = int(start_str)
+        end = int(end_str) if end_str else size - 1
+    else:
+        # bytes=-N = N bytes สุดท้าย
+        start = max(0, size - int(end_str))
+        end = size - 1
+
+    end = min(end, size - 1)
+    if start > end or start >= size:
+        raise HTTPException(status_code=416, detail="Requested range not satisfiable",
+                            headers={"Content-Range": f"bytes */{size}"})
+    return start, end
+
+
+def iter_file(path: str, start: int, end: int):
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def media_response(request: Request, digest: str, mime: Optional[str] = None) -> Response:
+    """สร้าง response ของไฟล์ใน blob store (ใช้ร่วมกับ endpoint เดิมที่อ้างอิง message id)"""
+    if not DIGEST_RE.match(digest):
+        raise HTTPException(status_code=404, detail="Media not found")
+
+    path = blob_path(digest)
+    if not os.path.isfile(path):
+        raise HTTPException(status_code=404, detail="Media not found")
+
+    etag = f'"{digest}"'
+    headers = {"ETag": etag, "Cache-Control": CACHE_CONTROL, "Accept-Ranges": "bytes"}
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and (if_none_match.strip() == "*" or etag in if_none_match):
+        return Response(status_code=304, headers=headers)
+
+    size = os.path.getsize(path)
+    if not mime:
+        with open(path, "rb") as f:
+            mime = guess_mime(f.read(16), "")
+
+    start, end, status_code = 0, size - 1, 200
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and size > 0 and (not if_range or if_range.strip() == etag):
+        byte_range = parse_range(range_header, size)
+        if byte_range:
+            start, end = byte_range
+            status_code = 206
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+
+    headers["Content-Length"] = str(end - start + 1 if size else 0)
+
+    if request.method == "HEAD":
+        return Response(status_code=status_code, headers=headers, media_type=mime)
+
+    return StreamingResponse(iter_file(path, start, end), status_code=status_code, headers=headers, media_type=mime)
+
+
+@router.api_route("/media/{digest}", methods=["GET", "HEAD"])
+def get_media(digest: str, request: Request):
+    """ดึงไฟล์สื่อตาม digest (รองรับ Range / ETag)"""
+    return media_response(request, digest)
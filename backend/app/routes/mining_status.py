@@ -5,13 +5,13 @@ Mining Status Management API
 
 from fastapi import APIRouter, Depends, HTTPException
 from sqlalchemy.orm import Session
-from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
 from datetime import datetime
-from typing import List, Optional, Dict, Any
+from typing import List, Optional
 from pydantic import BaseModel
 
-from app.database.database import get_db
-from app.database import models, crud
+from app.database.database import get_async_read_db
+from app.database import models, async_crud
 from app.celery_task.mining_tasks import (
     update_mining_status_task,
     reset_mining_status_task,
@@ -56,38 +56,11 @@ def update_customer_mining_status(
     db.add(new_status)
     return new_status
 
-def get_page_mining_statuses(db: Session, page_id: int) -> Dict[str, Dict[str, Any]]:
-    """Get mining statuses for all customers in a page"""
-    query = """
-        SELECT 
-            c.customer_psid,
-            ms.status,
-            ms.note,
-            ms.created_at
-        FROM fb_customers c
-        LEFT JOIN fb_customer_mining_status ms ON c.id = ms.customer_id
-        WHERE c.page_id = :page_id
-        ORDER BY c.customer_psid
-    """
-    
-    result = db.execute(text(query), {"page_id": page_id})
-    
-    statuses = {}
-    for row in result:
-        statuses[row[0]] = {
-            "status": row[1] or "ยังไม่ขุด",
-            "note": row[2],
-            "created_at": row[3]
-        }
-    
-    return statuses
-
 # =============== API Endpoints ===============
 @router.post("/mining-status/update/{page_id}")
 async def update_mining_status(
     page_id: str,
-    status_update: MiningStatusUpdate,
-    db: Session = Depends(get_db)
+    status_update: MiningStatusUpdate
 ):
     """Trigger Celery task เพื่ออัปเดตสถานะลูกค้า"""
     try:
@@ -112,15 +85,15 @@ async def update_mining_status(
 @router.get("/mining-status/{page_id}")
 async def get_mining_statuses(
     page_id: str,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_read_db)
 ):
     """Get current mining statuses for all customers in a page"""
     try:
-        page = crud.get_page_by_page_id(db, page_id)
+        page = await async_crud.get_page_by_page_id(db, page_id)
         if not page:
             raise HTTPException(status_code=404, detail="Page not found")
         
-        statuses = get_page_mining_statuses(db, page.ID)
+        statuses = await async_crud.get_page_mining_statuses(db, page.ID)
         
         return {
             "success": True,
@@ -134,8 +107,7 @@ async def get_mining_statuses(
 @router.post("/mining-status/reset/{page_id}")
 async def reset_mining_status(
     page_id: str,
-    customer_psids: List[str],
-    db: Session = Depends(get_db)
+    customer_psids: List[str]
 ):
     """Trigger Celery task เพื่อรีเซ็ตสถานะลูกค้า"""
     try:
@@ -147,8 +119,7 @@ async def reset_mining_status(
 
 @router.delete("/mining-status/clean-history/{page_id}")
 async def clean_mining_history(
-    page_id: str,
-    db: Session = Depends(get_db)
+    page_id: str
 ):
     """Trigger Celery task เพื่อล้าง record เก่าของสถานะ"""
     try:
@@ -1,15 +1,22 @@
-from fastapi import APIRouter, Request, Depends, BackgroundTasks
-from fastapi.responses import PlainTextResponse
+from fastapi import APIRouter, Request, BackgroundTasks
+from fastapi.responses import PlainTextResponse, JSONResponse
 from app.database import crud, models
-from app.database.database import get_db
 from sqlalchemy.orm import Session
 from datetime import datetime
 import os
+import hmac
+import hashlib
+import json
 from app.service.facebook_api import fb_get
+from app.service.webhook_ingest import (
+    enqueue_webhook, dedupe_webhook, release_dedupe_keys, dedupe_stats, WEBHOOK_STREAM
+)
+from app.utils.redis_helper import r
+from app.utils.lookup_cache import cache_stats
+from app.config import FB_APP_SECRET
 import logging
 import asyncio
 from typing import Dict, List, Optional, Any
-from app.celery_task.webhook_task import sync_new_user_data_task
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
@@ -18,6 +25,16 @@ logger = logging.getLogger(__name__)
 new_user_notifications: Dict[str, List[Dict[str, Any]]] = {}
 
 # =============== Helper Functions ===============
+def verify_signature(raw_body: bytes, signature_header: Optional[str]) -> bool:
+    """ตรวจ X-Hub-Signature-256 (HMAC-SHA256 ของ body ด้วย App Secret)"""
+    if not FB_APP_SECRET:
+        # ยังไม่ได้ตั้ง App Secret (dev) - ข้ามการตรวจ
+        return True
+    if not signature_header or not signature_header.startswith("sha256="):
+        return False
+    expected = hmac.new(FB_APP_SECRET.encode(), raw_body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature_header[len("sha256="):])
+
 def cleanup_old_notifications(page_id: str):
     """Remove notifications older than 24 hours"""
     if page_id not in new_user_notifications:
@@ -158,7 +175,7 @@ async def send_sse_update(
 ):
     """Send SSE update for customer changes"""
     try:
-        from app.routes.facebook.sse import customer_type_update_queue
+        from app.service.sse_broker import publish
         
         update_data = {
             'page_id': page_id,
@@ -171,7 +188,7 @@ async def send_sse_update(
             'timestamp': datetime.now().isoformat()
         }
         
-        await customer_type_update_queue.put(update_data)
+        publish(page_id, update_data)
         logger.info(f"📡 Sent SSE update for {action}: {sender_id}")
         
     except Exception as e:
@@ -188,40 +205,53 @@ async def verify_webhook(request: Request):
     return PlainTextResponse(content="Verification failed", status_code=403)
 
 @router.post("/webhook")
-async def webhook_post(request: Request, db: Session = Depends(get_db)):
-    body = await request.json()
-
-    for entry in body.get("entry", []):
-        page_id = entry.get("id")
-        if not page_id:
-            continue
-
-        page = crud.get_page_by_page_id(db, page_id)
-        if not page:
-            continue
-
-        for msg_event in entry.get("messaging", []):
-            sender_id = msg_event["sender"]["id"]
-            if sender_id == page_id:
-                continue
+async def webhook_post(request: Request):
+    """
+    รับ webhook แล้วตอบกลับทันที
+    - ตรวจ signature + parse JSON แบบเบาๆ เท่านั้น
+    - event ที่ Facebook ส่งซ้ำถูกตัดทิ้งก่อนเข้า stream
+    - งานกับ DB ทำใน webhook ingest consumer (app/service/webhook_ingest.py)
+    """
+    raw_body = await request.body()
 
-            try:
-                existing_customer = crud.get_customer_by_psid(db, page.ID, sender_id)
+    if not verify_signature(raw_body, request.headers.get("x-hub-signature-256")):
+        logger.warning("⚠️ Invalid webhook signature")
+        return PlainTextResponse("Invalid signature", status_code=403)
 
-                if not existing_customer:
-                    # ✅ ใช้ Celery แทน BackgroundTasks
-                    logger.info(f"🆕 New user detected: {sender_id} in page {page.page_name}")
-                    sync_new_user_data_task.delay(page_id, sender_id, page.ID)
+    try:
+        body = json.loads(raw_body)
+    except ValueError:
+        return PlainTextResponse("Invalid JSON", status_code=400)
 
-                else:
-                    crud.update_customer_interaction(db, page.ID, sender_id)
-                    logger.info(f"📝 Updated interaction for: {existing_customer.name}")
+    if body.get("object") not in (None, "page") or not body.get("entry"):
+        return PlainTextResponse("EVENT_RECEIVED", status_code=200)
 
-            except Exception as e:
-                logger.error(f"Error processing webhook: {e}")
+    claimed_keys = []
+    try:
+        new_body, claimed_keys = dedupe_webhook(body)
+        if new_body is None:
+            return PlainTextResponse("EVENT_RECEIVED", status_code=200)
+        enqueue_webhook(raw_body.decode("utf-8") if new_body is body else json.dumps(new_body))
+    except Exception as e:
+        # ให้ Facebook ส่งซ้ำภายหลังแทนการทิ้ง event
+        logger.error(f"❌ Error enqueueing webhook: {e}")
+        try:
+            release_dedupe_keys(claimed_keys)
+        except Exception:
+            pass
+        return PlainTextResponse("Temporarily unavailable", status_code=503)
 
     return PlainTextResponse("EVENT_RECEIVED", status_code=200)
 
+@router.get("/webhook/metrics")
+async def webhook_metrics():
+    """สถิติ webhook: อัตรา event ซ้ำที่ถูกตัดทิ้ง, จำนวน event ที่รอใน stream และ lookup cache ของโปรเซสนี้"""
+    try:
+        return {**dedupe_stats(), "stream_length": r.xlen(WEBHOOK_STREAM), "lookup_cache": cache_stats()}
+    except Exception as e:
+        logger.error(f"❌ Error reading webhook metrics: {e}")
+        return JSONResponse(status_code=500, content={"error": str(e)})
+
 @router.get("/new-user-notifications/{page_id}")
 async def get_new_user_notifications(page_id: str):
     """Get new user notifications for the last 24 hours"""
@@ -0,0 +1,223 @@
+"""
+Attachment Cache
+อัปโหลดสื่อ (รูป/วิดีโอ) ไป Facebook ครั้งเดียวผ่าน Attachment Upload API แล้วส่งด้วย attachment_id
+- key ของ cache = (page_id, sha256 ของไฟล์) -> สื่อเปลี่ยน = key ใหม่อัตโนมัติ
+- เก็บ attachment_id ใน Redis: fb_attachment:{page_id}:{digest}
+- ถ้า Facebook แจ้งว่า attachment_id ใช้ไม่ได้ จะลบ cache แล้วอัปโหลดใหม่ 1 ครั้ง
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from typing import Callable, Dict, Optional, Tuple
+
+import requests
+
+from app.service.facebook_api import GRAPH_TIMEOUT, GRAPH_UPLOAD_TIMEOUT
+from app.utils.redis_helper import r
+
+logger = logging.getLogger(__name__)
+
+FB_API_URL = "https://graph.facebook.com/v14.0"
+ATTACHMENT_CACHE_TTL = int(os.getenv("ATTACHMENT_CACHE_TTL", 60 * 60 * 24 * 30))
+UPLOAD_LOCK_TTL = 120
+
+RELEASE_LOCK_LUA = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+_release_lock = r.register_script(RELEASE_LOCK_LUA)
+
+MIME_TYPES = {"image": "image/jpeg", "video": "video/mp4", "audio": "audio/mpeg", "file": "application/octet-stream"}
+
+# digest ของไฟล์บนดิสก์ ไม่ต้อง hash ไฟล์ใหญ่ซ้ำทุกผู้รับ: path -> (mtime, size, digest)
+_file_digests: Dict[str, Tuple[float, int, str]] = {}
+_file_digests_lock = threading.Lock()
+
+
+def media_digest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def file_digest(path: str) -> str:
+    """sha256 ของไฟล์ - cache ตาม mtime/size จึงคำนวณใหม่เมื่อไฟล์เปลี่ยนเท่านั้น"""
+    stat = os.stat(path)
+    with _file_digests_lock:
+        cached = _file_digests.get(path)
+        if cached and cached[0] == stat.st_mtime and cached[1] == stat.st_size:
+            return cached[2]
+
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(block)
+    digest = sha.hexdigest()
+
+    with _file_digests_lock:
+        _file_digests[path] = (stat.st_mtime, stat.st_size, digest)
+    return digest
+
+
+def _cache_key(page_id: str, digest: str) -> str:
+    return f"fb_attachment:{page_id}:{digest}"
+
+
+def _index_key(digest: str) -> str:
+    # เพจทั้งหมดที่มี attachment ของสื่อนี้ (ใช้ตอน invalidate)
+    return f"fb_attachment_pages:{digest}"
+
+
+def upload_attachment(media_type: str, filename: str, fileobj, access_token: str) -> Dict:
+    """อัปโหลดสื่อไป me/message_attachments (is_reusable) - คืนค่า response ของ Graph"""
+    url = f"{FB_API_URL}/me/message_attachments"
+    data = {
+        "message": json.dumps({"attachment": {"type": media_type, "payload": {"is_reusable": True}}})
+    }
+    files = {"filedata": (filename, fileobj, MIME_TYPES.get(media_type, MIME_TYPES["file"]))}
+    response = requests.post(url, params={"access_token": access_token}, data=data, files=files, timeout=GRAPH_UPLOAD_TIMEOUT)
+    return response.json()
+
+
+def get_attachment_id(page_id: str, digest: str, media_type: str, access_token: str,
+                      open_media: Callable[[], Tuple[str, object]]) -> Optional[str]:
+    """คืนค่า attachment_id จาก cache หรืออัปโหลดใหม่ (ครั้งเดียวต่อเพจต่อสื่อ)
+
+    open_media: คืนค่า (filename, file object/bytes) - ถูกเรียกเฉพาะตอนต้องอัปโหลด
+    """
+    key = _cache_key(page_id, digest)
+    attachment_id = r.get(key)
+    if attachment_id:
+        return attachment_id
+
+    # กันหลาย worker อัปโหลดไฟล์เดียวกันพร้อมกัน - lock เก็บ token ของผู้ถือ
+    lock_key = f"{key}:lock"
+    token = uuid.uuid4().hex
+    deadline = time.monotonic() + UPLOAD_LOCK_TTL
+    while not r.set(lock_key, token, nx=True, ex=UPLOAD_LOCK_TTL):
+        # อีก worker กำลังอัปโหลด -> รอผล (lock หาย = ผู้ถือเสร็จหรือล้มเหลว -> ลองยึด lock ใหม่)
+        time.sleep(1)
+        attachment_id = r.get(key)
+        if attachment_id:
+            return attachment_id
+        if time.monotonic() >= deadline:
+            logger.warning(f"⚠️ Timed out waiting for attachment upload lock {lock_key}")
+            return None
+
+    try:
+        # ผู้ถือ lock ก่อนหน้าอาจอัปโหลดเสร็จระหว่างที่รอ
+        attachment_id = r.get(key)
+        if attachment_id:
+            return attachment_id
+
+        filename, media = open_media()
+        try:
+            result = upload_attachment(media_type, filename, media, access_token)
+        finally:
+            if hasattr(media, 'close'):
+                media.close()
+
+        attachment_id = result.get('attachment_id')
+        if not attachment_id:
+            logger.error(f"❌ Attachment upload failed for page {page_id}: {result.get('error')}")
+            return None
+
+        r.setex(key, ATTACHMENT_CACHE_TTL, attachment_id)
+        r.sadd(_index_key(digest), page_id)
+        r.expire(_index_key(digest), ATTACHMENT_CACHE_TTL)
+        logger.info(f"📎 Uploaded {media_type} {digest[:12]} for page {page_id}: attachment_id={attachment_id}")
+        return attachment_id
+    finally:
+        # ลบเฉพาะ lock ของตัวเอง (lock อาจหมดอายุแล้วถูก worker อื่นยึดไป)
+        _release_lock(keys=[lock_key], args=[token])
+
+
+def invalidate(page_id: str, digest: str):
+    r.delete(_cache_key(page_id, digest))
+    r.srem(_index_key(digest), page_id)
+
+
+def invalidate_media(data: Optional[bytes]):
+    """ลบ attachment_id ของสื่อนี้ทุกเพจ - เรียกเมื่อสื่อถูกแก้ไข/ลบ"""
+    if not data:
+        return
+    invalidate_digest(media_digest(data))
+
+
+def invalidate_digest(digest: Optional[str]):
+    if not digest:
+        return
+    pages = r.smembers(_index_key(digest))
+    if pages:
+        r.delete(*[_cache_key(page_id, digest) for page_id in pages])
+    r.delete(_index_key(digest))
+
+
+def _is_invalid_attachment(result: Dict) -> bool:
+    error = result.get('error') or {}
+    # attachment_id หมดอายุ/ไม่ใช่ของเพจนี้ -> Graph ตอบ 100 (invalid parameter)
+    return error.get('code') == 100 and 'attachment' in str(error.get('message', '')).lower()
+
+
+def send_attachment(psid: str, media_type: str, attachment_id: str, access_token: str,
+                    message_tag: Optional[str] = "CONFIRMED_EVENT_UPDATE") -> Dict:
+    payload = {
+        "recipient": {"id": psid},
+        "message": {"attachment": {"type": media_type, "payload": {"attachment_id": attachment_id}}},
+    }
+    if message_tag:
+        payload["messaging_type"] = "MESSAGE_TAG"
+        payload["tag"] = message_tag
+    response = requests.post(f"{FB_API_URL}/me/messages", params={"access_token": access_token}, json=payload, timeout=GRAPH_TIMEOUT)
+    return response.json()
+
+
+def _send_cached(page_id: str, psid: str, media_type: str, digest: str, access_token: str,
+                 open_media: Callable[[], Tuple[str, object]], message_tag: Optional[str]) -> Dict:
+    for attempt in range(2):
+        attachment_id = get_attachment_id(page_id, digest, media_type, access_token, open_media)
+        if not attachment_id:
+            return {"error": {"message": f"Cannot upload {media_type} attachment"}}
+
+        result = send_attachment(psid, media_type, attachment_id, access_token, message_tag)
+        if attempt == 0 and _is_invalid_attachment(result):
+            logger.warning(f"⚠️ attachment_id {attachment_id} rejected for page {page_id}, re-uploading")
+            invalidate(page_id, digest)
+            continue
+        return result
+    return result
+
+
+def send_media_bytes(page_id: str, psid: str, media_type: str, data: bytes, access_token: str,
+                     message_tag: Optional[str] = "CONFIRMED_EVENT_UPDATE") -> Dict:
+    """ส่งสื่อจาก binary (เช่น image_data ใน DB) ผ่าน attachment_id"""
+    filename = "image.jpg" if media_type == "image" else "video.mp4"
+    return _send_cached(page_id, psid, media_type, media_digest(data), access_token,
+                        lambda: (filename, data), message_tag)
+
+
+def send_media_digest(page_id: str, psid: str, media_type: str, digest: str,
+                      load_media: Callable[[], Optional[bytes]], access_token: str,
+                      message_tag: Optional[str] = "CONFIRMED_EVENT_UPDATE") -> Dict:
+    """ส่งสื่อจาก digest - โหลด bytes เฉพาะตอนที่ยังไม่มี attachment_id ใน cache"""
+    filename = "image.jpg" if media_type == "image" else "video.mp4"
+
+    def open_media():
+        data = load_media()
+        if data is None:
+            raise ValueError(f"Media {digest[:12]} expired or not found")
+        return filename, data
+
+    return _send_cached(page_id, psid, media_type, digest, access_token, open_media, message_tag)
+
+
+def send_media_file(page_id: str, psid: str, media_type: str, path: str, access_token: str,
+                    message_tag: Optional[str] = "CONFIRMED_EVENT_UPDATE") -> Dict:
+    """ส่งสื่อจากไฟล์บนดิสก์ผ่าน attachment_id"""
+    return _send_cached(page_id, psid, media_type, file_digest(path), access_token,
+                        lambda: (os.path.basename(path), open(path, 'rb')), message_tag)
@@ -427,7 +427,7 @@ class AutoSyncService:
                                      source_type: str):
         """ส่ง SSE notification สำหรับ customer ใหม่"""
         try:
-            from app.routes.facebook.sse import customer_type_update_queue
+            from app.service.sse_broker import publish
             
             update_data = {
                 'page_id': page_id,
@@ -440,7 +440,7 @@ class AutoSyncService:
                 'source_type': source_type
             }
             
-            await customer_type_update_queue.put(update_data)
+            publish(page_id, update_data)
             logger.info(f"📡 Sent SSE new user notification: {user_name} ({source_type})")
             
         except Exception as e:
@@ -482,7 +482,7 @@ class AutoSyncService:
                                       customer_name: str):
         """ส่ง SSE notification สำหรับการอัพเดท mining status"""
         try:
-            from app.routes.facebook.sse import customer_type_update_queue
+            from app.service.sse_broker import publish
             
             update_data = {
                 'page_id': page_id,
@@ -493,7 +493,7 @@ class AutoSyncService:
                 'timestamp': datetime.now().isoformat()
             }
             
-            await customer_type_update_queue.put(update_data)
+            publish(page_id, update_data)
             logger.info(f"📡 Sent SSE mining status update for: {customer_name}")
             
         except Exception as e:
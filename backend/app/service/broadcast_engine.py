@@ -0,0 +1,479 @@
+"""
+Broadcast Engine
+ระบบส่งข้อความหาลูกค้าจำนวนมากแบบ concurrent
+- จำกัด concurrency ต่อเพจตาม rate budget (token bucket)
+- retry ต่อผู้รับ โดยแยกประเภท error จาก Graph API
+- รายงาน progress ของแต่ละ job
+- ยกเลิก job ที่กำลังทำงานได้
+- กันส่งซ้ำด้วย send ledger (claim ก่อนส่งทุกข้อความ)
+"""
+
+import asyncio
+import logging
+import os
+import random
+import time
+import uuid
+import weakref
+from collections import deque
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import requests
+
+from app.database import models
+from app.database.database import SessionLocal
+from app.service.facebook_api import send_message, send_image_binary, send_video_binary
+from app.service import send_ledger
+from app.utils import lookup_cache
+
+logger = logging.getLogger(__name__)
+
+# จำนวนข้อความต่อวินาทีต่อเพจ และ concurrency สูงสุดต่อเพจ
+BROADCAST_RATE_PER_PAGE = float(os.getenv("BROADCAST_RATE_PER_PAGE", 10))
+BROADCAST_MAX_CONCURRENCY = int(os.getenv("BROADCAST_MAX_CONCURRENCY", 8))
+BROADCAST_MAX_RETRIES = int(os.getenv("BROADCAST_MAX_RETRIES", 3))
+BROADCAST_JOB_HISTORY = int(os.getenv("BROADCAST_JOB_HISTORY", 100))
+
+# ประเภทของ error
+ERROR_RATE_LIMITED = "rate_limited"
+ERROR_TRANSIENT = "transient"
+ERROR_PERMANENT = "permanent"
+ERROR_AUTH = "auth"
+ERROR_UNKNOWN = "unknown"  # request อาจถึง Facebook แล้ว - ห้าม retry
+SKIPPED = "skipped"  # ledger บันทึกว่าส่งแล้ว
+
+# Graph API error codes
+RATE_LIMIT_CODES = {4, 17, 32, 613, 80006}
+TRANSIENT_CODES = {1, 2}
+AUTH_CODES = {102, 190}
+
+
+def classify_send_error(result: Optional[Dict] = None, exc: Exception = None) -> str:
+    """แยกประเภท error จากผลลัพธ์ของ Graph API หรือ exception"""
+    if exc is not None:
+        if isinstance(exc, (requests.Timeout, requests.ConnectionError)):
+            return ERROR_TRANSIENT
+        return ERROR_PERMANENT
+
+    error = (result or {}).get("error") or {}
+    code = error.get("code")
+
+    if code in RATE_LIMIT_CODES:
+        return ERROR_RATE_LIMITED
+    if code in AUTH_CODES:
+        return ERROR_AUTH
+    if code in TRANSIENT_CODES or error.get("is_transient"):
+        return ERROR_TRANSIENT
+    # เช่น 10 (นอก 24 ชม.), 551 (user ไม่พร้อมรับ), 100 (PSID ไม่ถูกต้อง)
+    return ERROR_PERMANENT
+
+
+class PageRateLimiter:
+    """Token bucket ต่อเพจ - ใช้ร่วมกันทุก job ของเพจเดียวกัน"""
+
+    def __init__(self, rate_per_sec: float):
+        self.rate = max(rate_per_sec, 0.1)
+        self.capacity = max(self.rate, 1.0)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        """รอจนกว่าจะมี token สำหรับส่ง 1 ข้อความ"""
+        while True:
+            async with self.lock:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                else:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                    self.updated_at = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            await asyncio.sleep(wait)
+
+    def penalize(self, seconds: float):
+        """หยุดส่งทั้งเพจชั่วคราวเมื่อโดน rate limit"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+
+class BroadcastJob:
+    """สถานะของการส่งข้อความ 1 รอบ"""
+
+    def __init__(self, page_id: str, psids: List[str], schedule_id: Optional[str] = None, group_type: str = ""):
+        self.id = uuid.uuid4().hex
+        self.page_id = page_id
+        self.schedule_id = schedule_id
+        self.group_type = group_type
+        self.total = len(psids)
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.skipped = 0
+        self.campaign_key = None
+        self.status = "pending"  # pending, running, completed, cancelled, aborted
+        self.error = None
+        self.cancelled = False
+        self.succeeded_psids: List[str] = []
+        self.processed_psids: List[str] = []
+        self.failures: Dict[str, str] = {}
+        self.created_at = datetime.now()
+        self.started_at = None
+        self.finished_at = None
+
+    @property
+    def done(self) -> int:
+        return self.sent + self.failed + self.skipped
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "job_id": self.id,
+            "page_id": self.page_id,
+            "schedule_id": self.schedule_id,
+            "group_type": self.group_type,
+            "status": self.status,
+            "total": self.total,
+            "sent": self.sent,
+            "failed": self.failed,
+            "retried": self.retried,
+            "skipped": self.skipped,
+            "progress": round(self.done / self.total * 100, 1) if self.total else 100.0,
+            "error": self.error,
+            "failures": dict(list(self.failures.items())[:50]),
+            "created_at": self.created_at.isoformat(),
+            "started_at": self.started_at.isoformat() if self.started_at else None,
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+        }
+
+
+class BroadcastEngine:
+    def __init__(self):
+        self.jobs: Dict[str, BroadcastJob] = {}
+        self.finished_jobs: deque = deque(maxlen=BROADCAST_JOB_HISTORY)
+        self.loop_states = weakref.WeakKeyDictionary()
+
+    # ==================== Job registry ====================
+    def get_job(self, job_id: str) -> Optional[Dict[str, Any]]:
+        job = self.jobs.get(job_id) or next((j for j in self.finished_jobs if j.id == job_id), None)
+        return job.to_dict() if job else None
+
+    def list_jobs(self, page_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        jobs = list(self.jobs.values()) + list(self.finished_jobs)
+        return [j.to_dict() for j in jobs if page_id is None or j.page_id == page_id]
+
+    def cancel(self, job_id: str) -> bool:
+        """ยกเลิก job - ผู้รับที่ยังไม่ได้ส่งจะถูกข้าม"""
+        job = self.jobs.get(job_id)
+        if not job:
+            return False
+        job.cancelled = True
+        logger.info(f"🛑 Cancel requested for broadcast job {job_id}")
+        return True
+
+    def cancel_schedule(self, schedule_id: str) -> int:
+        """ยกเลิกทุก job ของ schedule"""
+        count = 0
+        for job in self.jobs.values():
+            if job.schedule_id == str(schedule_id):
+                job.cancelled = True
+                count += 1
+        return count
+
+    # ==================== Rate budget ====================
+    def _loop_state(self) -> Dict[str, Dict]:
+        # limiter/semaphore ผูกกับ event loop ที่สร้าง (scheduler thread, celery task) จึงแยกตาม loop
+        loop = asyncio.get_running_loop()
+        state = self.loop_states.get(loop)
+        if state is None:
+            state = {"limiters": {}, "semaphores": {}}
+            self.loop_states[loop] = state
+        return state
+
+    def _get_limiter(self, page_id: str, rate_per_sec: Optional[float] = None) -> PageRateLimiter:
+        limiters = self._loop_state()["limiters"]
+        if page_id not in limiters:
+            limiters[page_id] = PageRateLimiter(rate_per_sec or BROADCAST_RATE_PER_PAGE)
+        return limiters[page_id]
+
+    def _get_semaphore(self, page_id: str, rate_per_sec: Optional[float] = None) -> asyncio.Semaphore:
+        semaphores = self._loop_state()["semaphores"]
+        if page_id not in semaphores:
+            # concurrency ตาม rate budget แต่ไม่เกิน max
+            concurrency = max(1, min(BROADCAST_MAX_CONCURRENCY, int(rate_per_sec or BROADCAST_RATE_PER_PAGE)))
+            semaphores[page_id] = asyncio.Semaphore(concurrency)
+        return semaphores[page_id]
+
+    # ==================== Sending ====================
+    def _build_senders(self, page_id: str, messages: List[Dict], access_token: str) -> List[Tuple[str, Callable[[str], Dict]]]:
+        """เตรียมฟังก์ชันส่งของแต่ละข้อความครั้งเดียวต่อ job - คืนค่า (message_key, sender)"""
+        from app.config import image_dir, vid_dir
+
+        senders = []
+        for message in sorted(messages, key=lambda x: x.get('order', 0)):
+            message_type = message.get('type', 'text')
+            content = message.get('content', '')
+
+            msg_key = send_ledger.message_key(message)
+
+            if message_type == 'text':
+                senders.append((msg_key, lambda psid, text=content: send_message(psid, text, access_token)))
+            elif message_type == 'image':
+                image_path = f"{image_dir}/{content.replace('[IMAGE] ', '')}"
+                senders.append((msg_key, lambda psid, path=image_path: send_image_binary(psid, path, access_token, page_id)))
+            elif message_type == 'video':
+                video_path = f"{vid_dir}/{content.replace('[VIDEO] ', '')}"
+                senders.append((msg_key, lambda psid, path=video_path: send_video_binary(psid, path, access_token, page_id)))
+        return senders
+
+    async def _send_one(self, job: BroadcastJob, limiter: PageRateLimiter, msg_key: str, sender: Callable,
+                        psid: str) -> Optional[str]:
+        """ส่ง 1 ข้อความพร้อม retry - คืนค่าประเภท error, SKIPPED หรือ None ถ้าสำเร็จ"""
+        claimed = await asyncio.to_thread(send_ledger.claim, job.campaign_key, msg_key, psid, job.page_id)
+        if not claimed:
+            return SKIPPED
+
+        for attempt in range(BROADCAST_MAX_RETRIES + 1):
+            await limiter.acquire()
+            try:
+                result = await asyncio.to_thread(sender, psid)
+                error_kind = classify_send_error(result) if 'error' in result else None
+            except Exception as e:
+                logger.warning(f"[{job.group_type}] Exception sending to {psid}: {e}")
+                result = {"error": {"message": str(e)}}
+                error_kind = ERROR_UNKNOWN if send_ledger.is_delivery_unknown(e) else classify_send_error(exc=e)
+
+            if error_kind is None:
+                await asyncio.to_thread(send_ledger.mark_sent, job.campaign_key, msg_key, psid, result.get('message_id'))
+                return None
+
+            error_message = str(result.get('error', {}).get('message', error_kind))
+            if error_kind == ERROR_UNKNOWN:
+                # ไม่รู้ว่า Facebook รับไปแล้วหรือยัง - ไม่ส่งซ้ำ
+                job.failures[psid] = f"delivery unknown: {error_message}"
+                await asyncio.to_thread(send_ledger.mark_unknown, job.campaign_key, msg_key, psid, error_message)
+                return error_kind
+
+            if error_kind == ERROR_RATE_LIMITED:
+                limiter.penalize(min(60, 2 ** attempt * 5))
+            elif error_kind in (ERROR_PERMANENT, ERROR_AUTH):
+                job.failures[psid] = error_message
+                await asyncio.to_thread(send_ledger.mark_failed, job.campaign_key, msg_key, psid, error_message)
+                return error_kind
+
+            # job ถูกยกเลิก -> ไม่ retry (ไม่เรียก sender ซ้ำ)
+            if job.cancelled or attempt >= BROADCAST_MAX_RETRIES:
+                break
+            job.retried += 1
+            await asyncio.sleep((2 ** attempt) + random.uniform(0, 1))
+
+        job.failures[psid] = error_message
+        await asyncio.to_thread(send_ledger.mark_failed, job.campaign_key, msg_key, psid, error_message)
+        return error_kind
+
+    async def _send_to_recipient(self, job: BroadcastJob, psid: str, senders: List[Callable],
+                                 limiter: PageRateLimiter, semaphore: asyncio.Semaphore):
+        async with semaphore:
+            if job.cancelled:
+                return
+
+            error_kind = None
+            all_skipped = True
+            for msg_key, sender in senders:
+                error_kind = await self._send_one(job, limiter, msg_key, sender, psid)
+                if error_kind == SKIPPED:
+                    error_kind = None
+                    continue
+                all_skipped = False
+                if error_kind:
+                    break
+
+            job.processed_psids.append(psid)
+            if error_kind is None and all_skipped:
+                job.skipped += 1
+            elif error_kind is None:
+                job.sent += 1
+                job.succeeded_psids.append(psid)
+            else:
+                job.failed += 1
+                logger.error(f"[{job.group_type}] ❌ Failed sending to {psid}: {job.failures.get(psid)}")
+                if error_kind == ERROR_AUTH and not job.cancelled:
+                    # token ใช้ไม่ได้ - ส่งต่อไปก็ไม่สำเร็จ
+                    job.cancelled = True
+                    job.status = "aborted"
+                    job.error = "Page access token is invalid"
+
+    async def run(self, page_id: str, psids: List[str], messages: List[Dict], access_token: str,
+                  schedule: Dict[str, Any] = None, group_type: str = "",
+                  rate_per_sec: Optional[float] = None, campaign_key: Optional[str] = None,
+                  job: Optional[BroadcastJob] = None) -> BroadcastJob:
+        """ส่งข้อความหาผู้รับทั้งหมด แล้วอัพเดทกลุ่มลูกค้าแบบ batch
+
+        rate_per_sec: ใช้แทน BROADCAST_RATE_PER_PAGE เมื่อ rate budget ของเพจถูกแบ่งให้หลาย worker
+        campaign_key: key ของ send ledger (default: schedule ปัจจุบัน หรือ job นี้)
+        job: job ที่ผู้เรียกสร้างไว้เอง - อ่าน counter ได้แม้ run ถูกขัดจังหวะกลางทาง
+        """
+        job = job or BroadcastJob(page_id, psids, str(schedule['id']) if schedule else None, group_type)
+        self.jobs[job.id] = job
+
+        try:
+            senders = self._build_senders(page_id, messages, access_token)
+            if not senders:
+                job.status = "completed"
+                return job
+
+            if campaign_key:
+                job.campaign_key = campaign_key
+            elif schedule:
+                job.campaign_key = await asyncio.to_thread(send_ledger.schedule_campaign_key, job.schedule_id)
+            else:
+                job.campaign_key = f"job:{job.id}"
+
+            # ตัดผู้รับที่ ledger บันทึกว่าได้รับครบแล้ว (claim ต่อข้อความยังกันการแข่งกันส่งอีกชั้น)
+            delivered = await asyncio.to_thread(
+                send_ledger.already_sent_psids, job.campaign_key, [k for k, _ in senders], psids
+            )
+            if delivered:
+                psids = [psid for psid in psids if psid not in delivered]
+                job.skipped = len(delivered)
+                job.processed_psids.extend(delivered)
+                logger.info(f"[{group_type}] ⏭️ Skip {len(delivered)} users already sent in {job.campaign_key}")
+
+            job.status = "running"
+            job.started_at = datetime.now()
+            logger.info(f"[{group_type}] 🚀 Broadcast job {job.id}: {len(psids)} users, {len(senders)} messages")
+
+            limiter = self._get_limiter(page_id, rate_per_sec)
+            semaphore = self._get_semaphore(page_id, rate_per_sec)
+            await asyncio.gather(*(
+                self._send_to_recipient(job, psid, senders, limiter, semaphore)
+                for psid in psids
+            ))
+
+            if job.succeeded_psids and schedule:
+                await asyncio.to_thread(self._apply_group_assignment, page_id, job.succeeded_psids, schedule, group_type)
+
+            if job.status == "running":
+                job.status = "cancelled" if job.cancelled else "completed"
+
+        except Exception as e:
+            job.status = "aborted"
+            job.error = str(e)
+            logger.error(f"[{group_type}] Broadcast job {job.id} error: {e}")
+        finally:
+            job.finished_at = datetime.now()
+            self.jobs.pop(job.id, None)
+            self.finished_jobs.append(job)
+            logger.info(f"[{group_type}] Broadcast job {job.id} {job.status}: {job.sent} success, {job.failed} failed")
+
+        await self._notify_group_assignment(page_id, job.succeeded_psids, schedule, group_type)
+        return job
+
+    # ==================== Group assignment ====================
+    def _apply_group_assignment(self, page_id: str, psids: List[str], schedule: Dict[str, Any], group_type: str):
+        """อัพเดทกลุ่มของลูกค้าที่ส่งสำเร็จใน transaction เดียว"""
+        groups = schedule.get('groups') or []
+        if not groups:
+            return
+        group_id = str(groups[0])
+        if group_id.startswith('default_'):
+            return
+
+        db = SessionLocal()
+        try:
+            page = lookup_cache.get_page(db, page_id)
+            if not page:
+                return
+
+            now = datetime.now()
+            if group_id.startswith('knowledge_'):
+                knowledge_id = int(group_id.replace('knowledge_', ''))
+                updated = db.query(models.FbCustomer).filter(
+                    models.FbCustomer.page_id == page.ID,
+                    models.FbCustomer.customer_psid.in_(psids)
+                ).update(
+                    {models.FbCustomer.current_category_id: knowledge_id, models.FbCustomer.updated_at: now},
+                    synchronize_session=False
+                )
+                logger.info(f"[{group_type}] ✅ Updated {updated} customers to knowledge group {knowledge_id}")
+            else:
+                group_id_int = int(group_id)
+                customer_ids = [
+                    row.id for row in db.query(models.FbCustomer.id).filter(
+                        models.FbCustomer.page_id == page.ID,
+                        models.FbCustomer.customer_psid.in_(psids)
+                    )
+                ]
+                db.bulk_save_objects([
+                    models.FBCustomerCustomClassification(
+                        customer_id=customer_id,
+                        old_category_id=None,
+                        new_category_id=group_id_int,
+                        page_id=page.ID,
+                        classified_by="system"
+                    )
+                    for customer_id in customer_ids
+                ])
+                db.query(models.FbCustomer).filter(
+                    models.FbCustomer.id.in_(customer_ids)
+                ).update({models.FbCustomer.updated_at: now}, synchronize_session=False)
+                logger.info(f"[{group_type}] ✅ Inserted {len(customer_ids)} classifications into custom group {group_id_int}")
+
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            logger.error(f"[{group_type}] ❌ Error updating customer groups: {e}")
+        finally:
+            db.close()
+
+    async def _notify_group_assignment(self, page_id: str, psids: List[str], schedule: Dict[str, Any], group_type: str):
+        """ส่ง SSE update ให้ลูกค้าที่ถูกย้ายกลุ่ม"""
+        groups = (schedule or {}).get('groups') or []
+        if not psids or not groups or str(groups[0]).startswith('default_'):
+            return
+
+        from app.routes.facebook.sse import send_customer_type_update
+
+        group_id = str(groups[0])
+        db = SessionLocal()
+        try:
+            if group_id.startswith('knowledge_'):
+                knowledge_id = int(group_id.replace('knowledge_', ''))
+                knowledge_type = db.query(models.CustomerTypeKnowledge).filter(
+                    models.CustomerTypeKnowledge.id == knowledge_id
+                ).first()
+                if not knowledge_type:
+                    return
+                for psid in psids:
+                    await send_customer_type_update(
+                        page_id=page_id,
+                        psid=psid,
+                        customer_type_knowledge_id=knowledge_id,
+                        customer_type_knowledge_name=knowledge_type.type_name
+                    )
+            else:
+                custom_group = db.query(models.CustomerTypeCustom).filter(
+                    models.CustomerTypeCustom.id == int(group_id)
+                ).first()
+                if not custom_group:
+                    return
+                for psid in psids:
+                    await send_customer_type_update(
+                        page_id=page_id,
+                        psid=psid,
+                        customer_type_name=custom_group.type_name,
+                        customer_type_custom_id=custom_group.id
+                    )
+            logger.info(f"[{group_type}] 📡 Sent SSE updates for {len(psids)} customers")
+        except Exception as e:
+            logger.error(f"[{group_type}] Error sending SSE updates: {e}")
+        finally:
+            db.close()
+
+
+# สร้าง instance
+broadcast_engine = BroadcastEngine()
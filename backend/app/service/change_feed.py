@@ -0,0 +1,204 @@
+"""
+Change Feed
+รับการเปลี่ยนแปลงของลูกค้าจาก Postgres LISTEN/NOTIFY แล้วส่งต่อให้ SSE broker
+- trigger บน fb_customers / fb_customer_classifications / fb_customer_mining_status
+  ส่ง pg_notify('customer_changes', {t, op, id, page, psid}) (ดู migration 0005_customer_change_feed ใน database/migrations.py)
+- NOTIFY ถูกส่งเมื่อ commit เท่านั้น -> client ได้เฉพาะข้อมูลที่ commit แล้ว
+- ทั้งระบบมี listener ตัวเดียว (leader ถือ lease ใน Redis) - broker กระจายต่อให้ทุกโปรเซส
+- อ่าน notification แบบ async ด้วย add_reader บน socket ของ psycopg2 (ไม่ใช้ thread)
+- รวม notification ภายใน CHANGE_FEED_FLUSH_MS แล้ว query ข้อมูลลูกค้าครั้งเดียวต่อรอบ
+- LISTEN ใช้ DATABASE_DIRECT_URL (PgBouncer แบบ transaction pooling ส่ง NOTIFY ต่อให้ไม่ได้)
+"""
+
+import asyncio
+import json
+import logging
+import os
+import uuid
+from collections import defaultdict
+from typing import Dict, List, Optional, Set
+
+import psycopg2
+import psycopg2.extensions
+
+from app.database import crud, models
+from app.database.database import DATABASE_DIRECT_URL, SessionLocal
+from app.service.sse_broker import publish_event
+from app.utils.redis_helper import r
+
+logger = logging.getLogger(__name__)
+
+CHANGE_FEED_CHANNEL = "customer_changes"
+CHANGE_FEED_ENABLED = os.getenv("CHANGE_FEED_ENABLED", "true").lower() == "true"
+CHANGE_FEED_FLUSH_MS = int(os.getenv("CHANGE_FEED_FLUSH_MS", 100))
+CHANGE_FEED_LEASE_TTL = int(os.getenv("CHANGE_FEED_LEASE_TTL", 10))
+# มีค่าอยู่ = มี listener ทำงาน (poller ของ SSE จะหยุด query)
+CHANGE_FEED_LEADER_KEY = "change_feed:leader"
+
+RENEW_LEASE_LUA = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('expire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+RELEASE_LEASE_LUA = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+def is_change_feed_active() -> bool:
+    return bool(r.exists(CHANGE_FEED_LEADER_KEY))
+
+
+class ChangeFeedListener:
+    def __init__(self):
+        self.token = uuid.uuid4().hex
+        self._conn: Optional[psycopg2.extensions.connection] = None
+        self._task: Optional[asyncio.Task] = None
+        self._pending: List[Dict] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._renew_lease = r.register_script(RENEW_LEASE_LUA)
+        self._release_lease_script = r.register_script(RELEASE_LEASE_LUA)
+
+    def start(self):
+        """เรียกจาก startup event ของ FastAPI"""
+        if not CHANGE_FEED_ENABLED or (self._task and not self._task.done()):
+            return
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def _hold_lease(self) -> bool:
+        if self._renew_lease(keys=[CHANGE_FEED_LEADER_KEY], args=[self.token, CHANGE_FEED_LEASE_TTL]):
+            return True
+        return bool(r.set(CHANGE_FEED_LEADER_KEY, self.token, nx=True, ex=CHANGE_FEED_LEASE_TTL))
+
+    def _release_lease(self):
+        """คืน lease (เฉพาะของตัวเอง) - poller กลับมา query แทนระหว่างที่ไม่มี listener"""
+        try:
+            self._release_lease_script(keys=[CHANGE_FEED_LEADER_KEY], args=[self.token])
+        except Exception as e:
+            logger.error(f"❌ Change feed lease release failed: {e}")
+
+    def _connect(self):
+        conn = psycopg2.connect(DATABASE_DIRECT_URL.replace("postgresql+psycopg2://", "postgresql://"))
+        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        with conn.cursor() as cur:
+            cur.execute(f"LISTEN {CHANGE_FEED_CHANNEL}")
+        return conn
+
+    def _on_readable(self):
+        try:
+            self._conn.poll()
+        except Exception as e:
+            logger.error(f"❌ Change feed connection error: {e}")
+            self._close()
+            self._wakeup.set()
+            return
+        while self._conn.notifies:
+            notify = self._conn.notifies.pop(0)
+            try:
+                self._pending.append(json.loads(notify.payload))
+            except ValueError:
+                continue
+        if self._pending:
+            self._wakeup.set()
+
+    def _close(self):
+        if self._conn is None:
+            return
+        try:
+            asyncio.get_running_loop().remove_reader(self._conn.fileno())
+        except Exception:
+            pass
+        try:
+            self._conn.close()
+        except Exception:
+            pass
+        self._conn = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        while True:
+            try:
+                # ไม่ใช่ leader -> รอแล้วลองใหม่ (leader เดิมอาจตาย)
+                if not await asyncio.to_thread(self._hold_lease):
+                    self._close()
+                    await asyncio.sleep(CHANGE_FEED_LEASE_TTL / 2)
+                    continue
+
+                if self._conn is None or self._conn.closed:
+                    self._close()
+                    self._conn = await asyncio.to_thread(self._connect)
+                    loop.add_reader(self._conn.fileno(), self._on_readable)
+                    logger.info(f"👂 Change feed listening on {CHANGE_FEED_CHANNEL}")
+
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=CHANGE_FEED_LEASE_TTL / 3)
+                except asyncio.TimeoutError:
+                    continue
+                # รวม notification ที่ตามมาติดๆ ก่อน query
+                await asyncio.sleep(CHANGE_FEED_FLUSH_MS / 1000)
+                self._wakeup.clear()
+
+                batch, self._pending = self._pending, []
+                if batch:
+                    await asyncio.to_thread(self._flush, batch)
+
+            except asyncio.CancelledError:
+                self._close()
+                raise
+            except Exception as e:
+                # LISTEN ใช้ไม่ได้ -> ไม่ถือ lease ค้างไว้ (ไม่เช่นนั้น poller หยุดและ client ไม่ได้ update เลย)
+                logger.error(f"❌ Change feed error: {e}")
+                self._close()
+                await asyncio.to_thread(self._release_lease)
+                await asyncio.sleep(1)
+
+    def _flush(self, batch: List[Dict]):
+        """query ลูกค้าที่เปลี่ยนในครั้งเดียว แล้ว publish แยกตามเพจ"""
+        changed_ids: Set[int] = set()
+        deleted: Dict[int, List[Dict]] = defaultdict(list)
+        for change in batch:
+            if change.get("t") == "fb_customers" and change.get("op") == "DELETE":
+                deleted[change["page"]].append({"id": change["id"], "psid": change.get("psid"), "action": "delete"})
+            elif change.get("id"):
+                changed_ids.add(change["id"])
+
+        db = SessionLocal()
+        try:
+            deleted_ids = {d["id"] for removed in deleted.values() for d in removed}
+            updates = crud.get_customer_updates_by_ids(db, list(changed_ids - deleted_ids))
+            page_ids = {}
+            if deleted:
+                page_ids = {
+                    page.ID: page.page_id
+                    for page in db.query(models.FacebookPage).filter(models.FacebookPage.ID.in_(deleted)).all()
+                }
+        finally:
+            db.close()
+
+        by_page: Dict[str, List[Dict]] = defaultdict(list)
+        for update in updates:
+            update.pop("updated_at", None)
+            by_page[update.pop("fb_page_id")].append(update)
+        for page_id, updates in by_page.items():
+            publish_event(page_id, "customer_update", updates)
+        for page_db_id, removed in deleted.items():
+            if page_db_id in page_ids:
+                publish_event(page_ids[page_db_id], "customer_update", removed)
+
+        logger.debug(f"📡 Change feed published {len(batch)} changes for {len(by_page)} pages")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        self._close()
+        self._release_lease()
+
+
+change_feed_listener = ChangeFeedListener()
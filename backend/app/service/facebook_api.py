@@ -6,6 +6,14 @@ from tempfile import NamedTemporaryFile
 
 FB_API_URL = "https://graph.facebook.com/v14.0"
 
+# timeout (connect, read) วินาทีของทุก request ไป Graph API - ไม่มี timeout = request ที่ค้างกิน thread ไปตลอด
+# read timeout หลังส่ง request แล้ว = ไม่รู้ว่าส่งถึงหรือยัง (send_ledger.is_delivery_unknown)
+FB_CONNECT_TIMEOUT = float(os.getenv("FB_CONNECT_TIMEOUT", 5))
+FB_READ_TIMEOUT = float(os.getenv("FB_READ_TIMEOUT", 30))
+FB_UPLOAD_READ_TIMEOUT = float(os.getenv("FB_UPLOAD_READ_TIMEOUT", 120))
+GRAPH_TIMEOUT = (FB_CONNECT_TIMEOUT, FB_READ_TIMEOUT)
+GRAPH_UPLOAD_TIMEOUT = (FB_CONNECT_TIMEOUT, FB_UPLOAD_READ_TIMEOUT)
+
 # API สำหรับแก้ไข URL ของภาพที่ซ้ำซ้อน
 def fix_nested_image_url(bad_url: str) -> str:
     # ตัดเอาเฉพาะชื่อไฟล์ภาพ
@@ -24,7 +32,7 @@ def fb_post(endpoint: str, payload: dict, access_token: str = None):
     params = {"access_token": access_token}
     print(f"🔍 POST to: {url}")
     print(f"🔍 Payload: {payload}")
-    response = requests.post(url, params=params, json=payload)
+    response = requests.post(url, params=params, json=payload, timeout=GRAPH_TIMEOUT)
     return response.json()
 
 # API สำหรับแก้ไขรูปแบบ ISO datetime ให้ถูกต้อง
@@ -33,7 +41,7 @@ def fb_get(endpoint: str, params: dict = {}, access_token: str = None):
     url = f"{FB_API_URL}/{endpoint}"
     print(f"🔍 GET from: {url}")
     print(f"🔍 Params: {params}")
-    response = requests.get(url, params=params)
+    response = requests.get(url, params=params, timeout=GRAPH_TIMEOUT)
     return response.json()
 
 # API สำหรับดึงข้อมูลผู้ใช้จาก PSID
@@ -49,7 +57,7 @@ def send_image_file_from_db(recipient_id: str, image_binary: bytes, filename: st
     files = {
         'filedata': (filename, image_binary, 'image/jpeg')  # เปลี่ยน content type ตามไฟล์จริง
     }
-    response = requests.post(url, params=params, data=data, files=files)
+    response = requests.post(url, params=params, data=data, files=files, timeout=GRAPH_UPLOAD_TIMEOUT)
     print(f"Response Status: {response.status_code}")
     print(f"Response: {response.text}")
     return response.json()
@@ -64,17 +72,35 @@ def send_message(recipient_id: str, message_text: str, access_token: str = None)
     }
     return fb_post("me/messages", payload, access_token)
 
-# API สำหรับส่งข้อความแบบ binary (image/video)
-def send_image_binary(recipient_id: str, filepath: str, access_token: str):
+# หา path จริงของไฟล์รูป
+def resolve_image_path(filepath: str) -> str:
     prefix = "http://localhost:8000/images/"
     # ตัด prefix ออกหมดเลย (ถ้ามีซ้ำๆก็หมด)
     filepath = filepath.replace(prefix, "")
 
     base_dir = "C:/Users/peemn/OneDrive/รูปภาพ/"
-    full_path = os.path.join(base_dir, filepath)
+    return os.path.join(base_dir, filepath)
+
+# หา path จริงของไฟล์วิดีโอ
+def resolve_video_path(filepath: str) -> str:
+    prefix = "http://localhost:8000/videos/"
+    # ตัด prefix ออกหมดเลย (ถ้ามี)
+    filepath = filepath.replace(prefix, "")
+
+    base_dir = "C:/Users/peemn/Videos/"
+    return os.path.join(base_dir, filepath)
+
+# API สำหรับส่งข้อความแบบ binary (image/video)
+def send_image_binary(recipient_id: str, filepath: str, access_token: str, page_id: str = None):
+    full_path = resolve_image_path(filepath)
 
     print("เปิดไฟล์จาก:", full_path)
 
+    if page_id:
+        # อัปโหลดครั้งเดียวต่อเพจ แล้วส่งด้วย attachment_id
+        from app.service.attachment_cache import send_media_file
+        return send_media_file(page_id, recipient_id, "image", full_path, access_token)
+
     url = f"https://graph.facebook.com/v14.0/me/messages?access_token={access_token}"
     filename = os.path.basename(full_path)
 
@@ -101,7 +127,7 @@ def send_image_binary(recipient_id: str, filepath: str, access_token: str):
         files = {
             'filedata': (filename, f, 'image/jpeg')
         }
-        response = requests.post(url, data=data, files=files)
+        response = requests.post(url, data=data, files=files, timeout=GRAPH_UPLOAD_TIMEOUT)
 
     return response.json()
 
@@ -126,16 +152,16 @@ def send_image(recipient_id: str, filename: str, access_token: str):
     return fb_post("me/messages", payload, access_token)
 
 # API สำหรับส่งวิดีโอแบบ binary
-def send_video_binary(recipient_id: str, filepath: str, access_token: str):
-    prefix = "http://localhost:8000/videos/"
-    # ตัด prefix ออกหมดเลย (ถ้ามี)
-    filepath = filepath.replace(prefix, "")
-
-    base_dir = "C:/Users/peemn/Videos/"
-    full_path = os.path.join(base_dir, filepath)
+def send_video_binary(recipient_id: str, filepath: str, access_token: str, page_id: str = None):
+    full_path = resolve_video_path(filepath)
 
     print("เปิดไฟล์จาก:", full_path)
 
+    if page_id:
+        # อัปโหลดครั้งเดียวต่อเพจ แล้วส่งด้วย attachment_id
+        from app.service.attachment_cache import send_media_file
+        return send_media_file(page_id, recipient_id, "video", full_path, access_token)
+
     url = f"https://graph.facebook.com/v14.0/me/messages?access_token={access_token}"
     filename = os.path.basename(full_path)
 
@@ -162,7 +188,7 @@ def send_video_binary(recipient_id: str, filepath: str, access_token: str):
         files = {
             'filedata': (filename, f, 'video/mp4')  # MIME type video/mp4
         }
-        response = requests.post(url, data=data, files=files)
+        response = requests.post(url, data=data, files=files, timeout=GRAPH_UPLOAD_TIMEOUT)
 
     return response.json()
 
@@ -1,7 +1,9 @@
 import logging
-from app.service.facebook_api import send_message, send_image_binary, send_video_binary
+from app.service.facebook_api import send_message, send_image_binary, send_video_binary, GRAPH_TIMEOUT
 from app.config import image_dir, vid_dir
 from app.database import crud
+from app.service.attachment_cache import send_media_bytes, send_media_digest
+from app.utils.blob_store import read_blob
 import requests
 
 logger = logging.getLogger(__name__)
@@ -15,12 +17,14 @@ def send_facebook_message(
     image_binary: bytes = None,
     access_token: str = None,
     is_system_message: bool = False,
-    message_tag: str = None
+    message_tag: str = None,
+    media_digest: str = None
 ):
     """
     ส่งข้อความหรือรูปภาพผ่าน Facebook Messenger
-    - msg_type: "text" หรือ "image"
+    - msg_type: "text", "image" หรือ "video"
     - image_binary: ถ้าเป็นรูป ให้ใส่ binary
+    - media_digest: digest ของสื่อใน blob store (โหลดเมื่อจำเป็นต้องอัปโหลดเท่านั้น)
     """
     url = f"https://graph.facebook.com/v14.0/me/messages?access_token={access_token}"
     
@@ -33,22 +37,17 @@ def send_facebook_message(
         }
         if message_tag:
             data["tag"] = message_tag
-        resp = requests.post(url, json=data)
+        resp = requests.post(url, json=data, timeout=GRAPH_TIMEOUT)
     
-    elif msg_type == "image":
+    elif msg_type in ("image", "video") and media_digest:
+        return send_media_digest(page_id, psid, msg_type, media_digest, lambda: read_blob(media_digest),
+                                 access_token, message_tag)
+
+    elif msg_type in ("image", "video"):
         if not image_binary:
             raise ValueError("ไม่มีรูปภาพให้ส่ง")
-        # 🚀 multipart/form-data สำหรับไฟล์
-        data = {
-            "recipient": '{"id":"%s"}' % psid,
-            "message": '{"attachment":{"type":"image","payload":{}}}'
-        }
-        files = {
-            "filedata": ("image.jpg", image_binary, "image/jpeg")
-        }
-        if message_tag:
-            data["tag"] = message_tag
-        resp = requests.post(url, data=data, files=files)
+        # 📎 อัปโหลดครั้งเดียวต่อเพจ แล้วส่งด้วย attachment_id
+        return send_media_bytes(page_id, psid, msg_type, image_binary, access_token, message_tag)
     
     else:
         raise ValueError(f"Unsupported msg_type={msg_type}")
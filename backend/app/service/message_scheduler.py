@@ -2,16 +2,24 @@ import asyncio
 from datetime import datetime, timedelta
 from typing import Dict, List, Any, Set
 import logging
-from app.service.facebook_api import send_message, send_image_binary, send_video_binary
+import os
+from app.service.broadcast_engine import broadcast_engine
+from app.service import send_ledger
+from app.celery_task.broadcast_tasks import dispatch_campaign, cancel_schedule_campaigns
 from app.database import crud
 from sqlalchemy.orm import Session
 from app.database.database import SessionLocal
 import json
 from app.routes.facebook.sse import send_customer_type_update
 from app.database import models
+from app.utils import lookup_cache
 
 logger = logging.getLogger(__name__)
 
+# campaign ที่มีผู้รับตั้งแต่จำนวนนี้ขึ้นไปจะถูกส่งผ่าน Celery แทนการส่งใน process ของ API
+BROADCAST_USE_CELERY = os.getenv("BROADCAST_USE_CELERY", "true").lower() == "true"
+BROADCAST_CELERY_MIN_RECIPIENTS = int(os.getenv("BROADCAST_CELERY_MIN_RECIPIENTS", 50))
+
 class MessageScheduler:
     def __init__(self):
         self.active_schedules: Dict[str, List[Dict[str, Any]]] = {}
@@ -115,6 +123,13 @@ class MessageScheduler:
                 s for s in self.knowledge_group_schedules.get(page_id, []) if s['id'] != schedule_id
             ]
             
+            # หยุด broadcast ที่กำลังส่งของ schedule นี้
+            broadcast_engine.cancel_schedule(str(schedule_id))
+            try:
+                cancel_schedule_campaigns(str(schedule_id))
+            except Exception as e:
+                logger.error(f"Error cancelling campaigns of schedule {schedule_id}: {e}")
+
             # ลบ tracking data
             self.sent_tracking.pop(str(schedule_id), None)
             self.last_check_time.pop(schedule_id, None)
@@ -280,7 +295,7 @@ class MessageScheduler:
             db = SessionLocal()
             try:
                 # หา page record
-                page = crud.get_page_by_page_id(db, page_id)
+                page = lookup_cache.get_page(db, page_id)
                 if not page:
                     logger.error(f"Page {page_id} not found")
                     return
@@ -332,10 +347,10 @@ class MessageScheduler:
                 # ส่งข้อความให้ users ที่ตรงเงื่อนไข
                 if inactive_users:
                     logger.info(f"[{group_type}] Found {len(inactive_users)} inactive users for schedule {schedule['id']}")
-                    await self.send_messages_to_users(page_id, inactive_users, schedule['messages'], access_token, schedule, group_type)
+                    processed = await self.send_messages_to_users(page_id, inactive_users, schedule['messages'], access_token, schedule, group_type)
 
-                    # เพิ่ม users ที่ส่งแล้วเข้า tracking
-                    self.sent_tracking[schedule_id].update(inactive_users)
+                    # เพิ่ม users ที่ส่งแล้วเข้า tracking (ไม่รวมที่ถูกยกเลิกก่อนส่ง)
+                    self.sent_tracking.setdefault(schedule_id, set()).update(processed)
                     schedule['last_sent'] = datetime.now().isoformat()
 
             finally:
@@ -374,7 +389,7 @@ class MessageScheduler:
             if knowledge_group_ids:
                 db = SessionLocal()
                 try:
-                    page = crud.get_page_by_page_id(db, page_id)
+                    page = lookup_cache.get_page(db, page_id)
                     if not page:
                         logger.error(f"Page {page_id} not found")
                         return
@@ -422,8 +437,8 @@ class MessageScheduler:
             
             if filtered_psids:
                 logger.info(f"[{group_type}] Sending messages to {len(filtered_psids)} users")
-                await self.send_messages_to_users(page_id, filtered_psids, messages, access_token, schedule, group_type)
-                self.sent_tracking[schedule_id].update(filtered_psids)
+                processed = await self.send_messages_to_users(page_id, filtered_psids, messages, access_token, schedule, group_type)
+                self.sent_tracking.setdefault(schedule_id, set()).update(processed)
             else:
                 logger.warning(f"[{group_type}] No users found to send messages")
             
@@ -431,139 +446,28 @@ class MessageScheduler:
             logger.error(f"[{group_type}] Error processing schedule: {e}")
     
     async def send_messages_to_users(self, page_id: str, psids: List[str], messages: List[Dict], 
-                                access_token: str, schedule: Dict[str, Any] = None, group_type: str = ""):
-        """ส่งข้อความไปยัง users พร้อมอัพเดท customer type (knowledge/custom)"""
-        success_count = 0
-        fail_count = 0
+                                access_token: str, schedule: Dict[str, Any] = None, group_type: str = "") -> List[str]:
+        """ส่งข้อความไปยัง users พร้อมอัพเดท customer type (knowledge/custom)
 
+        - ผู้รับจำนวนมาก: แตกเป็น chunk ส่งผ่าน Celery (worker ใช้ token ของเพจจาก Redis)
+        - ผู้รับจำนวนน้อย: ส่งใน process ผ่าน broadcast engine
+        คืนค่า PSIDs ที่ถูกส่ง/ส่งเข้าคิวแล้ว เพื่อใช้ใน sent_tracking
+        """
         logger.info(f"[{group_type}] Starting to send messages to {len(psids)} users")
 
-        db = SessionLocal()
+        if BROADCAST_USE_CELERY and len(psids) >= BROADCAST_CELERY_MIN_RECIPIENTS:
+            try:
+                campaign_id = await asyncio.to_thread(dispatch_campaign, page_id, psids, messages, schedule, group_type)
+                logger.info(f"[{group_type}] Dispatched campaign {campaign_id} to Celery")
+                return list(psids)
+            except Exception as e:
+                logger.error(f"[{group_type}] Error dispatching campaign, sending in-process: {e}")
 
-        try:
-            page = crud.get_page_by_page_id(db, page_id)
-            if not page:
-                logger.error(f"Page {page_id} not found in database")
-                return
+        job = await broadcast_engine.run(page_id, psids, messages, access_token, schedule, group_type)
 
-            for psid in psids:
-                try:
-                    # ส่งข้อความ
-                    for message in sorted(messages, key=lambda x: x.get('order', 0)):
-                        message_type = message.get('type', 'text')
-                        content = message.get('content', '')
-                        logger.info(f"[{group_type}] Sending {message_type} message to {psid}")
-
-                        if message_type == 'text':
-                            result = send_message(psid, content, access_token)
-                        elif message_type == 'image':
-                            from app.config import image_dir
-                            clean_content = content.replace('[IMAGE] ', '')
-                            image_path = f"{image_dir}/{clean_content}"
-                            result = send_image_binary(psid, image_path, access_token)
-                        elif message_type == 'video':
-                            from app.config import vid_dir
-                            clean_content = content.replace('[VIDEO] ', '')
-                            video_path = f"{vid_dir}/{clean_content}"
-                            result = send_video_binary(psid, video_path, access_token)
-                        else:
-                            continue
-
-                        if 'error' in result:
-                            logger.error(f"[{group_type}] Error sending message to {psid}: {result}")
-                            fail_count += 1
-                            break
-                        else:
-                            logger.info(f"[{group_type}] Successfully sent message to {psid}")
-                            await asyncio.sleep(0.5)
-
-                    # อัพเดท customer type ถ้าส่งสำเร็จ
-                    if schedule and 'groups' in schedule and len(schedule['groups']) > 0:
-                        group_id = schedule['groups'][0]
-
-                        # ✅ Knowledge group
-                        if str(group_id).startswith('knowledge_'):
-                            try:
-                                knowledge_id = int(str(group_id).replace('knowledge_', ''))
-                                customer = crud.get_customer_by_psid(db, page.ID, psid)
-                                if customer:
-                                    # อัพเดท current_category_id ของ FbCustomer
-                                    customer.current_category_id = knowledge_id
-                                    customer.updated_at = datetime.now()
-                                    db.commit()
-                                    db.refresh(customer)
-                                    logger.info(f"[{group_type}] ✅ Updated customer {psid} to knowledge group {knowledge_id}")
-
-                                    # ส่ง SSE update
-                                    knowledge_type = db.query(models.CustomerTypeKnowledge).filter(
-                                        models.CustomerTypeKnowledge.id == knowledge_id
-                                    ).first()
-                                    if knowledge_type:
-                                        from app.routes.facebook.sse import send_customer_type_update
-                                        await send_customer_type_update(
-                                            page_id=page_id,
-                                            psid=psid,
-                                            customer_type_knowledge_id=knowledge_id,  
-                                            customer_type_knowledge_name=knowledge_type.type_name
-                                        )
-                                        logger.info(f"[{group_type}] 📡 Sent SSE update for knowledge type: {knowledge_type.type_name}")
-
-                            except Exception as e:
-                                logger.error(f"[{group_type}] ❌ Error updating customer knowledge type: {e}")
-                                db.rollback()
-
-                        # ✅ Custom group
-                        elif not str(group_id).startswith('default_'):
-                            try:
-                                customer = crud.get_customer_by_psid(db, page.ID, psid)
-                                if customer:
-                                    group_id_int = int(group_id) if isinstance(group_id, str) else group_id
-                                    custom_group = db.query(models.CustomerTypeCustom).filter(
-                                        models.CustomerTypeCustom.id == group_id_int
-                                    ).first()
-                                    if custom_group:
-                                        # ➡️ Insert new record into FBCustomerCustomClassification
-                                        new_classification = models.FBCustomerCustomClassification(
-                                            customer_id=customer.id,
-                                            old_category_id=None,  # หรือใส่ group เดิมถ้ามี logic
-                                            new_category_id=group_id_int,
-                                            page_id=page.ID,
-                                            classified_by="system"
-                                        )
-                                        db.add(new_classification)
-                                        customer.updated_at = datetime.now()
-                                        db.commit()
-                                        db.refresh(customer)
-
-                                        logger.info(f"[{group_type}] ✅ Inserted classification for customer {psid} into custom group {group_id_int}")
-
-                                        # ส่ง SSE update
-                                        from app.routes.facebook.sse import send_customer_type_update
-                                        await send_customer_type_update(
-                                            page_id=page_id,
-                                            psid=psid,
-                                            customer_type_name=custom_group.type_name,
-                                            customer_type_custom_id=group_id_int
-                                        )
-                                        logger.info(f"[{group_type}] 📡 Sent SSE update for custom type: {custom_group.type_name}")
-
-                            except Exception as e:
-                                logger.error(f"[{group_type}] ❌ Error inserting customer custom classification: {e}")
-                                db.rollback()
-
-                    success_count += 1
-                    await asyncio.sleep(1)
-
-                except Exception as e:
-                    logger.error(f"[{group_type}] Error sending messages to {psid}: {e}")
-                    fail_count += 1
-
-        finally:
-            db.close()
-
-        logger.info(f"[{group_type}] Sent messages complete: {success_count} success, {fail_count} failed")
+        logger.info(f"[{group_type}] Sent messages complete: {job.sent} success, {job.failed} failed")
+        return job.processed_psids
 
-    
     async def update_inactivity_from_conversations(self, page_id: str):
         """อัพเดทข้อมูล inactivity จาก conversations โดยตรง"""
         try:
@@ -651,8 +555,9 @@ class MessageScheduler:
         # อัพเดทวันที่ใน schedule
         schedule['date'] = next_date.strftime("%Y-%m-%d")
         
-        # Reset tracking สำหรับรอบใหม่
+        # Reset tracking สำหรับรอบใหม่ (ledger ด้วย ไม่เช่นนั้นรอบถัดไปจะข้ามผู้รับที่เคยส่งแล้วทั้งหมด)
         self.sent_tracking[schedule_id] = set()
+        await asyncio.to_thread(send_ledger.reset_schedule_epoch, schedule_id)
     
     def get_active_schedules_for_page(self, page_id: str):
         """ดึง active schedules สำหรับ page"""
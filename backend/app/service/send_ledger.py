@@ -0,0 +1,190 @@
+"""
+Send Ledger
+บันทึกการส่งข้อความต่อ (campaign/schedule, ข้อความ, psid) เพื่อไม่ให้ส่งซ้ำเมื่อ retry
+- claim แบบ atomic ก่อนเรียก Graph API (INSERT ... ON CONFLICT DO NOTHING)
+- pending/sent/unknown = ห้ามส่งซ้ำ, failed = claim ใหม่ได้
+- unknown = timeout หลังส่ง request ไปแล้ว ไม่รู้ว่า Facebook รับหรือยัง จึงไม่ส่งซ้ำ
+- pending ที่ค้างนานเกิน SEND_LEDGER_PENDING_TIMEOUT (worker ตายหลัง claim หรือบันทึกผลไม่สำเร็จ)
+  ถูกย้ายเป็น unknown โดย expire_stale_claims - ไม่ค้างเป็น pending เงียบๆ
+การรับประกันคือ at-most-once: ผู้รับได้ข้อความไม่เกิน 1 ครั้งต่อ key
+แต่ถ้าส่งค้างกลางทาง (unknown) ผู้รับอาจไม่ได้รับเลย - ดูได้จาก status = 'unknown'
+"""
+
+import hashlib
+import json
+import logging
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, Optional, Set
+
+import requests
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert
+
+from app.database import models
+from app.database.database import SessionLocal
+from app.utils.redis_helper import r
+
+logger = logging.getLogger(__name__)
+
+STATUS_PENDING = "pending"
+STATUS_SENT = "sent"
+STATUS_FAILED = "failed"
+STATUS_UNKNOWN = "unknown"
+
+# pending นานกว่านี้ถือว่า worker ที่ claim ไว้ตายไปแล้ว (ต้องนานกว่า time_limit ของ chunk task)
+SEND_LEDGER_PENDING_TIMEOUT = int(os.getenv("SEND_LEDGER_PENDING_TIMEOUT", 3600))
+
+# สถานะที่ถือว่า "ส่งแล้ว" (หรืออาจส่งแล้ว) ห้ามส่งซ้ำ
+DELIVERED_STATUSES = (STATUS_PENDING, STATUS_SENT, STATUS_UNKNOWN)
+
+
+def message_key(message: Dict) -> str:
+    """key ของข้อความจากเนื้อหา - ข้อความเดียวกันใน schedule เดียวกันได้ key เดิม"""
+    raw = json.dumps(
+        [message.get('order', 0), message.get('type', 'text'), message.get('content', '')],
+        ensure_ascii=False
+    )
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+
+def schedule_campaign_key(schedule_id: str) -> str:
+    """key ของ schedule - ผูกกับ epoch ใน Redis ที่เปลี่ยนเมื่อเริ่มรอบใหม่ (activate / repeat / reset tracking)"""
+    epoch_key = f"schedule_epoch:{schedule_id}"
+    r.set(epoch_key, int(time.time()), nx=True)
+    return f"schedule:{schedule_id}:{r.get(epoch_key)}"
+
+
+def reset_schedule_epoch(schedule_id: str):
+    """เริ่ม ledger รอบใหม่ของ schedule (INCR จึงได้ epoch ใหม่เสมอ แม้ reset ซ้ำในวินาทีเดียวกัน)"""
+    epoch_key = f"schedule_epoch:{schedule_id}"
+    r.set(epoch_key, int(time.time()), nx=True)
+    r.incr(epoch_key)
+
+
+def is_delivery_unknown(exc: Exception) -> bool:
+    """request อาจถึง Facebook แล้ว (read timeout / connection หลุดระหว่างรอ response)"""
+    if isinstance(exc, requests.ConnectTimeout):
+        return False
+    return isinstance(exc, (requests.Timeout, requests.ConnectionError))
+
+
+def claim(campaign_key: str, msg_key: str, psid: str, page_id: str = None) -> bool:
+    """จองสิทธิ์ส่ง - คืนค่า True ถ้าผู้เรียกเป็นคนส่งข้อความนี้"""
+    db = SessionLocal()
+    try:
+        Ledger = models.MessageSendLedger
+        stmt = insert(Ledger).values(
+            campaign_key=campaign_key, message_key=msg_key, psid=psid, page_id=page_id, status=STATUS_PENDING
+        ).on_conflict_do_nothing(constraint="uq_send_ledger_key").returning(Ledger.id)
+        claimed = db.execute(stmt).first() is not None
+
+        if not claimed:
+            # ครั้งก่อนส่งไม่สำเร็จแน่นอน -> claim ใหม่ได้
+            claimed = db.query(Ledger).filter(
+                Ledger.campaign_key == campaign_key,
+                Ledger.message_key == msg_key,
+                Ledger.psid == psid,
+                Ledger.status == STATUS_FAILED
+            ).update({
+                Ledger.status: STATUS_PENDING,
+                Ledger.attempts: Ledger.attempts + 1,
+                Ledger.error: None
+            }, synchronize_session=False) > 0
+
+        db.commit()
+        return claimed
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+def _finish(campaign_key: str, msg_key: str, psid: str, values: Dict):
+    db = SessionLocal()
+    try:
+        db.query(models.MessageSendLedger).filter(
+            models.MessageSendLedger.campaign_key == campaign_key,
+            models.MessageSendLedger.message_key == msg_key,
+            models.MessageSendLedger.psid == psid
+        ).update(values, synchronize_session=False)
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        logger.error(f"❌ Error updating send ledger for {psid}: {e}")
+    finally:
+        db.close()
+
+
+def mark_sent(campaign_key: str, msg_key: str, psid: str, graph_message_id: Optional[str] = None):
+    _finish(campaign_key, msg_key, psid, {"status": STATUS_SENT, "graph_message_id": graph_message_id})
+
+
+def mark_failed(campaign_key: str, msg_key: str, psid: str, error: str = None):
+    _finish(campaign_key, msg_key, psid, {"status": STATUS_FAILED, "error": error})
+
+
+def mark_unknown(campaign_key: str, msg_key: str, psid: str, error: str = None):
+    _finish(campaign_key, msg_key, psid, {"status": STATUS_UNKNOWN, "error": error})
+
+
+def expire_stale_claims(older_than_seconds: int = SEND_LEDGER_PENDING_TIMEOUT) -> int:
+    """ย้าย pending ที่ค้างเกินกำหนดเป็น unknown (อาจส่งไปแล้วก่อน worker ตาย จึงไม่ให้ claim ใหม่)"""
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=older_than_seconds)
+    db = SessionLocal()
+    try:
+        Ledger = models.MessageSendLedger
+        expired = db.query(Ledger).filter(
+            Ledger.status == STATUS_PENDING,
+            Ledger.updated_at < cutoff
+        ).update({
+            Ledger.status: STATUS_UNKNOWN,
+            Ledger.error: "claim expired before the send result was recorded"
+        }, synchronize_session=False)
+        db.commit()
+        if expired:
+            logger.warning(f"⏰ Expired {expired} stale send ledger claims to unknown")
+        return expired
+    except Exception as e:
+        db.rollback()
+        logger.error(f"❌ Error expiring stale send ledger claims: {e}")
+        return 0
+    finally:
+        db.close()
+
+
+def get_entry(campaign_key: str, msg_key: str, psid: str) -> Optional[models.MessageSendLedger]:
+    db = SessionLocal()
+    try:
+        return db.query(models.MessageSendLedger).filter(
+            models.MessageSendLedger.campaign_key == campaign_key,
+            models.MessageSendLedger.message_key == msg_key,
+            models.MessageSendLedger.psid == psid
+        ).first()
+    finally:
+        db.close()
+
+
+def already_sent_psids(campaign_key: str, msg_keys: Iterable[str], psids: Iterable[str]) -> Set[str]:
+    """PSIDs ที่ได้รับข้อความครบทุกข้อความแล้ว (ใช้กรองผู้รับก่อนเริ่มส่ง)"""
+    msg_keys = list(msg_keys)
+    psids = list(psids)
+    if not msg_keys or not psids:
+        return set()
+
+    db = SessionLocal()
+    try:
+        Ledger = models.MessageSendLedger
+        rows = db.query(Ledger.psid).filter(
+            Ledger.campaign_key == campaign_key,
+            Ledger.message_key.in_(msg_keys),
+            Ledger.psid.in_(psids),
+            Ledger.status.in_(DELIVERED_STATUSES)
+        ).group_by(Ledger.psid).having(
+            func.count(func.distinct(Ledger.message_key)) >= len(msg_keys)
+        ).all()
+        return {row.psid for row in rows}
+    finally:
+        db.close()
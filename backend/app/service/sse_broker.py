@@ -0,0 +1,367 @@
+"""
+SSE Broker
+กระจาย update แบบ real-time ไปยังทุก SSE connection ของเพจ
+- ผู้ส่ง (API, Celery, scheduler, thread ใดก็ได้) publish ไป Redis channel sse:page:{page_id}
+- แต่ละ API process subscribe channel ของเพจที่มี connection เปิดอยู่ (ครั้งเดียวต่อเพจ)
+  แล้วกระจายต่อให้ queue ของทุก connection ในโปรเซส (local fan-out)
+- update 1 รายการจึงถึงทุก dashboard ของเพจนั้น ไม่ใช่ client ใดก็ได้ 1 ราย เหมือน asyncio.Queue เดิม
+- ทุก event ถูกเก็บใน Redis Stream sse:stream:{page_id} (จำกัดจำนวน) และใช้ stream id เป็น event id
+  client ที่ reconnect พร้อม Last-Event-ID จะได้ event ที่พลาดไป (replay) แทนการโหลดรายชื่อลูกค้าใหม่ทั้งหมด
+- pub/sub หลุดแล้วต่อใหม่: replay event ที่เข้ามาระหว่างหลุดจาก stream ให้ทุก connection ของเพจ
+  (ต่อจาก event id ล่าสุดที่กระจายไปแล้ว) - ถ้าเก่าเกิน buffer หรือไม่รู้จุดเริ่ม ให้ client resync
+- Subscription รวม event ต่อ psid ภายใน SSE_FLUSH_MS และ replay ให้ทั้ง SSE (routes/facebook/sse.py)
+  และ WebSocket แบบหลายเพจ (routes/facebook/ws.py)
+"""
+
+import asyncio
+import json
+import logging
+import os
+from datetime import datetime
+from typing import Dict, List, Optional, Set, Tuple
+
+import redis.asyncio as aioredis
+
+from app.utils.redis_helper import r, REDIS_HOST, REDIS_PORT, REDIS_DB
+
+logger = logging.getLogger(__name__)
+
+SSE_CHANNEL_PREFIX = "sse:page:"
+SSE_STREAM_PREFIX = "sse:stream:"
+# event ที่ค้างได้ต่อ connection - เกินนี้ (client อ่านช้า) จะทิ้งทั้งหมดแล้วสั่ง resync
+SSE_SUBSCRIBER_QUEUE_SIZE = int(os.getenv("SSE_SUBSCRIBER_QUEUE_SIZE", 256))
+# จำนวน event ล่าสุดต่อเพจที่ replay ได้
+SSE_REPLAY_BUFFER = int(os.getenv("SSE_REPLAY_BUFFER", 1000))
+SSE_REPLAY_TTL = int(os.getenv("SSE_REPLAY_TTL", 60 * 60 * 24))
+# รวม event ที่เข้ามาภายในช่วงนี้เป็นชุดเดียว (state ล่าสุดต่อ psid)
+SSE_FLUSH_MS = int(os.getenv("SSE_FLUSH_MS", 250))
+
+# XADD + PUBLISH แบบ atomic -> ลำดับ id ใน stream ตรงกับลำดับที่ subscriber ได้รับ
+# message ที่ publish = "{stream id}\n{event json}"
+PUBLISH_EVENT_LUA = """
+local id = redis.call('XADD', KEYS[1], 'MAXLEN', '~', ARGV[1], '*', 'event', ARGV[2])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+redis.call('PUBLISH', KEYS[2], id .. '\n' .. ARGV[2])
+return id
+"""
+_publish_event_script = r.register_script(PUBLISH_EVENT_LUA)
+
+
+def page_channel(page_id: str) -> str:
+    return f"{SSE_CHANNEL_PREFIX}{page_id}"
+
+
+def page_stream(page_id: str) -> str:
+    return f"{SSE_STREAM_PREFIX}{page_id}"
+
+
+def parse_event_id(event_id: Optional[str]) -> Optional[Tuple[int, int]]:
+    """stream id ("ms-seq") -> tuple สำหรับเปรียบเทียบลำดับ (None ถ้าไม่ใช่ id ที่ถูกต้อง)"""
+    try:
+        ms, seq = (event_id or "").split("-")
+        return int(ms), int(seq)
+    except ValueError:
+        return None
+
+
+def replay_events(page_id: str, last_event_id: str) -> Tuple[List[Tuple[str, Dict]], bool]:
+    """event หลัง last_event_id -> ([(id, event)], overrun)
+
+    overrun = True เมื่อ event ที่ client ยังไม่ได้บางส่วนถูกตัดออกจาก buffer แล้ว (client ต้อง resync)
+    """
+    last = parse_event_id(last_event_id)
+    if last is None:
+        return [], True
+
+    stream = page_stream(page_id)
+    first = r.xrange(stream, "-", "+", count=1)
+    if not first:
+        return [], False
+    if parse_event_id(first[0][0]) > last:
+        return [], True
+
+    entries = r.xrange(stream, f"({last_event_id}", "+", count=SSE_REPLAY_BUFFER)
+    return [(entry_id, json.loads(fields["event"])) for entry_id, fields in entries], False
+
+
+def publish_event(page_id: str, event_type: str, data: List[Dict]) -> Optional[str]:
+    """ส่ง event ({type, data}) ให้ทุก subscriber ของเพจ (ทุกโปรเซส) - เรียกได้ทั้งจากโค้ด sync/async และ Celery
+
+    page_id คือ Facebook page id (string) - คืนค่า event id (None ถ้าส่งไม่สำเร็จ)
+    """
+    event = {"type": event_type, "data": data}
+    try:
+        return _publish_event_script(
+            keys=[page_stream(str(page_id)), page_channel(str(page_id))],
+            args=[SSE_REPLAY_BUFFER, json.dumps(event, ensure_ascii=False, default=str), SSE_REPLAY_TTL],
+        )
+    except Exception as e:
+        logger.error(f"❌ Error publishing SSE {event_type} for page {page_id}: {e}")
+        return None
+
+
+def publish(page_id: str, update: Dict) -> Optional[str]:
+    """ส่ง customer_type_update 1 รายการ (รูปแบบเดียวกับ queue เดิม)"""
+    return publish_event(page_id, "customer_type_update", [update])
+
+
+def resync_event() -> Dict:
+    return {"type": "resync", "timestamp": datetime.now().isoformat()}
+
+
+# event ของลูกค้าที่รวมกันได้ต่อ psid (ข้าม type)
+CUSTOMER_STATE_EVENT = "customer_update"
+CUSTOMER_PARTIAL_EVENT = "customer_type_update"
+
+
+def coalesce_events(items: List[Tuple[str, Dict]]) -> List[Dict]:
+    """รวม event ในชุดเดียวกันเหลือ 1 รายการต่อ psid (ข้าม type)
+
+    customer_update เป็น state เต็ม -> แทนที่ค่าเดิม / customer_type_update ส่งเฉพาะบาง field -> merge ทับ state ล่าสุด
+    (ผลยังเป็น customer_update ถ้ามี state เต็มอยู่ก่อน) แล้วเรียงตามครั้งสุดท้ายที่แต่ละ psid ปรากฏ
+    psid ที่อยู่ติดกันและ type เดียวกันรวมเป็น event เดียว
+    """
+    latest: Dict[object, Tuple[str, Dict]] = {}
+    for position, (_, event) in enumerate(items):
+        event_type = event.get("type")
+        for index, update in enumerate(event.get("data") or []):
+            psid = update.get("psid") if isinstance(update, dict) else None
+            if psid is None or event_type not in (CUSTOMER_STATE_EVENT, CUSTOMER_PARTIAL_EVENT):
+                key = (event_type, psid) if psid is not None else (event_type, position, index)
+            else:
+                key = psid
+            previous = latest.pop(key, None)
+            if previous and event_type == CUSTOMER_PARTIAL_EVENT:
+                latest[key] = (previous[0], {**previous[1], **update})
+            else:
+                latest[key] = (event_type, update)
+
+    # pop แล้วใส่ใหม่ -> ลำดับใน dict คือลำดับครั้งสุดท้ายที่ key ปรากฏ
+    events: List[Dict] = []
+    for event_type, update in latest.values():
+        if events and events[-1]["type"] == event_type:
+            events[-1]["data"].append(update)
+        else:
+            events.append({"type": event_type, "data": [update]})
+    return events
+
+
+class Subscription:
+    """queue ของ connection หนึ่ง (จำกัดขนาด) - ล้นเมื่อไร state ระหว่างทางไม่มีความหมายแล้ว ให้ resync แทน"""
+
+    def __init__(self, page_id: str):
+        self.page_id = page_id
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=SSE_SUBSCRIBER_QUEUE_SIZE)
+        self.overflowed = False
+        # id ล่าสุดที่ส่งให้ client แล้ว (tuple จาก parse_event_id)
+        self.last_sent: Optional[Tuple[int, int]] = None
+
+    def offer(self, item: Tuple[str, Dict]):
+        if self.overflowed:
+            return
+        try:
+            self.queue.put_nowait(item)
+        except asyncio.QueueFull:
+            self.request_resync()
+            logger.warning(f"⚠️ SSE subscriber queue full for page {self.page_id}, client will resync")
+
+    def request_resync(self):
+        """ทิ้ง event ที่ค้างแล้วให้ next_events ส่ง resync (ใส่ item ปลุก connection ที่รอ queue อยู่)"""
+        self.overflowed = True
+        self.drain()
+        self.queue.put_nowait((None, resync_event()))
+
+    def drain(self) -> List[Tuple[str, Dict]]:
+        items = []
+        while not self.queue.empty():
+            items.append(self.queue.get_nowait())
+        return items
+
+    def take_overflow(self) -> bool:
+        """คืนค่า True ครั้งเดียวหลัง overflow (แล้วรับ event ต่อ)"""
+        if not self.overflowed:
+            return False
+        self.drain()
+        self.overflowed = False
+        return True
+
+    async def replay(self, last_event_id: Optional[str]) -> List[Tuple[Optional[str], Dict]]:
+        """event ที่ client พลาดไปหลัง last_event_id (หรือ resync ถ้าเก่าเกิน buffer)
+
+        เรียกหลัง subscribe เพื่อไม่ให้ event ที่เข้ามาระหว่าง replay หายไป
+        """
+        if not last_event_id:
+            return []
+        missed, overrun = await asyncio.to_thread(replay_events, self.page_id, last_event_id)
+        if overrun:
+            logger.info(f"SSE replay buffer overrun for page {self.page_id}, asking client to resync")
+            return [(None, resync_event())]
+        self.last_sent = parse_event_id(last_event_id)
+        if missed:
+            self.last_sent = parse_event_id(missed[-1][0])
+        return missed
+
+    async def next_events(self, timeout: float) -> Optional[List[Tuple[Optional[str], Dict]]]:
+        """รอ event ชุดถัดไป -> [(event id, event)] ที่รวมต่อ psid แล้ว / None ถ้าไม่มี event ภายใน timeout
+
+        id ของชุดอยู่ที่ event สุดท้าย (reconnect จะได้ต่อจากหลังชุดนี้)
+        """
+        if self.take_overflow():
+            # client อ่านไม่ทัน -> event ที่ค้างถูกทิ้ง ให้ client โหลดใหม่แทน
+            return [(None, resync_event())]
+        try:
+            first = await asyncio.wait_for(self.queue.get(), timeout=timeout)
+        except asyncio.TimeoutError:
+            return None
+
+        # รวบ event ที่ตามมาภายใน flush window
+        await asyncio.sleep(SSE_FLUSH_MS / 1000)
+        if self.take_overflow():
+            return [(None, resync_event())]
+        batch = [first] + self.drain()
+        # ข้าม event ที่ส่งไปแล้วตอน replay
+        if self.last_sent:
+            batch = [item for item in batch if (parse_event_id(item[0]) or (0, 0)) > self.last_sent]
+        if not batch:
+            return []
+
+        events = coalesce_events(batch)
+        batch_id = batch[-1][0]
+        self.last_sent = parse_event_id(batch_id)
+        return [(batch_id if index == len(events) - 1 else None, event) for index, event in enumerate(events)]
+
+
+class SSEBroker:
+    def __init__(self):
+        self._subscribers: Dict[str, Set[Subscription]] = {}
+        # event id ล่าสุดที่กระจายไปแล้วต่อเพจ - ใช้ replay ช่วงที่ pub/sub หลุด และกัน event ซ้ำ
+        self._last_ids: Dict[str, str] = {}
+        self._redis: Optional[aioredis.Redis] = None
+        self._pubsub = None
+        self._reader_task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def _ensure_started(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is loop and self._reader_task and not self._reader_task.done():
+            return
+        self._loop = loop
+        self._redis = aioredis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, decode_responses=True)
+        self._pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+        self._reader_task = loop.create_task(self._reader())
+
+    async def subscribe(self, page_id: str) -> Subscription:
+        """เปิด subscription ของ connection หนึ่ง - queue ได้ (event id, event) / ต้องเรียก unsubscribe เมื่อ connection ปิด"""
+        self._ensure_started()
+        subscription = Subscription(page_id)
+        subscribers = self._subscribers.setdefault(page_id, set())
+        subscribers.add(subscription)
+        if len(subscribers) == 1:
+            # จุดเริ่มสำหรับ replay หลัง reconnect (อ่านก่อน subscribe - event ที่ตามมาไม่ถูกมองว่าซ้ำ)
+            latest = await self._redis.xrevrange(page_stream(page_id), count=1)
+            if latest:
+                self._last_ids.setdefault(page_id, latest[0][0])
+            await self._pubsub.subscribe(page_channel(page_id))
+            logger.info(f"📡 Subscribed to {page_channel(page_id)}")
+        return subscription
+
+    async def unsubscribe(self, page_id: str, subscription: Subscription):
+        subscribers = self._subscribers.get(page_id)
+        if not subscribers:
+            return
+        subscribers.discard(subscription)
+        if not subscribers:
+            del self._subscribers[page_id]
+            self._last_ids.pop(page_id, None)
+            try:
+                await self._pubsub.unsubscribe(page_channel(page_id))
+                logger.info(f"📴 Unsubscribed from {page_channel(page_id)}")
+            except Exception as e:
+                logger.error(f"❌ Error unsubscribing {page_channel(page_id)}: {e}")
+
+    def subscriber_count(self, page_id: Optional[str] = None) -> int:
+        if page_id is not None:
+            return len(self._subscribers.get(page_id, ()))
+        return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+    def _fan_out(self, page_id: str, event_id: str, event: Dict):
+        parsed = parse_event_id(event_id)
+        last = parse_event_id(self._last_ids.get(page_id))
+        if parsed and last and parsed <= last:
+            # ได้ไปแล้วจาก replay หลัง reconnect
+            return
+        if parsed:
+            self._last_ids[page_id] = event_id
+        for subscription in list(self._subscribers.get(page_id, ())):
+            subscription.offer((event_id, event))
+
+    async def _reader(self):
+        """อ่าน message จาก Redis แล้วกระจายให้ connection ในโปรเซสนี้"""
+        while True:
+            try:
+                if not self._subscribers:
+                    await asyncio.sleep(0.5)
+                    continue
+
+                message = await self._pubsub.get_message(timeout=1.0)
+                if not message or message.get("type") != "message":
+                    continue
+
+                page_id = message["channel"][len(SSE_CHANNEL_PREFIX):]
+                event_id, _, payload = message["data"].partition("\n")
+                self._fan_out(page_id, event_id, json.loads(payload))
+
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ SSE broker reader error: {e}")
+                await asyncio.sleep(1)
+                await self._resubscribe()
+
+    async def _resubscribe(self):
+        """สร้าง pubsub ใหม่หลังหลุดการเชื่อมต่อ แล้ว subscribe เพจที่ยังมี connection อยู่"""
+        try:
+            await self._pubsub.close()
+        except Exception:
+            pass
+        self._pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+        if self._subscribers:
+            try:
+                await self._pubsub.subscribe(*[page_channel(page_id) for page_id in self._subscribers])
+            except Exception as e:
+                logger.error(f"❌ SSE broker resubscribe failed: {e}")
+                return
+            for page_id in list(self._subscribers):
+                await self._replay_gap(page_id)
+
+    async def _replay_gap(self, page_id: str):
+        """กระจาย event ที่ publish ระหว่าง pub/sub หลุด (จาก stream) - ไม่ได้ก็สั่งทุก connection ของเพจ resync"""
+        last_id = self._last_ids.get(page_id)
+        try:
+            missed, overrun = await asyncio.to_thread(replay_events, page_id, last_id) if last_id else ([], True)
+        except Exception as e:
+            logger.error(f"❌ SSE gap replay failed for page {page_id}: {e}")
+            missed, overrun = [], True
+
+        if overrun:
+            logger.warning(f"⚠️ SSE events for page {page_id} lost during reconnect, clients will resync")
+            for subscription in list(self._subscribers.get(page_id, ())):
+                subscription.request_resync()
+            return
+        for event_id, event in missed:
+            self._fan_out(page_id, event_id, event)
+        if missed:
+            logger.info(f"♻️ Replayed {len(missed)} SSE events for page {page_id} after reconnect")
+
+    async def close(self):
+        if self._reader_task:
+            self._reader_task.cancel()
+        if self._pubsub:
+            await self._pubsub.close()
+        if self._redis:
+            await self._redis.close()
+        self._subscribers.clear()
+        self._reader_task = None
+
+
+sse_broker = SSEBroker()
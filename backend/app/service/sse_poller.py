@@ -0,0 +1,137 @@
+"""
+SSE Customer Change Poller
+poll ลูกค้าที่ถูกแก้ไขของเพจ 1 ตัวต่อเพจ (ทั้งระบบ) แล้วส่งผลผ่าน SSE broker ให้ทุก connection
+- แทนการที่ทุก SSE connection ถือ DB session และ query ซ้ำกันทุก 5 วินาที
+- หลายโปรเซสแย่ง lease ใน Redis (sse:poller:{page_id}) - ผู้ถือ lease เท่านั้นที่ query
+- watermark (updated_at ล่าสุดที่ส่งแล้ว) เก็บใน Redis จึงส่งต่อได้เมื่อ lease เปลี่ยนมือ
+- แต่ละรอบเปิด session สั้นๆ ใน thread แล้วปิดทันที (อ่านจาก read replica ถ้ามีและ lag ไม่เกินกำหนด)
+- เป็น fallback ของ change feed (LISTEN/NOTIFY) - ขณะที่ change feed ทำงาน poller จะไม่ query
+"""
+
+import asyncio
+import logging
+import os
+import uuid
+from datetime import datetime, timezone
+from typing import Dict
+
+from app.database import crud
+from app.database.database import open_read_session
+from app.service.change_feed import is_change_feed_active
+from app.service.sse_broker import publish_event
+from app.utils import lookup_cache
+from app.utils.redis_helper import r
+
+logger = logging.getLogger(__name__)
+
+SSE_POLL_INTERVAL = float(os.getenv("SSE_POLL_INTERVAL", 5))
+SSE_POLLER_LEASE_TTL = int(os.getenv("SSE_POLLER_LEASE_TTL", 15))
+
+# ต่ออายุ lease เฉพาะเมื่อเป็นเจ้าของ
+RENEW_LEASE_LUA = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('expire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+RELEASE_LEASE_LUA = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+def _lease_key(page_id: str) -> str:
+    return f"sse:poller:{page_id}"
+
+
+def _watermark_key(page_id: str) -> str:
+    return f"sse:poller:{page_id}:since"
+
+
+class CustomerChangePoller:
+    def __init__(self):
+        self.token = uuid.uuid4().hex
+        self._watchers: Dict[str, int] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._renew_lease = r.register_script(RENEW_LEASE_LUA)
+        self._release_lease = r.register_script(RELEASE_LEASE_LUA)
+
+    def watch(self, page_id: str):
+        """connection เปิด - เริ่ม poller ของเพจถ้ายังไม่มีในโปรเซสนี้"""
+        self._watchers[page_id] = self._watchers.get(page_id, 0) + 1
+        task = self._tasks.get(page_id)
+        if not task or task.done():
+            self._tasks[page_id] = asyncio.get_running_loop().create_task(self._run(page_id))
+
+    def unwatch(self, page_id: str):
+        """connection ปิด - หยุด poller เมื่อไม่เหลือ connection ของเพจ"""
+        remaining = self._watchers.get(page_id, 0) - 1
+        if remaining > 0:
+            self._watchers[page_id] = remaining
+            return
+        self._watchers.pop(page_id, None)
+        task = self._tasks.pop(page_id, None)
+        if task:
+            task.cancel()
+
+    def _hold_lease(self, page_id: str) -> bool:
+        key = _lease_key(page_id)
+        if self._renew_lease(keys=[key], args=[self.token, SSE_POLLER_LEASE_TTL]):
+            return True
+        return bool(r.set(key, self.token, nx=True, ex=SSE_POLLER_LEASE_TTL))
+
+    def _poll_once(self, page_id: str):
+        """1 รอบ (รันใน thread): query การเปลี่ยนแปลงแล้ว publish"""
+        if not self._hold_lease(page_id):
+            return
+
+        if is_change_feed_active():
+            # change feed ส่งให้แล้ว - เลื่อน watermark ไว้ เผื่อ change feed หยุดจะได้ไม่ส่งย้อนหลังทั้งหมด
+            r.set(_watermark_key(page_id), datetime.now(timezone.utc).isoformat(), ex=SSE_POLLER_LEASE_TTL * 20)
+            return
+
+        since_raw = r.get(_watermark_key(page_id))
+        since = datetime.fromisoformat(since_raw) if since_raw else datetime.now(timezone.utc)
+
+        db = open_read_session()
+        try:
+            page = lookup_cache.get_page(db, page_id)
+            if not page:
+                return
+            updates = crud.get_customer_updates_after(db, page.ID, since)
+        finally:
+            db.close()
+
+        for update in updates:
+            update.pop('fb_page_id', None)
+        if not since_raw or updates:
+            watermark = max((u.pop('updated_at') for u in updates), default=since)
+            r.set(_watermark_key(page_id), watermark.isoformat(), ex=SSE_POLLER_LEASE_TTL * 20)
+        if updates:
+            publish_event(page_id, "customer_update", updates)
+            logger.info(f"📡 Published {len(updates)} customer updates for page {page_id}")
+
+    async def _run(self, page_id: str):
+        try:
+            while True:
+                try:
+                    await asyncio.to_thread(self._poll_once, page_id)
+                except Exception as e:
+                    logger.error(f"❌ SSE poller error for page {page_id}: {e}")
+                await asyncio.sleep(SSE_POLL_INTERVAL)
+        finally:
+            try:
+                self._release_lease(keys=[_lease_key(page_id)], args=[self.token])
+            except Exception:
+                pass
+
+    def stop(self):
+        for task in self._tasks.values():
+            task.cancel()
+        self._tasks.clear()
+        self._watchers.clear()
+
+
+customer_change_poller = CustomerChangePoller()
@@ -0,0 +1,419 @@
+"""
+Webhook Ingest
+ประมวลผล webhook event จาก Redis Stream (webhook:events) แบบ batch ด้วย consumer group
+- webhook_post แค่ตรวจ signature แล้ว XADD -> ตอบ Facebook ได้ทันที
+- consumer อ่านทีละ batch, ทำงานกับ DB ใน session เดียว แล้ว XACK
+- event ที่ค้างใน consumer ที่ตายไปจะถูกดึงกลับมาด้วย XAUTOCLAIM
+- batch ที่ล้มเหลวถูกทำซ้ำทีละ entry เพื่อแยก entry เสีย - entry ที่ล้มเหลวครบ WEBHOOK_MAX_DELIVERIES ครั้ง
+  (นับจาก delivery count ใน XPENDING) ถูกย้ายไป dead-letter stream (webhook:dead) แล้ว XACK
+- รวม event ของลูกค้าคนเดียวกันในแต่ละช่วงเวลา (window) เหลือ 1 update / 1 new-user sync
+- บันทึกข้อความ (ขาเข้าและ echo ของเพจ) ลง customer_messages ทันที โดยใช้ mid กันซ้ำ
+  (polling sync_customer_messages_task เหลือไว้เติมช่องว่างเท่านั้น)
+- กัน event ซ้ำ (Facebook ส่ง webhook ซ้ำเมื่อ timeout/ตอบช้า) ด้วย Redis SET NX ตาม mid / watermark
+  ก่อน XADD จึงไม่มีงานกับ DB หรือ Celery เลยสำหรับ event ซ้ำ
+รันได้ทั้งเป็น thread ใน API (app.py) หรือแยก process: python -m app.service.webhook_ingest
+"""
+
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+import redis
+from sqlalchemy.exc import OperationalError
+
+from app.database import crud
+from app.database.database import SessionLocal
+from app.utils import lookup_cache
+from app.utils.redis_helper import r
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_STREAM = os.getenv("WEBHOOK_STREAM", "webhook:events")
+WEBHOOK_GROUP = os.getenv("WEBHOOK_GROUP", "webhook-ingest")
+WEBHOOK_STREAM_MAXLEN = int(os.getenv("WEBHOOK_STREAM_MAXLEN", 100000))
+WEBHOOK_BATCH_SIZE = int(os.getenv("WEBHOOK_BATCH_SIZE", 200))
+WEBHOOK_BLOCK_MS = int(os.getenv("WEBHOOK_BLOCK_MS", 1000))
+# event ที่ค้าง (ไม่ ack) นานเกินนี้จะถูก consumer อื่นดึงไปทำต่อ
+WEBHOOK_CLAIM_IDLE_MS = int(os.getenv("WEBHOOK_CLAIM_IDLE_MS", 60000))
+# entry ที่ล้มเหลวครบจำนวนครั้งนี้ถูกย้ายไป dead-letter stream (ไม่ให้ entry เสียบล็อก stream ตลอดไป)
+WEBHOOK_MAX_DELIVERIES = int(os.getenv("WEBHOOK_MAX_DELIVERIES", 5))
+WEBHOOK_DEAD_STREAM = os.getenv("WEBHOOK_DEAD_STREAM", "webhook:dead")
+WEBHOOK_DEAD_MAXLEN = int(os.getenv("WEBHOOK_DEAD_MAXLEN", 10000))
+# ระยะเวลารวบ event ก่อนเขียน DB 1 ครั้ง
+WEBHOOK_COALESCE_WINDOW_MS = int(os.getenv("WEBHOOK_COALESCE_WINDOW_MS", 500))
+# กัน sync ลูกค้าใหม่ซ้ำ (ทั้งใน window เดียวกันและข้าม window/consumer)
+NEW_USER_SYNC_LOCK_TTL = int(os.getenv("NEW_USER_SYNC_LOCK_TTL", 300))
+# Facebook retry ได้นานหลายชั่วโมง จึงจำ event ที่เห็นแล้วไว้ 1 วัน
+WEBHOOK_DEDUPE_TTL = int(os.getenv("WEBHOOK_DEDUPE_TTL", 60 * 60 * 24))
+DEDUPE_TOTAL_KEY = "webhook:dedupe:total"
+DEDUPE_HITS_KEY = "webhook:dedupe:hits"
+
+
+def event_dedupe_key(page_id: str, msg_event: Dict) -> Optional[str]:
+    """key ที่ระบุ event ได้แน่นอน: mid ของข้อความ, watermark ของ delivery/read"""
+    sender_id = (msg_event.get("sender") or {}).get("id", "")
+    message = msg_event.get("message") or {}
+    if message.get("mid"):
+        return f"webhook:seen:mid:{message['mid']}"
+    for kind in ("delivery", "read"):
+        watermark = (msg_event.get(kind) or {}).get("watermark")
+        if watermark:
+            return f"webhook:seen:{kind}:{page_id}:{sender_id}:{watermark}"
+    postback_mid = (msg_event.get("postback") or {}).get("mid")
+    if postback_mid:
+        return f"webhook:seen:mid:{postback_mid}"
+    if msg_event.get("timestamp") and sender_id:
+        return f"webhook:seen:ts:{page_id}:{sender_id}:{msg_event['timestamp']}"
+    return None
+
+
+def dedupe_webhook(body: Dict) -> Tuple[Optional[Dict], List[str]]:
+    """ตัด event ที่เคยรับแล้วออกจาก webhook body (SET NX ทุก event ใน round trip เดียว)
+
+    คืนค่า (body ที่เหลือแต่ event ใหม่ - None ถ้าซ้ำทั้งหมด, key ที่จองไว้)
+    ถ้า enqueue ไม่สำเร็จต้องเรียก release_dedupe_keys เพื่อให้ retry ของ Facebook ผ่านได้
+    """
+    candidates = []
+    for entry in body.get("entry", []):
+        for msg_event in entry.get("messaging", []):
+            key = event_dedupe_key(entry.get("id", ""), msg_event)
+            if key:
+                candidates.append((id(msg_event), key))
+
+    if not candidates:
+        return body, []
+
+    pipe = r.pipeline(transaction=False)
+    for _, key in candidates:
+        pipe.set(key, 1, nx=True, ex=WEBHOOK_DEDUPE_TTL)
+    results = pipe.execute()
+
+    duplicates = {event_id for (event_id, _), is_new in zip(candidates, results) if not is_new}
+    claimed = [key for (_, key), is_new in zip(candidates, results) if is_new]
+
+    pipe = r.pipeline(transaction=False)
+    pipe.incrby(DEDUPE_TOTAL_KEY, len(candidates))
+    if duplicates:
+        pipe.incrby(DEDUPE_HITS_KEY, len(duplicates))
+    pipe.execute()
+
+    if not duplicates:
+        return body, claimed
+
+    entries = []
+    for entry in body.get("entry", []):
+        if "messaging" in entry:
+            messaging = [e for e in entry["messaging"] if id(e) not in duplicates]
+            if not messaging:
+                continue
+            entry = {**entry, "messaging": messaging}
+        entries.append(entry)
+
+    logger.info(f"🔁 Dropped {len(duplicates)} duplicate webhook events")
+    return ({**body, "entry": entries} if entries else None), claimed
+
+
+def release_dedupe_keys(keys: List[str]):
+    if keys:
+        r.delete(*keys)
+
+
+def dedupe_stats() -> Dict:
+    total, hits = r.mget(DEDUPE_TOTAL_KEY, DEDUPE_HITS_KEY)
+    total, hits = int(total or 0), int(hits or 0)
+    return {
+        "total_events": total,
+        "duplicate_events": hits,
+        "hit_rate": round(hits / total, 4) if total else 0.0,
+    }
+
+
+def enqueue_webhook(raw_body: str) -> str:
+    """เพิ่ม webhook body ลง stream - คืนค่า stream id"""
+    return r.xadd(
+        WEBHOOK_STREAM,
+        {"body": raw_body, "received_at": str(time.time())},
+        maxlen=WEBHOOK_STREAM_MAXLEN,
+        approximate=True,
+    )
+
+
+def event_time(msg_event: Dict) -> datetime:
+    """เวลาของ event จาก timestamp (ms) ของ Facebook"""
+    timestamp = msg_event.get("timestamp")
+    if timestamp:
+        return datetime.fromtimestamp(timestamp / 1000, tz=timezone.utc)
+    return datetime.now(timezone.utc)
+
+
+def coalesce_events(events: List[Tuple[str, Dict]]) -> Dict[Tuple[str, str], datetime]:
+    """รวม event ตาม (page_id, psid) เหลือเวลาล่าสุดของแต่ละลูกค้า"""
+    latest: Dict[Tuple[str, str], datetime] = {}
+    for page_id, msg_event in events:
+        sender_id = (msg_event.get("sender") or {}).get("id")
+        if not sender_id or sender_id == page_id:
+            continue
+        key = (page_id, sender_id)
+        ts = event_time(msg_event)
+        if key not in latest or ts > latest[key]:
+            latest[key] = ts
+    return latest
+
+
+def message_content(message: Dict) -> Tuple[str, str]:
+    """(message_text, message_type) รูปแบบเดียวกับ polling sync"""
+    if message.get("text"):
+        return message["text"], "text"
+    from app.routes.facebook.psids_sync import get_message_content  # lazy import
+    content = get_message_content({"attachments": message.get("attachments")})
+    if content:
+        return content, "attachment"
+    return "", "unknown"
+
+
+def extract_messages(events: List[Tuple[str, Dict]], pages: Dict[str, int]) -> List[Dict]:
+    """แปลง messaging event ที่เป็นข้อความเป็น row ของ customer_messages"""
+    messages = []
+    for page_id, msg_event in events:
+        message = msg_event.get("message") or {}
+        mid = message.get("mid")
+        if not mid or page_id not in pages:
+            continue
+
+        is_echo = bool(message.get("is_echo"))
+        sender_id = (msg_event.get("sender") or {}).get("id")
+        # echo = ข้อความที่เพจส่ง -> ลูกค้าคือผู้รับ
+        psid = (msg_event.get("recipient") or {}).get("id") if is_echo else sender_id
+        if not sender_id or not psid:
+            continue
+
+        message_text, message_type = message_content(message)
+        messages.append({
+            "page_db_id": pages[page_id],
+            "psid": psid,
+            "sender_id": sender_id,
+            "is_echo": is_echo,
+            "mid": mid,
+            "message_text": message_text,
+            "message_type": message_type,
+            "created_at": event_time(msg_event),
+        })
+    return messages
+
+
+def extract_events(body: Dict) -> List[Tuple[str, Dict]]:
+    """แตก webhook body เป็นรายการ (page_id, messaging event)"""
+    events = []
+    for entry in body.get("entry", []):
+        page_id = entry.get("id")
+        if not page_id:
+            continue
+        for msg_event in entry.get("messaging", []):
+            events.append((page_id, msg_event))
+    return events
+
+
+class WebhookIngestConsumer:
+    def __init__(self):
+        self.consumer_name = f"{socket.gethostname()}-{os.getpid()}"
+        self.is_running = False
+        self.processed = 0
+
+    def ensure_group(self):
+        try:
+            r.xgroup_create(WEBHOOK_STREAM, WEBHOOK_GROUP, id="0", mkstream=True)
+            logger.info(f"✅ Created consumer group {WEBHOOK_GROUP} on {WEBHOOK_STREAM}")
+        except redis.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    def process_batch(self, entries: List[Tuple[str, Dict]]):
+        """ทำงานกับ DB ของทั้ง window: UPDATE เดียว + sync ลูกค้าใหม่ไม่เกิน 1 ครั้งต่อคน"""
+        events = []
+        for _, fields in entries:
+            try:
+                events.extend(extract_events(json.loads(fields.get("body") or "{}")))
+            except ValueError as e:
+                logger.error(f"❌ Invalid webhook payload in stream: {e}")
+
+        latest = coalesce_events(events)
+        if not events:
+            return
+
+        db = SessionLocal()
+        try:
+            pages = {}
+            for page_id in {page_id for page_id, _ in events}:
+                page = lookup_cache.get_page(db, page_id)
+                if page:
+                    pages[page_id] = page.ID
+
+            interactions = [
+                (pages[page_id], psid, ts) for (page_id, psid), ts in latest.items() if page_id in pages
+            ]
+            existing = crud.bulk_touch_customer_interactions(db, interactions)
+            inserted = crud.insert_webhook_messages(db, extract_messages(events, pages))
+            logger.info(
+                f"📝 Coalesced {len(events)} webhook events into {len(interactions)} interaction updates, "
+                f"{inserted} new messages"
+            )
+        except Exception as e:
+            db.rollback()
+            logger.error(f"Error processing webhook: {e}")
+            raise
+        finally:
+            db.close()
+
+        # ลูกค้าที่ยังไม่มีในฐานข้อมูล -> sync ครั้งเดียว
+        from app.celery_task.webhook_task import sync_new_user_data_task  # lazy import
+        page_ids_by_db_id = {db_id: page_id for page_id, db_id in pages.items()}
+        for page_db_id, psid, _ in interactions:
+            if (page_db_id, psid) in existing:
+                continue
+            page_id = page_ids_by_db_id[page_db_id]
+            if not r.set(f"webhook:new_user_sync:{page_id}:{psid}", 1, nx=True, ex=NEW_USER_SYNC_LOCK_TTL):
+                continue
+            logger.info(f"🆕 New user detected: {psid} in page {page_id}")
+            sync_new_user_data_task.delay(page_id, psid, page_db_id)
+
+    def _ack(self, entry_ids: List[str]):
+        r.xack(WEBHOOK_STREAM, WEBHOOK_GROUP, *entry_ids)
+        self.processed += len(entry_ids)
+
+    def _dead_letter(self, entry_id: str, fields: Dict, deliveries: int, error: Exception):
+        """ย้าย entry ไป dead-letter stream แล้ว ack (MULTI - ไม่หายระหว่างทาง)"""
+        pipe = r.pipeline()
+        pipe.xadd(
+            WEBHOOK_DEAD_STREAM,
+            {**fields, "source_id": entry_id, "deliveries": str(deliveries), "error": str(error)[:1000]},
+            maxlen=WEBHOOK_DEAD_MAXLEN,
+            approximate=True,
+        )
+        pipe.xack(WEBHOOK_STREAM, WEBHOOK_GROUP, entry_id)
+        pipe.execute()
+        logger.error(f"☠️ Webhook entry {entry_id} failed {deliveries} times, moved to {WEBHOOK_DEAD_STREAM}: {error}")
+
+    def _handle_each(self, entries: List[Tuple[str, Dict]], deliveries: Dict[str, int]):
+        """ทำทีละ entry - ack ตัวที่สำเร็จ, ตัวที่ล้มเหลวค้างไว้ให้ claim_stale ลองใหม่จนครบจำนวนครั้ง"""
+        for entry_id, fields in entries:
+            try:
+                self.process_batch([(entry_id, fields)])
+            except OperationalError:
+                raise
+            except Exception as e:
+                attempts = deliveries.get(entry_id, 1)
+                if attempts >= WEBHOOK_MAX_DELIVERIES:
+                    self._dead_letter(entry_id, fields, attempts, e)
+                else:
+                    logger.warning(f"⚠️ Webhook entry {entry_id} failed "
+                                   f"(attempt {attempts}/{WEBHOOK_MAX_DELIVERIES}), left pending: {e}")
+                continue
+            self._ack([entry_id])
+
+    def _handle(self, entries: List[Tuple[str, Dict]], deliveries: Optional[Dict[str, int]] = None):
+        """deliveries: จำนวนครั้งที่ entry ถูกส่งให้ consumer (จาก XPENDING) - entry ใหม่ = 1"""
+        if not entries:
+            return
+        if len(entries) > 1:
+            try:
+                self.process_batch(entries)
+                self._ack([entry_id for entry_id, _ in entries])
+                return
+            except OperationalError:
+                # DB ใช้งานไม่ได้ ไม่ใช่ entry เสีย -> ไม่แยกทีละ entry (ไม่ยิง DB ซ้ำเป็นพันครั้ง) รอ claim รอบถัดไป
+                raise
+            except Exception as e:
+                logger.warning(f"⚠️ Webhook batch of {len(entries)} entries failed, retrying one by one: {e}")
+        self._handle_each(entries, deliveries or {})
+
+    def _delivery_counts(self, entry_ids: List[str]) -> Dict[str, int]:
+        """times_delivered ของแต่ละ entry จาก XPENDING (round trip เดียว)"""
+        pipe = r.pipeline(transaction=False)
+        for entry_id in entry_ids:
+            pipe.xpending_range(WEBHOOK_STREAM, WEBHOOK_GROUP, min=entry_id, max=entry_id, count=1)
+        counts = {}
+        for pending in pipe.execute():
+            for item in pending:
+                counts[item["message_id"]] = item["times_delivered"]
+        return counts
+
+    def _read(self, block_ms: int) -> List[Tuple[str, Dict]]:
+        response = r.xreadgroup(
+            WEBHOOK_GROUP, self.consumer_name, {WEBHOOK_STREAM: ">"},
+            count=WEBHOOK_BATCH_SIZE, block=block_ms
+        )
+        return [entry for _, stream_entries in response or [] for entry in stream_entries]
+
+    def claim_stale(self):
+        """ดึง event ที่ consumer อื่นอ่านไปแล้วแต่ไม่ ack (เช่น process ตาย)"""
+        start_id = "0-0"
+        while True:
+            result = r.xautoclaim(
+                WEBHOOK_STREAM, WEBHOOK_GROUP, self.consumer_name,
+                min_idle_time=WEBHOOK_CLAIM_IDLE_MS, start_id=start_id, count=WEBHOOK_BATCH_SIZE
+            )
+            start_id, entries = result[0], result[1]
+            entries = [(entry_id, fields) for entry_id, fields in entries if fields]
+            if entries:
+                logger.warning(f"♻️ Reclaimed {len(entries)} stale webhook events")
+                self._handle(entries, self._delivery_counts([entry_id for entry_id, _ in entries]))
+            if start_id in ("0-0", b"0-0"):
+                break
+
+    def run(self):
+        """loop หลักของ consumer (blocking)"""
+        self.is_running = True
+        self.ensure_group()
+        last_claim = 0.0
+        logger.info(f"🚀 Webhook ingest consumer {self.consumer_name} started")
+
+        while self.is_running:
+            try:
+                if time.time() - last_claim > WEBHOOK_CLAIM_IDLE_MS / 1000:
+                    self.claim_stale()
+                    last_claim = time.time()
+
+                entries = self._read(WEBHOOK_BLOCK_MS)
+                if entries:
+                    # รวบ event ที่เข้ามาต่อเนื่องภายใน window ก่อนเขียน DB
+                    window_ends = time.time() + WEBHOOK_COALESCE_WINDOW_MS / 1000
+                    while len(entries) < WEBHOOK_BATCH_SIZE * 10:
+                        remaining_ms = int((window_ends - time.time()) * 1000)
+                        if remaining_ms <= 0:
+                            break
+                        more = self._read(remaining_ms)
+                        if not more:
+                            break
+                        entries.extend(more)
+                    self._handle(entries)
+
+            except redis.ResponseError as e:
+                if "NOGROUP" in str(e):
+                    self.ensure_group()
+                    continue
+                logger.error(f"❌ Webhook ingest error: {e}")
+                time.sleep(1)
+            except Exception as e:
+                logger.error(f"❌ Webhook ingest error: {e}")
+                time.sleep(1)
+
+    def start_in_thread(self) -> threading.Thread:
+        thread = threading.Thread(target=self.run, daemon=True, name="webhook-ingest")
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.is_running = False
+
+
+webhook_ingest_consumer = WebhookIngestConsumer()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    webhook_ingest_consumer.run()
@@ -1,4 +1,5 @@
 from apscheduler.schedulers.background import BackgroundScheduler
+import os
 import requests
 from app.database.crud import get_all_connected_pages, sync_missing_retarget_tiers
 from app.database.database import SessionLocal
@@ -10,11 +11,17 @@ from app.celery_task.messages import sync_customer_messages_task
 from app.celery_task.classification import scheduled_hybrid_classification_task, classify_page_tier_task
 from app.celery_task.auto_sync_tasks import sync_all_pages_task
 from app.database.models import FacebookPage
+from app.database.migrations import gc_media_blobs
+from app.service.send_ledger import expire_stale_claims
 import logging
 
 logger = logging.getLogger(__name__)
 
 SYNC_TIMEOUT = 60*5
+# ข้อความถูกบันทึกจาก webhook แล้ว polling ใช้เติมช่องว่างเท่านั้น (lookback 2 ชม. ยังครอบคลุม)
+MESSAGE_SYNC_INTERVAL_MINUTES = int(os.getenv("MESSAGE_SYNC_INTERVAL_MINUTES", 60))
+MEDIA_GC_INTERVAL_HOURS = int(os.getenv("MEDIA_GC_INTERVAL_HOURS", 6))
+SEND_LEDGER_EXPIRE_INTERVAL_MINUTES = int(os.getenv("SEND_LEDGER_EXPIRE_INTERVAL_MINUTES", 10))
 
 # ฟังก์ชันสำหรับ sync ข้อมูลลูกค้าจาก Facebook
 def schedule_facebook_sync():
@@ -72,13 +79,19 @@ def start_scheduler():
     # Sync ข้อมูลลูกค้าทุกๆ 1 นาที (เดิม)
     scheduler.add_job(schedule_facebook_sync, 'interval', minutes=10)
     
-    # Sync ข้อความทุกนาที (เดิม)
-    scheduler.add_job(schedule_facebook_messages_sync, 'interval', minutes=10) 
+    # Sync ข้อความ (backstop ของ webhook)
+    scheduler.add_job(schedule_facebook_messages_sync, 'interval', minutes=MESSAGE_SYNC_INTERVAL_MINUTES)
     
     # 🆕 แก้ไข: เปลี่ยนจาก 1 นาที
     scheduler.add_job(scheduled_hybrid_classification, 'interval', minutes=10)
 
     scheduler.add_job(sync_all_pages_task.delay, 'interval', minutes=10)
+
+    # ลบไฟล์สื่อใน blob store ที่ไม่มีข้อความอ้างถึงแล้ว
+    scheduler.add_job(gc_media_blobs, 'interval', hours=MEDIA_GC_INTERVAL_HOURS)
+
+    # pending ที่ค้างใน send ledger (worker ตายหลัง claim) -> unknown
+    scheduler.add_job(expire_stale_claims, 'interval', minutes=SEND_LEDGER_EXPIRE_INTERVAL_MINUTES)
     
     # Sync retarget tiers เฉพาะตอนเริ่มระบบ
     sync_missing_tiers_on_startup()
@@ -0,0 +1,184 @@
+"""
+Blob Store
+เก็บไฟล์สื่อบนดิสก์แบบ content-addressed (ชื่อไฟล์ = sha256)
+- ไฟล์เดียวกันถูกเก็บครั้งเดียว
+- แบ่งโฟลเดอร์ตาม 2 ตัวแรกของ digest ไม่ให้โฟลเดอร์เดียวมีไฟล์มากเกินไป
+- เขียนแบบ atomic (เขียนไฟล์ชั่วคราวแล้ว rename)
+- row ในฐานข้อมูลเก็บแค่ media_digest / media_size / media_mime
+- ไฟล์ที่ไม่มี row อ้างถึงแล้วถูกลบโดย remove_orphan_blobs (เรียกจาก gc_media_blobs เป็นระยะ)
+- ใช้ส่งสื่อให้ Celery task ด้วย digest เช่นกัน (ไม่มี row อ้างถึง จึงอยู่ได้อย่างน้อย MEDIA_GC_MIN_AGE_HOURS)
+  MEDIA_DIR จึงต้องเป็น volume ที่ API และ worker เห็นร่วมกัน
+"""
+
+import hashlib
+import os
+import re
+import tempfile
+import time
+from typing import Callable, Dict, Optional, Set
+
+MEDIA_DIR = os.getenv(
+    "MEDIA_DIR",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), "media_store")
+)
+# base URL ของ /media/{digest} ที่ส่งให้ frontend
+MEDIA_BASE_URL = os.getenv("MEDIA_BASE_URL", "http://localhost:8000")
+
+MEDIA_URL_RE = re.compile(r"/media/([0-9a-f]{64})(?:[?#].*)?$")
+DIGEST_RE = re.compile(r"[0-9a-f]{64}")
+
+DEFAULT_MIME = {"image": "image/jpeg", "video": "video/mp4"}
+
+
+def blob_path(digest: str) -> str:
+    return os.path.join(MEDIA_DIR, digest[:2], digest[2:4], digest)
+
+
+def has_blob(digest: Optional[str]) -> bool:
+    return bool(digest) and os.path.isfile(blob_path(digest))
+
+
+def put_blob(data: bytes) -> str:
+    """เก็บไฟล์แล้วคืนค่า digest - ถ้ามีไฟล์นี้อยู่แล้วจะไม่เขียนซ้ำ"""
+    digest = hashlib.sha256(data).hexdigest()
+    path = blob_path(digest)
+    if os.path.isfile(path):
+        # อัปเดต mtime - GC จะไม่ลบ blob ที่เพิ่งถูกอ้างถึงใหม่ (row อาจยังไม่ commit)
+        os.utime(path)
+        return digest
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return digest
+
+
+def read_blob(digest: str) -> Optional[bytes]:
+    """อ่านไฟล์ทั้งหมด - None ถ้าไม่พบ (ส่งให้ client ใช้ /media/{digest} ซึ่ง stream จากไฟล์แทน)"""
+    path = blob_path(digest)
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def remove_orphan_blobs(referenced: Set[str], min_age_seconds: float) -> int:
+    """ลบ blob ที่ไม่อยู่ใน referenced และไม่ถูกเขียน/อ้างถึงภายใน min_age_seconds - คืนจำนวนที่ลบ"""
+    cutoff = time.time() - min_age_seconds
+    removed = 0
+    for root, _, files in os.walk(MEDIA_DIR):
+        for name in files:
+            # .tmp- ที่ค้างจาก put_blob ที่ล้มเหลวก็ลบเมื่อเก่าพอ
+            if name in referenced or not (DIGEST_RE.fullmatch(name) or name.startswith(".tmp-")):
+                continue
+            path = os.path.join(root, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    removed += 1
+            except FileNotFoundError:
+                continue
+    return removed
+
+
+def guess_mime(data: bytes, message_type: str) -> str:
+    """เดา mime จาก magic bytes (fallback ตามประเภทข้อความ)"""
+    head = data[:16]
+    if head.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if head.startswith(b"\x89PNG"):
+        return "image/png"
+    if head.startswith((b"GIF87a", b"GIF89a")):
+        return "image/gif"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    if head[4:8] == b"ftyp":
+        return "video/quicktime" if head[8:10] == b"qt" else "video/mp4"
+    if head.startswith(b"\x1a\x45\xdf\xa3"):
+        return "video/webm"
+    return DEFAULT_MIME.get(message_type, "application/octet-stream")
+
+
+def store_media(data: Optional[bytes], message_type: str) -> Dict:
+    """เก็บสื่อแล้วคืนค่า field สำหรับ row (ใช้กับ setattr / constructor)"""
+    if not data:
+        return {"media_digest": None, "media_size": None, "media_mime": None, "image_data": None}
+    return {
+        "media_digest": put_blob(data),
+        "media_size": len(data),
+        "media_mime": guess_mime(data, message_type),
+        "image_data": None,
+    }
+
+
+def media_url(digest: str) -> str:
+    return f"{MEDIA_BASE_URL}/media/{digest}"
+
+
+def digest_from_media_url(value: Optional[str]) -> Optional[str]:
+    """ดึง digest จาก URL ของ /media/{digest} (None ถ้าไม่ใช่ URL ของ blob store)"""
+    if not value or len(value) > 2048:
+        return None
+    match = MEDIA_URL_RE.search(value)
+    return match.group(1) if match else None
+
+
+def blob_media_fields(digest: str, message_type: str) -> Optional[Dict]:
+    """field ของ row จาก blob ที่มีอยู่แล้ว - None ถ้าไม่พบไฟล์"""
+    path = blob_path(digest)
+    if not os.path.isfile(path):
+        return None
+    with open(path, "rb") as f:
+        head = f.read(16)
+    return {
+        "media_digest": digest,
+        "media_size": os.path.getsize(path),
+        "media_mime": guess_mime(head, message_type),
+        "image_data": None,
+    }
+
+
+def media_fields_from_input(value: Optional[str], message_type: str,
+                            decode: Callable[[Optional[str], str], Optional[bytes]]) -> Optional[Dict]:
+    """แปลงค่าที่ frontend ส่งมา (base64 หรือ URL ของ /media) เป็น field ของ row
+
+    frontend ส่ง image_base64 ที่ได้จาก listing กลับมาตอนแก้ไข ซึ่งตอนนี้เป็น URL
+    -> อ้างอิง blob เดิม ไม่ decode เป็น base64 (คืนค่า None = ไม่เปลี่ยนสื่อ ถ้าไม่พบ blob)
+    """
+    digest = digest_from_media_url(value)
+    if digest:
+        return blob_media_fields(digest, message_type)
+    return store_media(decode(value, message_type), message_type)
+
+
+def row_has_media(row) -> bool:
+    # has_legacy_media เป็น boolean ที่ query มาพร้อม row จึงไม่ต้องโหลด image_data (deferred)
+    return bool(row.media_digest) or bool(row.has_legacy_media)
+
+
+def row_media_digest(row) -> Optional[str]:
+    """digest ของสื่อใน row (row เก่าที่ยังไม่ย้ายออกจาก image_data ใช้ hash ของ bytes)"""
+    if row.media_digest:
+        return row.media_digest
+    if row.has_legacy_media and row.image_data:
+        return hashlib.sha256(row.image_data).hexdigest()
+    return None
+
+
+def load_row_media(row) -> Optional[bytes]:
+    """โหลดสื่อของ row จาก blob store (fallback เป็น image_data เดิม - โหลดเฉพาะ row ที่มี)"""
+    if row.media_digest:
+        data = read_blob(row.media_digest)
+        if data is not None:
+            return data
+    return row.image_data if row.has_legacy_media else None
@@ -0,0 +1,202 @@
+"""
+Lookup Cache
+cache ในโปรเซสสำหรับ lookup ที่ถูกเรียกบ่อยที่สุด (webhook, Celery task, SSE, scheduler)
+- page_id (Facebook) -> PageSnapshot (ID, page_id, page_name, created_at)
+- (page DB ID, psid) -> customer id  และ negative cache สำหรับ psid ที่ยังไม่มีในฐานข้อมูล
+- ขนาดจำกัดแบบ LRU + TTL
+- invalidate ข้ามโปรเซสผ่าน Redis pub/sub (channel lookup_cache:invalidate)
+
+คืนค่าเป็น snapshot ไม่ใช่ ORM object (ใช้ข้าม session ได้ และแก้ไขไม่ได้)
+ถ้าต้องแก้ไขหรือใช้ relationship ให้ query ด้วย crud ตามเดิม
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from typing import Any, Hashable, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+from app.database import models
+from app.utils.redis_helper import r
+
+logger = logging.getLogger(__name__)
+
+PAGE_CACHE_SIZE = int(os.getenv("PAGE_CACHE_SIZE", 1000))
+PAGE_CACHE_TTL = int(os.getenv("PAGE_CACHE_TTL", 300))
+CUSTOMER_CACHE_SIZE = int(os.getenv("CUSTOMER_CACHE_SIZE", 100000))
+CUSTOMER_CACHE_TTL = int(os.getenv("CUSTOMER_CACHE_TTL", 600))
+# psid ที่ยังไม่มีจะถูกสร้างโดย sync ในไม่ช้า จึงจำไว้สั้นๆ
+NEGATIVE_CACHE_TTL = int(os.getenv("NEGATIVE_CACHE_TTL", 30))
+INVALIDATE_CHANNEL = "lookup_cache:invalidate"
+
+PageSnapshot = namedtuple("PageSnapshot", ["ID", "page_id", "page_name", "created_at"])
+
+_MISSING = object()
+
+
+class TTLCache:
+    """LRU + TTL แบบ thread-safe"""
+
+    def __init__(self, maxsize: int, ttl: int):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Any:
+        """คืนค่า _MISSING ถ้าไม่มีหรือหมดอายุ (None เป็นค่าที่ cache ได้)"""
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] < time.monotonic():
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return _MISSING
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[int] = None):
+        with self._lock:
+            self._data[key] = (time.monotonic() + (ttl or self.ttl), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key: Hashable):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
+
+
+page_cache = TTLCache(PAGE_CACHE_SIZE, PAGE_CACHE_TTL)
+customer_cache = TTLCache(CUSTOMER_CACHE_SIZE, CUSTOMER_CACHE_TTL)
+
+_listener_pid: Optional[int] = None
+_listener_lock = threading.Lock()
+
+
+def _listen_invalidations():
+    while True:
+        try:
+            pubsub = r.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(INVALIDATE_CHANNEL)
+            # cache อาจพลาด message ระหว่างที่หลุดการเชื่อมต่อ -> ล้างทั้งหมดเมื่อ subscribe ใหม่
+            page_cache.clear()
+            customer_cache.clear()
+            for message in pubsub.listen():
+                _apply_invalidation(message.get("data") or "")
+        except Exception as e:
+            logger.error(f"❌ Lookup cache invalidation listener error: {e}")
+            time.sleep(1)
+
+
+def _apply_invalidation(data: str):
+    kind, _, key = data.partition(":")
+    if kind == "page":
+        page_cache.delete(key)
+    elif kind == "customer":
+        page_db_id, _, psid = key.partition(":")
+        customer_cache.delete((int(page_db_id), psid))
+    elif kind == "all":
+        page_cache.clear()
+        customer_cache.clear()
+
+
+def _ensure_listener() -> bool:
+    """เริ่ม thread รับ invalidation ครั้งแรกที่ใช้ cache (แยกตาม pid เพราะ Celery prefork fork หลัง import)
+
+    คืนค่า False ถ้ายังเริ่มไม่ได้ -> ไม่ใช้ cache (ไม่เสี่ยงได้ข้อมูลเก่าโดยไม่มีใคร invalidate)
+    """
+    global _listener_pid
+    if _listener_pid == os.getpid():
+        return True
+    with _listener_lock:
+        if _listener_pid != os.getpid():
+            try:
+                threading.Thread(target=_listen_invalidations, daemon=True, name="lookup-cache-invalidate").start()
+                _listener_pid = os.getpid()
+            except Exception as e:
+                logger.error(f"❌ Cannot start lookup cache listener: {e}")
+                return False
+    return True
+
+
+def _publish(data: str):
+    try:
+        r.publish(INVALIDATE_CHANNEL, data)
+    except Exception as e:
+        logger.error(f"❌ Cannot publish lookup cache invalidation {data}: {e}")
+
+
+def get_page(db: Session, page_id: str) -> Optional[PageSnapshot]:
+    """page row จาก Facebook page_id (None ถ้าไม่พบ - ไม่ cache ค่า None)"""
+    if _ensure_listener():
+        cached = page_cache.get(page_id)
+        if cached is not _MISSING:
+            return cached
+
+    row = db.query(
+        models.FacebookPage.ID, models.FacebookPage.page_id,
+        models.FacebookPage.page_name, models.FacebookPage.created_at
+    ).filter(models.FacebookPage.page_id == page_id).first()
+    if not row:
+        return None
+
+    snapshot = PageSnapshot(row.ID, row.page_id, row.page_name, row.created_at)
+    page_cache.set(page_id, snapshot)
+    return snapshot
+
+
+def get_customer_id(db: Session, page_db_id: int, psid: str) -> Optional[int]:
+    """fb_customers.id จาก (page DB ID, psid) - psid ที่ไม่พบถูกจำไว้ NEGATIVE_CACHE_TTL วินาที"""
+    key = (page_db_id, psid)
+    if _ensure_listener():
+        cached = customer_cache.get(key)
+        if cached is not _MISSING:
+            return cached
+
+    row = db.query(models.FbCustomer.id).filter(
+        models.FbCustomer.page_id == page_db_id,
+        models.FbCustomer.customer_psid == psid
+    ).first()
+    customer_id = row.id if row else None
+    customer_cache.set(key, customer_id, None if customer_id else NEGATIVE_CACHE_TTL)
+    return customer_id
+
+
+def invalidate_page(page_id: str):
+    page_cache.delete(page_id)
+    _publish(f"page:{page_id}")
+
+
+def invalidate_customer(page_db_id: int, psid: str):
+    customer_cache.delete((page_db_id, psid))
+    _publish(f"customer:{page_db_id}:{psid}")
+
+
+def invalidate_all():
+    page_cache.clear()
+    customer_cache.clear()
+    _publish("all")
+
+
+def cache_stats() -> dict:
+    return {"pages": page_cache.stats(), "customers": customer_cache.stats()}
@@ -0,0 +1,31 @@
+import os
+import time
+
+from app.utils import blob_store
+
+
+def test_remove_orphan_blobs_keeps_referenced_and_recent(monkeypatch, tmp_path):
+    monkeypatch.setattr(blob_store, "MEDIA_DIR", str(tmp_path))
+    kept = blob_store.put_blob(b"referenced")
+    orphan = blob_store.put_blob(b"orphan")
+    recent = blob_store.put_blob(b"recent orphan")
+
+    old = time.time() - 3600
+    for digest in (kept, orphan):
+        os.utime(blob_store.blob_path(digest), (old, old))
+
+    assert blob_store.remove_orphan_blobs({kept}, min_age_seconds=60) == 1
+    assert blob_store.read_blob(kept) == b"referenced"
+    assert blob_store.read_blob(orphan) is None
+    assert blob_store.has_blob(recent)
+
+
+def test_put_blob_refreshes_mtime_of_existing_blob(monkeypatch, tmp_path):
+    monkeypatch.setattr(blob_store, "MEDIA_DIR", str(tmp_path))
+    digest = blob_store.put_blob(b"shared")
+    path = blob_store.blob_path(digest)
+    os.utime(path, (0, 0))
+
+    blob_store.put_blob(b"shared")
+
+    assert os.path.getmtime(path) > 0
@@ -0,0 +1,116 @@
+import asyncio
+import re
+from datetime import timedelta
+
+import pytest
+from sqlalchemy import event, inspect
+from sqlalchemy.dialects import postgresql
+
+import app.routes.facebook.main  # noqa: F401
+from app.database import models
+from app.routes.custom_messages import custom_messages_query, get_message_sets_by_page
+from app.routes.facebook.schedules import get_all_schedules_with_details
+from app.routes.group_messages import (group_message_ids_query, group_messages_query, knowledge_group_messages_query,
+                                       message_schedules_query, schedule_summary_messages_query)
+
+MEDIA = b"\xff\xd8\xff" + b"\0" * 4096
+
+
+def _selects_media_bytes(stmt) -> bool:
+    """SQL ดึง image_data มาด้วยหรือไม่ (has_legacy_media = image_data IS NOT NULL ไม่นับ)"""
+    sql = str(stmt.compile(dialect=postgresql.dialect()))
+    return "image_data" in re.sub(r"\w+\.image_data IS NOT NULL", "", sql)
+
+
+def _loaded_messages(session) -> list:
+    """ข้อความทุก row ที่ query โหลดเข้า session (เก็บ reference ไว้ - identity map เป็น weak ref)"""
+    return [obj for obj in session.info["loaded"]
+            if isinstance(obj, (models.CustomerTypeMessage, models.FBCustomMessage))]
+
+
+def _loaded_media_bytes(session) -> int:
+    """bytes ของ image_data ที่ถูกโหลดเข้า session (column ที่ยัง unloaded ไม่นับ)"""
+    return sum(
+        len(obj.__dict__.get("image_data") or b"")
+        for obj in _loaded_messages(session)
+        if "image_data" not in inspect(obj).unloaded
+    )
+
+
+@pytest.fixture
+def seeded_db(message_db):
+    db = message_db
+    db.add_all([
+        models.FacebookPage(ID=1, page_id="page-1", page_name="Page"),
+        models.CustomerTypeCustom(id=10, page_id=1, type_name="VIP", rule_description="-"),
+        models.CustomerTypeKnowledge(id=20, type_name="Knowledge", rule_description="-"),
+        models.PageCustomerTypeKnowledge(id=30, page_id=1, customer_type_knowledge_id=20),
+        models.CustomerTypeMessage(id=100, page_id=1, customer_type_custom_id=10, message_type="image",
+                                   content="a.jpg", display_order=1, image_data=MEDIA),
+        models.CustomerTypeMessage(id=101, page_id=1, page_customer_type_knowledge_id=30, message_type="image",
+                                   content="b.jpg", display_order=1, image_data=MEDIA),
+        models.MessageSchedule(id=1000, customer_type_message_id=100, send_type="after_inactive",
+                               send_after_inactive=timedelta(days=1)),
+        models.MessageSchedule(id=1001, customer_type_message_id=101, send_type="immediate"),
+        models.MessageSets(id=200, page_id="page-1", set_name="Set"),
+        models.FBCustomMessage(id=300, message_set_id=200, page_id="page-1", message_type="image",
+                               content="c.jpg", display_order=1, image_data=MEDIA),
+    ])
+    db.commit()
+    db.expunge_all()
+
+    db.info["loaded"] = []
+    event.listen(db, "loaded_as_persistent", lambda session, obj: session.info["loaded"].append(obj))
+    return db
+
+
+def test_group_message_listings_skip_media_bytes():
+    assert not _selects_media_bytes(group_messages_query(1, 2))
+    assert not _selects_media_bytes(knowledge_group_messages_query(1, 2))
+
+
+def test_custom_message_listing_skips_media_bytes():
+    assert not _selects_media_bytes(custom_messages_query(1))
+
+
+def test_executed_message_listings_leave_image_data_unloaded(seeded_db):
+    for stmt in (group_messages_query(1, 10), knowledge_group_messages_query(1, 20), custom_messages_query(200)):
+        rows = seeded_db.execute(stmt).scalars().all()
+        assert rows
+        for row in rows:
+            assert "image_data" in inspect(row).unloaded
+            assert row.has_legacy_media
+    assert _loaded_media_bytes(seeded_db) == 0
+
+
+def test_schedule_queries_fetch_no_media_bytes(seeded_db):
+    # get_group_schedules
+    for group_id in ("10", "knowledge_20"):
+        schedules = seeded_db.execute(message_schedules_query(group_message_ids_query(1, group_id))).scalars().all()
+        assert len(schedules) == 1
+        assert "customer_type_message" in inspect(schedules[0]).unloaded
+
+    # get_group_schedule_summaries
+    rows = seeded_db.execute(schedule_summary_messages_query(1, [10])).all()
+    assert [tuple(row) for row in rows] == [(10, 100)]
+    seeded_db.execute(message_schedules_query([100])).scalars().all()
+
+    assert _loaded_media_bytes(seeded_db) == 0
+
+
+def test_all_schedules_join_fetches_no_media_bytes(seeded_db):
+    result = asyncio.run(get_all_schedules_with_details("page-1", db=seeded_db))
+
+    assert result["total_groups"] == 2
+    messages = _loaded_messages(seeded_db)
+    assert len(messages) == 2
+    assert all("image_data" in inspect(msg).unloaded for msg in messages)
+    assert _loaded_media_bytes(seeded_db) == 0
+
+
+def test_message_sets_listing_fetches_no_media_bytes(seeded_db):
+    sets = get_message_sets_by_page("page-1", db=seeded_db)
+
+    assert [s.id for s in sets] == [200]
+    assert "messages" in inspect(sets[0]).unloaded
+    assert _loaded_media_bytes(seeded_db) == 0
@@ -0,0 +1,33 @@
+import asyncio
+
+# app import routes ก่อน scheduler (routes.facebook.auth import message_scheduler กลับ)
+import app.routes.facebook.main  # noqa: F401
+from app.service import send_ledger
+from app.service.message_scheduler import MessageScheduler
+
+
+def test_repeat_schedule_starts_new_campaign_key(monkeypatch, fake_redis):
+    monkeypatch.setattr(send_ledger, "r", fake_redis)
+    scheduler = MessageScheduler()
+    schedule = {"id": 42, "date": "2026-01-01", "repeat": {"type": "daily"}}
+
+    first_run = send_ledger.schedule_campaign_key("42")
+    assert send_ledger.schedule_campaign_key("42") == first_run
+
+    asyncio.run(scheduler.handle_repeat("page-1", schedule, None))
+
+    second_run = send_ledger.schedule_campaign_key("42")
+    assert schedule["date"] == "2026-01-02"
+    assert second_run != first_run
+
+
+def test_reset_schedule_epoch_changes_key_within_same_second(monkeypatch, fake_redis):
+    monkeypatch.setattr(send_ledger, "r", fake_redis)
+    monkeypatch.setattr(send_ledger.time, "time", lambda: 1_700_000_000)
+
+    keys = {send_ledger.schedule_campaign_key("7")}
+    for _ in range(3):
+        send_ledger.reset_schedule_epoch("7")
+        keys.add(send_ledger.schedule_campaign_key("7"))
+
+    assert len(keys) == 4
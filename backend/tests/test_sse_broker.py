@@ -0,0 +1,102 @@
+import asyncio
+
+import app.routes.facebook.main  # noqa: F401
+from app.service import sse_broker
+from app.service.sse_broker import SSEBroker, Subscription
+
+
+class FakePubSub:
+    def __init__(self):
+        self.channels = set()
+
+    async def subscribe(self, *channels):
+        self.channels.update(channels)
+
+    async def close(self):
+        pass
+
+
+class FakeAsyncRedis:
+    def pubsub(self, ignore_subscribe_messages=True):
+        return FakePubSub()
+
+
+def _broker(page_id, subscription, last_id):
+    broker = SSEBroker()
+    broker._redis = FakeAsyncRedis()
+    broker._pubsub = FakePubSub()
+    broker._subscribers[page_id] = {subscription}
+    if last_id:
+        broker._last_ids[page_id] = last_id
+    return broker
+
+
+def test_resubscribe_replays_events_published_during_outage(monkeypatch):
+    missed = [("5-0", {"type": "customer_update", "data": [{"psid": "A"}]}),
+              ("6-0", {"type": "customer_update", "data": [{"psid": "B"}]})]
+    calls = []
+
+    def replay_events(page_id, last_event_id):
+        calls.append((page_id, last_event_id))
+        return missed, False
+
+    monkeypatch.setattr(sse_broker, "replay_events", replay_events)
+
+    async def run():
+        subscription = Subscription("page-1")
+        broker = _broker("page-1", subscription, "4-0")
+        await broker._resubscribe()
+        # event ที่ได้จาก replay แล้วมาซ้ำทาง pub/sub จะไม่ถูกส่งซ้ำ
+        broker._fan_out("page-1", "6-0", missed[1][1])
+        broker._fan_out("page-1", "7-0", {"type": "customer_update", "data": [{"psid": "C"}]})
+        return subscription.drain(), broker
+
+    received, broker = asyncio.run(run())
+
+    assert calls == [("page-1", "4-0")]
+    assert [event_id for event_id, _ in received] == ["5-0", "6-0", "7-0"]
+    assert broker._last_ids["page-1"] == "7-0"
+    assert "sse:page:page-1" in broker._pubsub.channels
+
+
+def test_resubscribe_asks_clients_to_resync_when_gap_is_lost(monkeypatch):
+    monkeypatch.setattr(sse_broker, "replay_events", lambda page_id, last_event_id: ([], True))
+
+    async def run(last_id):
+        subscription = Subscription("page-1")
+        subscription.offer(("3-0", {"type": "customer_update", "data": [{"psid": "A"}]}))
+        broker = _broker("page-1", subscription, last_id)
+        await broker._resubscribe()
+        return await subscription.next_events(timeout=1)
+
+    # "3-0": ถูกตัดออกจาก buffer แล้ว / None: ไม่รู้จุดเริ่ม (stream ว่างตอน subscribe)
+    for last_id in ("3-0", None):
+        events = asyncio.run(run(last_id))
+        assert [(event_id, event["type"]) for event_id, event in events] == [(None, "resync")]
+
+
+def test_coalesce_keeps_latest_state_across_event_types():
+    items = [
+        ("1-0", {"type": "customer_update", "data": [{"psid": "A", "name": "A", "group": "Y"}]}),
+        ("2-0", {"type": "customer_type_update", "data": [{"psid": "A", "group": "Z"}]}),
+        ("3-0", {"type": "customer_update", "data": [{"psid": "A", "name": "A", "group": "W"}]}),
+    ]
+
+    assert sse_broker.coalesce_events(items) == [
+        {"type": "customer_update", "data": [{"psid": "A", "name": "A", "group": "W"}]},
+    ]
+
+
+def test_coalesce_applies_partial_updates_onto_full_state_in_last_seen_order():
+    items = [
+        ("1-0", {"type": "customer_update", "data": [{"psid": "A", "name": "A", "group": "Y"},
+                                                     {"psid": "B", "name": "B", "group": "Y"}]}),
+        ("2-0", {"type": "customer_type_update", "data": [{"psid": "A", "group": "Z"}]}),
+        ("3-0", {"type": "customer_type_update", "data": [{"psid": "C", "group": "Z"}]}),
+    ]
+
+    assert sse_broker.coalesce_events(items) == [
+        {"type": "customer_update", "data": [{"psid": "B", "name": "B", "group": "Y"},
+                                             {"psid": "A", "name": "A", "group": "Z"}]},
+        {"type": "customer_type_update", "data": [{"psid": "C", "group": "Z"}]},
+    ]
@@ -0,0 +1,63 @@
+import pytest
+
+import app.routes.facebook.main  # noqa: F401
+from app.service import webhook_ingest
+from app.service.webhook_ingest import WEBHOOK_DEAD_STREAM, WEBHOOK_MAX_DELIVERIES, WEBHOOK_STREAM
+
+
+@pytest.fixture
+def consumer(monkeypatch, fake_redis):
+    """consumer ที่ process_batch ล้มเหลวทุกครั้งที่ batch มี entry เสีย"""
+    monkeypatch.setattr(webhook_ingest, "r", fake_redis)
+    consumer = webhook_ingest.WebhookIngestConsumer()
+    consumer.batches = []
+
+    def process_batch(entries):
+        consumer.batches.append([entry_id for entry_id, _ in entries])
+        if any(fields["body"] == "bad" for _, fields in entries):
+            raise ValueError("violates foreign key constraint")
+
+    monkeypatch.setattr(consumer, "process_batch", process_batch)
+    return consumer
+
+
+def _deliver(fake_redis, bodies):
+    """XADD + XREADGROUP: entry ใหม่อยู่ใน pending ของ group (delivery count = 1)"""
+    entries = []
+    for body in bodies:
+        entry_id = fake_redis.xadd(WEBHOOK_STREAM, {"body": body})
+        fake_redis.pending[entry_id] = 1
+        entries.append((entry_id, {"body": body}))
+    return entries
+
+
+def test_bad_entry_is_isolated_from_its_batch(consumer, fake_redis):
+    entries = _deliver(fake_redis, ["ok", "bad", "ok"])
+
+    consumer._handle(entries)
+
+    # batch ล้มเหลว -> ทำทีละ entry: entry ดีถูก ack, entry เสียค้างไว้ลองใหม่
+    assert consumer.batches[0] == ["1-0", "2-0", "3-0"]
+    assert list(fake_redis.pending) == ["2-0"]
+    assert consumer.processed == 2
+    assert WEBHOOK_DEAD_STREAM not in fake_redis.streams
+
+
+def test_entry_failing_every_delivery_moves_to_dead_letter_stream(consumer, fake_redis):
+    entries = _deliver(fake_redis, ["ok", "bad", "ok"])
+    consumer._handle(entries)
+
+    for _ in range(WEBHOOK_MAX_DELIVERIES - 1):
+        consumer.claim_stale()
+
+    assert fake_redis.pending == {}
+    dead = fake_redis.streams[WEBHOOK_DEAD_STREAM]
+    assert len(dead) == 1
+    assert dead[0][1]["source_id"] == "2-0"
+    assert dead[0][1]["body"] == "bad"
+    assert dead[0][1]["deliveries"] == str(WEBHOOK_MAX_DELIVERIES)
+    assert "foreign key" in dead[0][1]["error"]
+    # entry เสียถูกลองเดี่ยวๆ ครบ WEBHOOK_MAX_DELIVERIES ครั้ง แล้วไม่ถูก claim อีก
+    assert consumer.batches.count(["2-0"]) == WEBHOOK_MAX_DELIVERIES
+    consumer.claim_stale()
+    assert consumer.batches.count(["2-0"]) == WEBHOOK_MAX_DELIVERIES
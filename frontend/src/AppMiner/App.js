@@ -992,10 +992,18 @@ function App() {
   // SECTION 14: REALTIME UPDATES HOOK
   // =====================================================
   
+  // ✅ SSE แจ้งว่าพลาด event เกิน buffer -> โหลดรายชื่อใหม่ (เฉพาะเพจที่เปิดอยู่)
+  const handleRealtimeResync = useCallback((pageId) => {
+    if (pageId === selectedPage) {
+      loadConversations(pageId, true, false, true);
+    }
+  }, [selectedPage, loadConversations]);
+
   const { disconnect, reconnect } = useRealtimeUpdates(
     pages,              // ✅ ส่ง pages ทั้งหมด
     selectedPage,       // ✅ ส่ง selectedPage เพื่อใช้ในการแสดง notification
-    handleRealtimeUpdate // ✅ callback รับ pageId ด้วย
+    handleRealtimeUpdate, // ✅ callback รับ pageId ด้วย
+    handleRealtimeResync
   );
 
   // =====================================================
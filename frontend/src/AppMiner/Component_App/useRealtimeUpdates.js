@@ -2,158 +2,194 @@
 
 import { useEffect, useRef, useCallback } from 'react';
 
-export const useRealtimeUpdates = (pages, selectedPageId, onUpdate) => {
-  const eventSourcesRef = useRef({});
-  const reconnectTimeoutsRef = useRef({});
-  const reconnectAttemptsRef = useRef({});
-  const lastEventIdsRef = useRef({});
-
-  // ✅ สร้าง connection สำหรับเพจเดียว
-  const connectToPage = useCallback((pageId) => {
-    if (!pageId) return;
-
-    // ปิด connection เดิม (ถ้ามี)
-    if (eventSourcesRef.current[pageId]) {
-      eventSourcesRef.current[pageId].close();
-      delete eventSourcesRef.current[pageId];
+const WS_URL = 'ws://localhost:8000/ws/customers';
+
+// ✅ WebSocket เดียวสำหรับทุกเพจ (แทน SSE 1 connection ต่อเพจ)
+export const useRealtimeUpdates = (pages, selectedPageId, onUpdate, onResync) => {
+  const socketRef = useRef(null);
+  const reconnectTimeoutRef = useRef(null);
+  const reconnectAttemptsRef = useRef(0);
+  const closedByUserRef = useRef(false);
+  // เพจที่ subscribe อยู่บน socket ปัจจุบัน
+  const subscribedRef = useRef(new Set());
+  // seq ล่าสุดต่อเพจจาก server (ใช้ต่อ stream ตอน reconnect แทนการโหลดใหม่ทั้งหมด)
+  const streamIdsRef = useRef({});
+  const pageIdsRef = useRef([]);
+  // เก็บใน ref เพื่อไม่ให้ connection ถูกสร้างใหม่เมื่อ callback เปลี่ยน
+  const onUpdateRef = useRef(onUpdate);
+  onUpdateRef.current = onUpdate;
+  const onResyncRef = useRef(onResync);
+  onResyncRef.current = onResync;
+
+  pageIdsRef.current = Array.isArray(pages)
+    ? pages.filter(page => page && page.id).map(page => page.id)
+    : [];
+
+  const send = useCallback((message) => {
+    const socket = socketRef.current;
+    if (socket && socket.readyState === WebSocket.OPEN) {
+      socket.send(JSON.stringify(message));
     }
+  }, []);
 
-    console.log(`🔌 Connecting to SSE for page ${pageId}`);
-    
-    const eventSource = new EventSource(
-      `http://localhost:8000/sse/customers/${pageId}`
-    );
-    
-    eventSourcesRef.current[pageId] = eventSource;
-
-    eventSource.onopen = () => {
-      console.log(`✅ SSE connection established for page ${pageId}`);
-      reconnectAttemptsRef.current[pageId] = 0;
-    };
+  // ✅ ปรับ subscription ให้ตรงกับรายการเพจ (ไม่ต้อง reconnect)
+  const syncSubscriptions = useCallback(() => {
+    const socket = socketRef.current;
+    if (!socket || socket.readyState !== WebSocket.OPEN) return;
+
+    const wanted = new Set(pageIdsRef.current);
+    subscribedRef.current.forEach(pageId => {
+      if (!wanted.has(pageId)) {
+        send({ action: 'unsubscribe', page_id: pageId });
+        subscribedRef.current.delete(pageId);
+        delete streamIdsRef.current[pageId];
+      }
+    });
+    wanted.forEach(pageId => {
+      if (!subscribedRef.current.has(pageId)) {
+        send({ action: 'subscribe', page_id: pageId, last_seq: streamIdsRef.current[pageId] || null });
+        subscribedRef.current.add(pageId);
+      }
+    });
+  }, [send]);
+
+  const handleMessage = useCallback((event) => {
+    let data;
+    try {
+      data = JSON.parse(event.data);
+    } catch (error) {
+      console.error('Error parsing realtime data:', error);
+      return;
+    }
+
+    const pageId = data.page_id;
+    if (pageId && data.seq) {
+      streamIdsRef.current[pageId] = data.seq;
+    }
 
-    eventSource.onmessage = (event) => {
-      try {
-        const data = JSON.parse(event.data);
-        
-        // ป้องกันข้อมูลซ้ำ
-        const eventId = data.id || data.timestamp;
-        if (eventId && eventId === lastEventIdsRef.current[pageId]) {
-          return;
+    // จัดการตาม type
+    switch (data.type) {
+      case 'customer_update':
+        console.log(`📊 [${pageId}] Received customer updates:`, data.data);
+        if (onUpdateRef.current) {
+          onUpdateRef.current(pageId, data.data);
         }
-        lastEventIdsRef.current[pageId] = eventId;
-        
-        // จัดการตาม type
-        switch (data.type) {
-          case 'customer_update':
-            console.log(`📊 [${pageId}] Received customer updates:`, data.data);
-            
-            // ✅ แยกประเภทการอัปเดต
-            const statusUpdates = data.data.filter(u => 
-              u.action === 'mining_status_update' || u.mining_status
-            );
-            
-            const newUsers = data.data.filter(u => u.action === 'new');
-         
-            
-            // ส่งข้อมูลไปอัปเดต (พร้อม pageId)
-            if (onUpdate) {
-              onUpdate(pageId, data.data);
-            }
-            break;
-            
-          case 'customer_type_update':
-            console.log(`🏷️ [${pageId}] Received customer type update:`, data.data);
-            if (onUpdate) {
-              onUpdate(pageId, data.data);
-            }
-            break;
-            
-          case 'heartbeat':
-            // Heartbeat - ไม่ต้องทำอะไร
-            break;
-            
-          case 'error':
-            console.error(`❌ [${pageId}] SSE Error:`, data.message);
-            break;
-            
-          default:
-            console.log(`📦 [${pageId}] Unknown event type:`, data.type);
+        break;
+
+      case 'customer_type_update':
+        console.log(`🏷️ [${pageId}] Received customer type update:`, data.data);
+        if (onUpdateRef.current) {
+          onUpdateRef.current(pageId, data.data);
         }
-      } catch (error) {
-        console.error(`Error parsing SSE data for page ${pageId}:`, error);
-      }
+        break;
+
+      case 'resync':
+        // event ที่พลาดไปเก่าเกิน buffer ของ server -> โหลดข้อมูลใหม่
+        console.log(`🔁 [${pageId}] Realtime resync required`);
+        if (onResyncRef.current) {
+          onResyncRef.current(pageId);
+        }
+        break;
+
+      case 'error':
+        console.error(`❌ [${pageId || '-'}] Realtime error:`, data.message);
+        // subscription ของเพจนี้ปิดไป -> subscribe ใหม่ต่อจาก seq ล่าสุด
+        if (pageId && data.message === 'Subscription closed' && subscribedRef.current.has(pageId)) {
+          subscribedRef.current.delete(pageId);
+          setTimeout(syncSubscriptions, 1000);
+        }
+        break;
+
+      // seq อย่างเดียว (event ในชุดถูกกรองตาม types) - บันทึกไว้ด้านบนแล้ว
+      case 'seq':
+      case 'subscribed':
+      case 'unsubscribed':
+      case 'heartbeat':
+      case 'pong':
+        break;
+
+      default:
+        console.log(`📦 [${pageId}] Unknown event type:`, data.type);
+    }
+  }, [syncSubscriptions]);
+
+  const connect = useCallback(() => {
+    if (socketRef.current) return;
+    closedByUserRef.current = false;
+
+    console.log('🔌 Connecting realtime WebSocket');
+    const socket = new WebSocket(WS_URL);
+    socketRef.current = socket;
+
+    socket.onopen = () => {
+      console.log('✅ Realtime WebSocket connected');
+      reconnectAttemptsRef.current = 0;
+      subscribedRef.current = new Set();
+      syncSubscriptions();
     };
 
-    eventSource.onerror = (error) => {
-      console.error(`❌ SSE connection error for page ${pageId}:`, error);
-      eventSource.close();
-      delete eventSourcesRef.current[pageId];
-      
+    socket.onmessage = handleMessage;
+
+    socket.onerror = (error) => {
+      console.error('❌ Realtime WebSocket error:', error);
+    };
+
+    socket.onclose = () => {
+      socketRef.current = null;
+      subscribedRef.current = new Set();
+      if (closedByUserRef.current) return;
+
       // Reconnect with exponential backoff
-      const attempts = reconnectAttemptsRef.current[pageId] || 0;
+      const attempts = reconnectAttemptsRef.current;
       const delay = Math.min(1000 * Math.pow(2, attempts), 30000);
-      
-      console.log(`🔄 [${pageId}] Reconnecting in ${delay}ms (attempt ${attempts + 1})`);
-      
-      reconnectTimeoutsRef.current[pageId] = setTimeout(() => {
-        reconnectAttemptsRef.current[pageId] = attempts + 1;
-        connectToPage(pageId);
+      console.log(`🔄 Reconnecting realtime WebSocket in ${delay}ms (attempt ${attempts + 1})`);
+      reconnectTimeoutRef.current = setTimeout(() => {
+        reconnectAttemptsRef.current = attempts + 1;
+        connect();
       }, delay);
     };
-  }, [onUpdate]);
+  }, [handleMessage, syncSubscriptions]);
 
-  // ✅ เชื่อมต่อทุกเพจ
-  const connectAllPages = useCallback(() => {
-    if (!Array.isArray(pages) || pages.length === 0) {
-      console.warn('⚠️ No pages to connect');
-      return;
+  // ✅ ปิดการเชื่อมต่อ
+  const disconnect = useCallback(() => {
+    console.log('🔌 Disconnecting realtime WebSocket...');
+    closedByUserRef.current = true;
+    if (reconnectTimeoutRef.current) {
+      clearTimeout(reconnectTimeoutRef.current);
+      reconnectTimeoutRef.current = null;
     }
-
-    console.log(`🚀 Connecting to ${pages.length} pages...`);
-    
-    pages.forEach(page => {
-      if (page && page.id) {
-        connectToPage(page.id);
-      }
-    });
-  }, [pages, connectToPage]);
-
-  // ✅ ปิดการเชื่อมต่อทั้งหมด
-  const disconnectAll = useCallback(() => {
-    console.log('🔌 Disconnecting all SSE connections...');
-    
-    // ปิด eventSources ทั้งหมด
-    Object.keys(eventSourcesRef.current).forEach(pageId => {
-      if (eventSourcesRef.current[pageId]) {
-        eventSourcesRef.current[pageId].close();
-      }
-    });
-    eventSourcesRef.current = {};
-    
-    // Clear reconnect timeouts
-    Object.keys(reconnectTimeoutsRef.current).forEach(pageId => {
-      if (reconnectTimeoutsRef.current[pageId]) {
-        clearTimeout(reconnectTimeoutsRef.current[pageId]);
-      }
-    });
-    reconnectTimeoutsRef.current = {};
-    
-    // Reset states
-    reconnectAttemptsRef.current = {};
-    lastEventIdsRef.current = {};
+    if (socketRef.current) {
+      socketRef.current.close();
+      socketRef.current = null;
+    }
+    subscribedRef.current = new Set();
+    reconnectAttemptsRef.current = 0;
+    streamIdsRef.current = {};
   }, []);
 
-  // ✅ Effect: เชื่อมต่อเมื่อ pages เปลี่ยน
+  const reconnect = useCallback(() => {
+    if (socketRef.current) {
+      syncSubscriptions();
+    } else {
+      connect();
+    }
+  }, [connect, syncSubscriptions]);
+
+  // ✅ Effect: เปิด socket ครั้งเดียว
   useEffect(() => {
-    connectAllPages();
-    
+    connect();
     return () => {
-      disconnectAll();
+      disconnect();
     };
-  }, [connectAllPages, disconnectAll]);
+  }, [connect, disconnect]);
+
+  // ✅ Effect: pages เปลี่ยน -> subscribe / unsubscribe บน socket เดิม
+  useEffect(() => {
+    syncSubscriptions();
+  }, [pages, syncSubscriptions]);
 
-  return { 
-    disconnect: disconnectAll, 
-    reconnect: connectAllPages 
+  return {
+    disconnect,
+    reconnect
   };
 };